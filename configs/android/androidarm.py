@@ -14,6 +14,7 @@ config = {
             "7140e026b7b747236545dc30e377a959b0bdf91bb4d70efd7f97f92fce12a9196042503124b8df8d30c2d97b7eb5f9df9556afdffa0b5d9625008aead305c32b"),
     },
     ".avds_dir": "/home/cltbld/.android",
+    "avd_template_cache_dir": "/builds/slave/talos-slave/cached/avd-templates",
     "emulator_process_name": "emulator64-arm",
     "emulator_cpu": "cortex-a9",
     "exes": {
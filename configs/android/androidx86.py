@@ -14,6 +14,7 @@ config = {
             "3b2d18eb0194d82c70c5ee17487ccbac309f9b2e9839fe7ca4a27a9a06f6338bb24394476da78559685d99151fccc85fdde03297aa73ee2f7fb3183e11925c4d"),
     },
     ".avds_dir": "/home/cltbld/.android",
+    "avd_template_cache_dir": "/builds/slave/talos-slave/cached/avd-templates",
     "emulator_process_name": "emulator64-x86",
     "exes": {
         'adb': '/tools/android-sdk18/platform-tools/adb',
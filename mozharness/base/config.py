@@ -210,6 +210,7 @@ class BaseConfig(object):
     """
     def __init__(self, config=None, initial_config_file=None, config_options=None,
                  all_actions=None, default_actions=None,
+                 action_dependencies=None,
                  volatile_config=None, option_args=None,
                  require_config_file=False, usage="usage: %prog [options]"):
         self._config = {}
@@ -226,6 +227,10 @@ class BaseConfig(object):
             self.default_actions = default_actions[:]
         else:
             self.default_actions = self.all_actions[:]
+        self.action_dependencies = {}
+        if action_dependencies:
+            self.action_dependencies = self.verify_action_dependencies(
+                action_dependencies)
         if volatile_config is None:
             self.volatile_config = {
                 'actions': None,
@@ -393,6 +398,22 @@ class BaseConfig(object):
             print("Invalid action found: " + str(e))
             raise SystemExit(-1)
 
+    def verify_action_dependencies(self, action_dependencies):
+        """action_dependencies maps an action to the list of actions it
+        needs to have finished first.  Those have to come earlier in
+        all_actions, so running everything in all_actions order is always
+        still valid.
+        """
+        for action, dependencies in action_dependencies.items():
+            self.verify_actions([action] + list(dependencies))
+            for dependency in dependencies:
+                if self.all_actions.index(dependency) >= self.all_actions.index(action):
+                    print("Action %s depends on %s, which doesn't come before it in %s!" %
+                          (action, dependency, self.all_actions))
+                    raise SystemExit(-1)
+        return dict([(action, list(dependencies)) for action, dependencies
+                     in action_dependencies.items()])
+
     def list_actions(self):
         print "Actions available: " + ', '.join(self.all_actions)
         if self.default_actions != self.all_actions:
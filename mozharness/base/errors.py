@@ -12,7 +12,8 @@ Each line of output is matched against each substring or regular expression
 in the error list.  On a match, we determine the 'level' of that line,
 whether IGNORE, DEBUG, INFO, WARNING, ERROR, CRITICAL, or FATAL.
 
-TODO: Context lines (requires work on the OutputParser side)
+An entry may also set 'context_lines' to 'pre:post' (e.g. '5:5') to log the
+lines around a match at the match's level.
 
 TODO: We could also create classes that generate these, but with the
 appropriate level (please don't die on any errors; please die on any
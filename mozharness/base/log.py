@@ -11,10 +11,15 @@ TODO:
 - log rotation config
 """
 
+from collections import deque, OrderedDict
 from datetime import datetime
 import logging
 import os
+import re
+import sre_constants
+import sre_parse
 import sys
+import threading
 import traceback
 
 # Define our own FATAL_LEVEL
@@ -120,25 +125,190 @@ class LogMixin(object):
         pass
 
 
+# ErrorListMatcher {{{1
+def _required_literal(parsed):
+    """Return the longest run of literal characters that any match of the
+    parsed (sre_parse) pattern has to contain.
+    """
+    best = u''
+    run = []
+    for op, av in list(parsed) + [(None, None)]:
+        if op == sre_constants.LITERAL:
+            run.append(unichr(av))
+            continue
+        candidates = [u''.join(run)]
+        run = []
+        if op == sre_constants.SUBPATTERN:
+            candidates.append(_required_literal(av[-1]))
+        for candidate in candidates:
+            if len(candidate) > len(best):
+                best = candidate
+    return best
+
+
+def query_regex_gate(regex):
+    """Return a plain substring that has to be in any line that regex
+    matches, or '' if we can't find one.
+
+    Checking `gate in line` is much cheaper than regex.search(line), so
+    we only search lines that contain the gate.
+    """
+    if regex.flags & re.IGNORECASE:
+        return ''
+    try:
+        parsed = sre_parse.parse(regex.pattern, regex.flags)
+    except (AttributeError, TypeError, sre_constants.error):
+        return ''
+    gate = _required_literal(parsed)
+    try:
+        # Keep the gate a str, so `gate in line` works for both str and
+        # unicode lines.
+        return str(gate)
+    except UnicodeEncodeError:
+        return ''
+
+
+def parse_context_lines(context_lines):
+    """Turn an error_list entry's 'context_lines' into a
+    (num_pre_context_lines, num_post_context_lines) tuple.
+
+    context_lines is either a 'pre:post' string, where either side may be
+    empty ('5:5', '20:', ':3'), or a (pre, post) tuple.
+    """
+    if not context_lines:
+        return (0, 0)
+    if isinstance(context_lines, basestring):
+        if ':' not in context_lines:
+            raise ValueError("context_lines %s isn't of the form 'pre:post'!" %
+                             context_lines)
+        context_lines = context_lines.split(':', 1)
+    pre, post = context_lines
+    return (int(pre or 0), int(post or 0))
+
+
+class ErrorListMatcher(object):
+    """Compiled form of an error_list.
+
+    OutputParser used to run every error_list entry against every line,
+    which adds up over millions of lines of test or build output.  This
+    does the same walk, first-match-wins, but cheaper per entry:
+
+    * every 'regex' entry is gated on a literal substring the regex
+      requires (e.g. 'abort:' for '^abort:'), so the regex only runs on
+      lines that could possibly match;
+    * entries that can never win are dropped: repeated entries (the
+      lists get concatenated, so BaseErrorList shows up more than once
+      in MakefileErrorList) and anything whose gate contains an earlier
+      'substr'.
+
+    A single alternation regex over all the entries would avoid the
+    python-level loop, but sre tries every branch at every offset; it
+    measured several times slower than this on our error lists.
+
+    valid is False if an entry has neither 'substr' nor 'regex'; the
+    caller has to walk the error_list itself so it can warn about it.
+
+    num_pre_context_lines is the largest pre-context in the error_list,
+    i.e. how many lines OutputParser needs to keep around.
+    """
+    def __init__(self, error_list):
+        self.error_list = error_list
+        self.entries = list(error_list)
+        self.valid = True
+        self.checks = []
+        self.num_pre_context_lines = 0
+        earlier_substrs = []
+        seen = set()
+        for error_check in self.entries:
+            pre_context = parse_context_lines(error_check.get('context_lines'))[0]
+            self.num_pre_context_lines = max(self.num_pre_context_lines,
+                                             pre_context)
+            if 'substr' in error_check:
+                gate = error_check['substr']
+                regex = None
+                key = ('substr', gate)
+            elif 'regex' in error_check:
+                regex = error_check['regex']
+                gate = query_regex_gate(regex)
+                key = ('regex', id(regex))
+            else:
+                self.valid = False
+                continue
+            if key in seen:
+                continue
+            seen.add(key)
+            shadowed = False
+            for substr in earlier_substrs:
+                if substr in gate:
+                    shadowed = True
+                    break
+            if shadowed:
+                continue
+            if regex is None:
+                earlier_substrs.append(gate)
+            self.checks.append((gate, regex, error_check))
+
+    def match(self, line):
+        """Return the first error_list entry that matches line, or None.
+        """
+        for gate, regex, error_check in self.checks:
+            if gate in line and (regex is None or regex.search(line)):
+                return error_check
+        return None
+
+
+# Keyed by id(error_list), least recently used first.  We hold on to the
+# error_list itself so the id can't be recycled while the cache entry is
+# alive, and keep at most MAX_ERROR_LIST_MATCHERS of them.
+MAX_ERROR_LIST_MATCHERS = 64
+_error_list_matchers = OrderedDict()
+_error_list_matchers_lock = threading.Lock()
+
+
+def compile_error_list(error_list):
+    """Return a cached ErrorListMatcher for error_list.
+
+    The error lists in mozharness.base.errors and friends are module-level
+    constants, so every run_command() using the same list shares one
+    compiled matcher.  If the list has been modified since it was
+    compiled, it's recompiled.  Lists built on the fly for one call
+    (e.g. HgErrorList + [...]) age out of the cache once it's full.
+    """
+    key = id(error_list)
+    with _error_list_matchers_lock:
+        cached = _error_list_matchers.pop(key, None)
+        if cached is not None and cached.error_list is error_list and \
+                len(cached.entries) == len(error_list) and \
+                all(a is b for a, b in zip(cached.entries, error_list)):
+            _error_list_matchers[key] = cached
+            return cached
+    matcher = ErrorListMatcher(error_list)
+    with _error_list_matchers_lock:
+        _error_list_matchers[key] = matcher
+        while len(_error_list_matchers) > MAX_ERROR_LIST_MATCHERS:
+            _error_list_matchers.popitem(last=False)
+    return matcher
+
+
 # OutputParser {{{1
 class OutputParser(LogMixin):
     """ Helper object to parse command output.
 
-This will buffer output if needed, so we can go back and mark
-[(linenum - 10):linenum+10] as errors if need be, without having to
-get all the output first.
-
-linenum+10 will be easy; we can set self.num_post_context_lines to 10,
-and self.num_post_context_lines-- as we mark each line to at least error
-level X.
-
-linenum-10 will be trickier. We'll not only need to save the line
-itself, but also the level that we've set for that line previously,
-whether by matching on that line, or by a previous line's context.
-We should only log that line if all output has ended (self.finish() ?);
-otherwise store a list of dictionaries in self.context_buffer that is
-buffered up to self.num_pre_context_lines (set to the largest
-pre-context-line setting in error_list.)
+Each line is matched against self.error_list (see
+mozharness.base.errors), and logged at the level of the first matching
+entry, or INFO.
+
+An error_list entry can also ask for context around the lines it
+matches, e.g. 'context_lines': '5:5' for 5 lines before and 5 lines
+after.  Post-context is easy: the next N lines are logged at (at least)
+the level of the match.  The pre-context lines have already been logged
+by the time we see the match, so we keep the last
+self.num_pre_context_lines lines (the largest pre-context setting in
+error_list) in self.context_buffer, a bounded deque, along with the
+level each was logged at; on a match, any of them logged at a lesser
+level are logged again at the match's level.  That way the per-level
+logs (foo_error.log etc.) show what led up to the error, without our
+holding on to more than a handful of lines.
 """
     def __init__(self, config=None, log_obj=None, error_list=None, log_output=True):
         self.config = config
@@ -147,46 +317,110 @@ pre-context-line setting in error_list.)
         self.log_output = log_output
         self.num_errors = 0
         self.num_warnings = 0
-        # TODO context_lines.
-        # Not in use yet, but will be based off error_list.
-        self.context_buffer = []
+        # [line, log_level] pairs.
+        self.context_buffer = deque(maxlen=0)
         self.num_pre_context_lines = 0
         self.num_post_context_lines = 0
+        self.post_context_level = INFO
         self.worst_log_level = INFO
-
-    def parse_single_line(self, line):
+        self._error_list_matcher = None
+
+    def _query_error_list_matcher(self):
+        if self._error_list_matcher is None or \
+                self._error_list_matcher.error_list is not self.error_list:
+            matcher = compile_error_list(self.error_list)
+            self._error_list_matcher = matcher
+            if matcher.num_pre_context_lines != self.num_pre_context_lines:
+                self.num_pre_context_lines = matcher.num_pre_context_lines
+                self.context_buffer = deque(self.context_buffer,
+                                            maxlen=self.num_pre_context_lines)
+        return self._error_list_matcher
+
+    def _match_error_list(self, line):
+        """Return the first error_list entry that matches line, or None.
+        """
+        matcher = self._query_error_list_matcher()
+        if matcher.valid:
+            return matcher.match(line)
+        # An entry without 'substr' or 'regex'; walk the list by hand so
+        # we keep warning about it.
         for error_check in self.error_list:
-            # TODO buffer for context_lines.
-            match = False
             if 'substr' in error_check:
                 if error_check['substr'] in line:
-                    match = True
+                    return error_check
             elif 'regex' in error_check:
                 if error_check['regex'].search(line):
-                    match = True
+                    return error_check
             else:
                 self.warning("error_list: 'substr' and 'regex' not in %s" %
                              error_check)
-            if match:
-                log_level = error_check.get('level', INFO)
-                if self.log_output:
-                    message = ' %s' % line
-                    if error_check.get('explanation'):
-                        message += '\n %s' % error_check['explanation']
-                    if error_check.get('summary'):
-                        self.add_summary(message, level=log_level)
-                    else:
-                        self.log(message, level=log_level)
-                if log_level in (ERROR, CRITICAL, FATAL):
-                    self.num_errors += 1
-                if log_level == WARNING:
-                    self.num_warnings += 1
-                self.worst_log_level = self.worst_level(log_level,
-                                                        self.worst_log_level)
-                break
-        else:
+
+    def _query_context_level(self, log_level):
+        """Context lines are logged at the level of the line they're
+        context for, but never FATAL; that would exit before we get to
+        the line itself.
+        """
+        if log_level == FATAL:
+            return CRITICAL
+        return log_level
+
+    def _log_pre_context(self, num_lines, context_level):
+        if num_lines > len(self.context_buffer):
+            num_lines = len(self.context_buffer)
+        for index in range(len(self.context_buffer) - num_lines,
+                           len(self.context_buffer)):
+            line, line_level = self.context_buffer[index]
+            if self.worst_level(context_level, line_level) == line_level:
+                # Already logged at this level or worse.
+                continue
             if self.log_output:
-                self.info(' %s' % line)
+                self.log(' %s' % line, level=context_level)
+            self.context_buffer[index][1] = context_level
+
+    def parse_single_line(self, line):
+        error_check = self._match_error_list(line)
+        log_level = INFO
+        pre_context = post_context = 0
+        if error_check is not None:
+            log_level = error_check.get('level', INFO)
+            pre_context, post_context = parse_context_lines(
+                error_check.get('context_lines'))
+        if pre_context or post_context:
+            context_level = self._query_context_level(log_level)
+        if pre_context:
+            self._log_pre_context(pre_context, context_level)
+        # The level we log at; log_level is what we count.
+        display_level = log_level
+        if self.num_post_context_lines:
+            self.num_post_context_lines -= 1
+            display_level = self.worst_level(self.post_context_level,
+                                             log_level)
+            if not self.num_post_context_lines:
+                self.post_context_level = INFO
+        if error_check is not None:
+            if self.log_output:
+                message = ' %s' % line
+                if error_check.get('explanation'):
+                    message += '\n %s' % error_check['explanation']
+                if error_check.get('summary'):
+                    self.add_summary(message, level=display_level)
+                else:
+                    self.log(message, level=display_level)
+            if log_level in (ERROR, CRITICAL, FATAL):
+                self.num_errors += 1
+            if log_level == WARNING:
+                self.num_warnings += 1
+            self.worst_log_level = self.worst_level(log_level,
+                                                    self.worst_log_level)
+        elif self.log_output:
+            self.log(' %s' % line, level=display_level)
+        if post_context:
+            self.num_post_context_lines = max(post_context,
+                                              self.num_post_context_lines)
+            self.post_context_level = self.worst_level(context_level,
+                                                       self.post_context_level)
+        if self.num_pre_context_lines:
+            self.context_buffer.append([line, display_level])
 
     def add_lines(self, output):
         if isinstance(output, basestring):
@@ -340,6 +574,95 @@ class BaseLogger(object):
             raise SystemExit(exit_code)
 
 
+# BufferedLogger {{{1
+class BufferedLogger(object):
+    """Hold on to messages and hand them to logger (another logger's
+    log_message) in one block on flush(), so the output of something
+    running in a thread isn't interleaved with everything else.
+
+    FATAL messages flush everything right away, since they exit.
+
+    If log_file is set, messages are also written to that file as they
+    come in.
+    """
+    def __init__(self, logger, lock=None, log_file=None):
+        self.logger = logger
+        self.lock = lock or threading.Lock()
+        self.messages = []
+        self.log_file = log_file
+        self.log_file_mode = 'w'
+        self.log_fh = None
+
+    def log_message(self, message, level=INFO, exit_code=-1, post_fatal_callback=None):
+        if level == IGNORE:
+            return
+        if self.log_file:
+            if not self.log_fh:
+                self.log_fh = open(self.log_file, self.log_file_mode)
+                self.log_file_mode = 'a'
+            timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            for line in message.splitlines():
+                self.log_fh.write("%s %8s - %s\n" % (timestamp, level.upper(), line))
+            self.log_fh.flush()
+        if level == FATAL:
+            self.flush()
+            return self.logger.log_message(message, level=level, exit_code=exit_code,
+                                           post_fatal_callback=post_fatal_callback)
+        self.messages.append((message, level))
+
+    def flush(self):
+        with self.lock:
+            for message, level in self.messages:
+                self.logger.log_message(message, level=level)
+            self.messages = []
+        if self.log_fh:
+            self.log_fh.close()
+            self.log_fh = None
+
+
+# ThreadLogger {{{1
+class ThreadLogger(object):
+    """Hand messages to the logger set_logger() was given in the current
+    thread, or to logger if there isn't one.
+
+    Set as a script's log_obj, this lets methods running in other
+    threads log somewhere of their own, e.g. a BufferedLogger.
+    Everything else is logger's.
+    """
+    def __init__(self, logger):
+        self.logger = logger
+        self.local = threading.local()
+
+    def set_logger(self, logger):
+        self.local.logger = logger
+
+    def log_message(self, message, level=INFO, exit_code=-1, post_fatal_callback=None):
+        logger = getattr(self.local, 'logger', None) or self.logger
+        return logger.log_message(message, level=level, exit_code=exit_code,
+                                  post_fatal_callback=post_fatal_callback)
+
+    def __getattr__(self, name):
+        return getattr(self.logger, name)
+
+
+# PrefixLogger {{{1
+class PrefixLogger(object):
+    """Hand messages to logger with prefix in front of every line, e.g. to
+    tell apart the output of several processes logging at once.
+    """
+    def __init__(self, logger, prefix):
+        self.logger = logger
+        self.prefix = prefix
+
+    def log_message(self, message, level=INFO, exit_code=-1, post_fatal_callback=None):
+        message = '\n'.join(self.prefix + line for line in message.splitlines())
+        return self.logger.log_message(message, level=level, exit_code=exit_code,
+                                       post_fatal_callback=post_fatal_callback)
+
+    def __getattr__(self, name):
+        return getattr(self.logger, name)
+
+
 # SimpleFileLogger {{{1
 class SimpleFileLogger(BaseLogger):
     """Create one logFile.  Possibly also output to
@@ -7,6 +7,14 @@
 """Generic ways to parallelize jobs.
 """
 
+import itertools
+from multiprocessing.pool import ThreadPool
+import os
+import sys
+import threading
+
+from mozharness.base.log import BufferedLogger, ThreadLogger
+
 
 # ChunkingMixin {{{1
 class ChunkingMixin(object):
@@ -34,3 +42,69 @@ class ChunkingMixin(object):
             if c == this_chunk:
                 return possible_list[0:n]
             del possible_list[0:n]
+
+
+# ParallelMixin {{{1
+class ParallelMixin(object):
+    """Run a method over a list of things in threads.
+
+    Depends on LogMixin and ScriptMixin.
+    """
+    def run_in_parallel(self, func, items, num_workers=1, log_name=None):
+        """Call func(item) for each of items, in up to num_workers
+        threads, and yield (item, result) as they finish.
+
+        Each item's log goes into the main log in one block when it's
+        done and, if log_name is set, into
+        abs_log_dir/<log_name>-<item>.log as it happens.  If func raises
+        (e.g. through fatal()) for an item, no more items are started;
+        once the running ones are done, the exception is re-raised.
+        """
+        log_obj = self.log_obj
+        log_lock = threading.Lock()
+        exc_infos = []
+        if log_obj:
+            self.log_obj = ThreadLogger(log_obj)
+        if log_name:
+            abs_log_dir = self.query_abs_dirs()['abs_log_dir']
+            self.mkdir_p(abs_log_dir)
+
+        def run_item(item):
+            if exc_infos:
+                return item, None, False
+            item_log = None
+            if log_obj:
+                log_file = None
+                if log_name:
+                    log_file = os.path.join(abs_log_dir,
+                                            '%s-%s.log' % (log_name, item))
+                item_log = BufferedLogger(log_obj, lock=log_lock,
+                                          log_file=log_file)
+                self.log_obj.set_logger(item_log)
+            try:
+                return item, func(item), True
+            except BaseException:
+                exc_infos.append(sys.exc_info())
+                return item, None, False
+            finally:
+                if item_log:
+                    item_log.flush()
+                    self.log_obj.set_logger(None)
+
+        pool = None
+        try:
+            if num_workers > 1 and len(items) > 1:
+                pool = ThreadPool(min(num_workers, len(items)))
+                results = pool.imap_unordered(run_item, items)
+            else:
+                results = itertools.imap(run_item, items)
+            for item, result, done in results:
+                if done:
+                    yield item, result
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+            self.log_obj = log_obj
+        if exc_infos:
+            raise exc_infos[0][0], exc_infos[0][1], exc_infos[0][2]
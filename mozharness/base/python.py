@@ -9,6 +9,7 @@
 
 import os
 import sys
+import threading
 import traceback
 
 from mozharness.base.script import (
@@ -421,6 +422,10 @@ class ResourceMonitoringMixin(object):
     since we require an external package, we can only record resource usage
     after that package is installed (as part of creating the virtualenv).
     That's just the way things have to be.
+
+    create-virtualenv activates the virtualenv for the whole process, so
+    scripts with action_dependencies should make it depend on every action
+    that could otherwise run alongside it.
     """
     def __init__(self, *args, **kwargs):
         super(ResourceMonitoringMixin, self).__init__(*args, **kwargs)
@@ -430,6 +435,20 @@ class ResourceMonitoringMixin(object):
         self.register_virtualenv_module('mozsystemmonitor==0.0.0',
                                         method='pip', optional=True)
         self._resource_monitor = None
+        self._resource_timings = []
+        # Actions run in parallel can start before create-virtualenv and
+        # finish after it; only finish the phases we actually began.
+        self._resource_phases = set()
+        self._resource_lock = threading.Lock()
+
+    def record_resource_timing(self, name, duration):
+        """Report that name took duration seconds along with the resource
+        usage at the end of the run.
+
+        This is for things the resource monitor can't see, because they
+        happen before create-virtualenv or are smaller than an action.
+        """
+        self._resource_timings.append((name, duration))
 
     @PostScriptAction('create-virtualenv')
     def _start_resource_monitoring(self, action, success=None):
@@ -445,41 +464,45 @@ class ResourceMonitoringMixin(object):
             from mozsystemmonitor.resourcemonitor import SystemResourceMonitor
 
             self.info("Starting resource monitoring.")
-            self._resource_monitor = SystemResourceMonitor(poll_interval=1.0)
-            self._resource_monitor.start()
+            monitor = SystemResourceMonitor(poll_interval=1.0)
+            monitor.start()
+            with self._resource_lock:
+                self._resource_monitor = monitor
         except Exception:
             self.warning("Unable to start resource monitor: %s" %
                          traceback.format_exc())
 
     @PreScriptAction
     def _resource_record_pre_action(self, action):
-        # Resource monitor isn't available until after create-virtualenv.
-        if not self._resource_monitor:
-            return
+        with self._resource_lock:
+            # Resource monitor isn't available until after create-virtualenv.
+            if not self._resource_monitor:
+                return
 
-        self._resource_monitor.begin_phase(action)
+            self._resource_monitor.begin_phase(action)
+            self._resource_phases.add(action)
 
     @PostScriptAction
     def _resource_record_post_action(self, action, success=None):
-        # Resource monitor isn't available until after create-virtualenv.
-        if not self._resource_monitor:
-            return
+        with self._resource_lock:
+            if action not in self._resource_phases:
+                return
 
-        self._resource_monitor.finish_phase(action)
+            self._resource_phases.remove(action)
+            self._resource_monitor.finish_phase(action)
 
     @PostScriptRun
     def _resource_record_post_run(self):
-        if not self._resource_monitor:
-            return
-
-        # This should never raise an exception. This is a workaround until
-        # mozsystemmonitor is fixed. See bug 895388.
-        try:
-            self._resource_monitor.stop()
-            self._log_resource_usage()
-        except Exception:
-            self.warning("Exception when reporting resource usage: %s" %
-                         traceback.format_exc())
+        if self._resource_monitor:
+            # This should never raise an exception. This is a workaround until
+            # mozsystemmonitor is fixed. See bug 895388.
+            try:
+                self._resource_monitor.stop()
+                self._log_resource_usage()
+            except Exception:
+                self.warning("Exception when reporting resource usage: %s" %
+                             traceback.format_exc())
+        self._log_resource_timings()
 
     def _log_resource_usage(self):
         rm = self._resource_monitor
@@ -528,6 +551,10 @@ class ResourceMonitoringMixin(object):
             cpu_percent, cpu_times, io = resources(phase)
             log_usage(phase, end_time - start_time, cpu_percent, cpu_times, io)
 
+    def _log_resource_timings(self):
+        for name, duration in self._resource_timings:
+            self.info('%s - Wall time: %.0fs' % (name, duration))
+
 
 # __main__ {{{1
 
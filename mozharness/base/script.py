@@ -11,21 +11,34 @@ mozharness.
 """
 
 import codecs
+from collections import deque
 from contextlib import contextmanager
+import errno
+import fnmatch
 import gzip
 import inspect
+import itertools
 import os
 import platform
 import pprint
+import Queue
 import re
+import select
 import shutil
+import signal
 import socket
+import stat
+import struct
 import subprocess
 import sys
+import tarfile
+import threading
 import time
 import traceback
 import urllib2
 import urlparse
+import zipfile
+import zlib
 if os.name == 'nt':
     try:
         import win32file
@@ -43,7 +56,163 @@ except ImportError:
 from mozprocess import ProcessHandler
 from mozharness.base.config import BaseConfig
 from mozharness.base.log import SimpleFileLogger, MultiFileLogger, \
-    LogMixin, OutputParser, DEBUG, INFO, ERROR, FATAL
+    LogMixin, OutputParser, DEBUG, INFO, WARNING, ERROR, FATAL
+from mozharness.base.transfer import DownloadCache
+
+
+# Run by `python -c` in front of a command, to start it in a new session
+# (and so a new process group) before exec'ing it.
+SETSID_WRAPPER = "import os, sys; os.setsid(); os.execvp(sys.argv[1], sys.argv[1:])"
+
+
+def query_setsid_command(command, shell=False):
+    """Return command (a Popen() args list or string), wrapped so it
+    runs as the leader of a process group of its own, for Popen() with
+    shell=False.
+
+    preexec_fn would be simpler, but on python 2 the forked child can
+    deadlock in it if other threads were running, and we run commands
+    from several threads.
+    """
+    if isinstance(command, basestring):
+        command = [command]
+    if shell:
+        command = ['/bin/sh', '-c'] + list(command)
+    return [sys.executable, '-c', SETSID_WRAPPER] + list(command)
+
+
+class RangeIgnored(urllib2.URLError):
+    """The server answered a Range request with the whole file."""
+
+
+class TeeReader(object):
+    """File-like wrapper that copies everything read from fileobj to
+    copy_to, and remembers the first error reading fileobj raised.
+    """
+    def __init__(self, fileobj, copy_to):
+        self.fileobj = fileobj
+        self.copy_to = copy_to
+        self.error = None
+
+    def read(self, size=-1):
+        try:
+            data = self.fileobj.read(size)
+        except Exception, e:
+            self.error = e
+            raise
+        self.copy_to.write(data)
+        return data
+
+    def drain(self):
+        while self.read(1024 ** 2):
+            pass
+
+
+# OutputPump {{{1
+class OutputPump(object):
+    """Read output from one or more pipes as it arrives.
+
+    The pipes are watched with select(); whatever is ready is read in one
+    large chunk and split into lines in bulk, and each stream's callback
+    is handed a list of complete lines at a time.  A trailing partial
+    line is held back until the rest of it (or EOF) arrives.
+
+    select() doesn't work on pipes on Windows, so this is POSIX-only.
+    """
+    def __init__(self, chunk_size=64 * 1024):
+        self.chunk_size = chunk_size
+        # fd: [callback, partial line]
+        self.streams = {}
+
+    def add_stream(self, stream, callback, split_lines=True):
+        """Start watching stream (a file object or fd).  callback gets
+        called with a list of lines, without line endings, or with each
+        chunk of data as it was read if split_lines is False.
+        """
+        if hasattr(stream, 'fileno'):
+            stream = stream.fileno()
+        if split_lines:
+            self.streams[stream] = [callback, '']
+        else:
+            self.streams[stream] = [callback, None]
+
+    def remove_stream(self, stream):
+        """Stop watching stream, once the callback has had whatever is
+        ready to read on it right now, and any partial line.
+
+        For a process that exited while something it started still holds
+        its stdout open.
+        """
+        if hasattr(stream, 'fileno'):
+            stream = stream.fileno()
+        while stream in self.streams and select.select([stream], [], [], 0)[0]:
+            self._read(stream)
+        if stream in self.streams:
+            callback, partial = self.streams.pop(stream)
+            if partial:
+                callback([partial])
+
+    def _read(self, fd):
+        try:
+            data = os.read(fd, self.chunk_size)
+        except OSError, e:
+            if e.errno in (errno.EINTR, errno.EAGAIN):
+                return
+            raise
+        callback, partial = self.streams[fd]
+        if not data:
+            del self.streams[fd]
+            if partial:
+                callback([partial])
+            return
+        if partial is None:
+            callback(data)
+            return
+        lines = (partial + data).split('\n')
+        self.streams[fd][1] = lines.pop()
+        if lines:
+            callback(lines)
+
+    def pump(self, timeout=None):
+        """Wait up to timeout seconds (forever if None) for output from
+        any stream, and hand it to the callbacks.
+
+        If every stream has hit EOF already, just sleep for timeout, so
+        callers polling for their processes to exit don't spin.
+
+        Returns True if anything was read, False otherwise.
+        """
+        if not self.streams:
+            if timeout:
+                time.sleep(timeout)
+            return False
+        try:
+            ready = select.select(self.streams.keys(), [], [], timeout)[0]
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return False
+            raise
+        for fd in ready:
+            self._read(fd)
+        return bool(ready)
+
+    def run(self, output_timeout=None):
+        """Pump until every stream hits EOF.
+
+        If output_timeout is set and none of the streams produce anything
+        for that many seconds, give up and return False.  Otherwise return
+        True.
+        """
+        last_output = time.time()
+        while self.streams:
+            wait = None
+            if output_timeout:
+                wait = max(0, last_output + output_timeout - time.time())
+            if self.pump(wait):
+                last_output = time.time()
+            elif output_timeout and time.time() - last_output >= output_timeout:
+                return False
+        return True
 
 
 # ScriptMixin {{{1
@@ -58,6 +227,8 @@ class ScriptMixin(object):
     """
 
     env = None
+    download_cache = None
+    _partial_downloads = None
 
     # Simple filesystem commands {{{2
     def mkdir_p(self, path, error_level=ERROR):
@@ -172,12 +343,138 @@ class ScriptMixin(object):
         else:
             return parsed.netloc
 
+    def _query_partial_download(self, url, file_name, headers):
+        """ Helper method for _download_file().
+
+            Return the segment list for downloading url to file_name with
+            Range requests, or None if we can't.  Segments left over from an
+            earlier attempt are reused, as long as the server still sends
+            the same ETag/Last-Modified/Content-Length and file_name is
+            still there, so a retry only fetches what's missing.
+            """
+        if self._partial_downloads is None:
+            self._partial_downloads = {}
+        key = (url, file_name)
+        if key in self._partial_downloads and self._partial_downloads[key] is None:
+            # The server ignored our Range header last time.
+            return None
+        length = headers.get('content-length')
+        if 'bytes' not in headers.get('accept-ranges', '') or length is None:
+            return None
+        length = int(length)
+        if not length:
+            return None
+        validators = [headers.get(h) for h in ('etag', 'last-modified')] + [length]
+        partial = self._partial_downloads.get(key)
+        if partial and partial['validators'] == validators and \
+                os.path.exists(file_name) and os.path.getsize(file_name) == length:
+            got_length = sum(segment['pos'] - segment['start'] for segment in partial['segments'])
+            self.info("Resuming download of %s; %d of %d bytes already done." %
+                      (url, got_length, length))
+            return partial['segments']
+        num_segments = max(1, min(self.config.get('download_segments', 4),
+                                  length // self.config.get('download_min_segment_size',
+                                                            8 * 1024 ** 2)))
+        size = -(-length // num_segments)
+        segments = [{'start': start, 'pos': start, 'end': min(start + size, length) - 1}
+                    for start in range(0, length, size)]
+        local_file = open(file_name, 'wb')
+        local_file.truncate(length)
+        local_file.close()
+        self._partial_downloads[key] = {'validators': validators, 'segments': segments}
+        return segments
+
+    def _download_segment(self, url, file_name, segment, f=None):
+        """ Helper method for _download_file_in_segments().
+
+            Fetch segment['pos'] through segment['end'] of url into the same
+            bytes of file_name, keeping segment['pos'] up to date.  If f is
+            given, it's a response for the whole file, and segment starts
+            at 0.
+            """
+        if f is None:
+            request = urllib2.Request(url, headers={
+                'Range': 'bytes=%d-%d' % (segment['pos'], segment['end'])})
+            f = urllib2.urlopen(request, timeout=30)
+            if f.getcode() != 206:
+                f.close()
+                raise RangeIgnored("Server ignored the Range header for %s" % url)
+        try:
+            local_file = open(file_name, 'r+b')
+            try:
+                local_file.seek(segment['pos'])
+                while segment['pos'] <= segment['end']:
+                    block = f.read(min(1024 ** 2, segment['end'] - segment['pos'] + 1))
+                    if not block:
+                        raise urllib2.URLError("Download incomplete; bytes %d-%d stopped at %d" %
+                                               (segment['start'], segment['end'], segment['pos']))
+                    local_file.write(block)
+                    segment['pos'] += len(block)
+            finally:
+                local_file.close()
+        finally:
+            f.close()
+
+    def _download_file_in_segments(self, url, file_name, segments, f):
+        """ Helper method for _download_file().
+
+            Download the unfinished segments concurrently, one connection
+            each; the first segment of a fresh download reuses f, our
+            request for the whole file.  The first error is re-raised once
+            they've all stopped; whatever was downloaded stays in segments
+            for the retry.
+            """
+        if segments[0]['pos'] != 0:
+            f.close()
+            f = None
+        segments = [s for s in segments if s['pos'] <= s['end']]
+        errors = []
+
+        def download_segment(segment, f=None):
+            try:
+                self._download_segment(url, file_name, segment, f=f)
+            except Exception:
+                errors.append(sys.exc_info())
+
+        if len(segments) > 1:
+            self.info("Downloading %s in %d segments." % (url, len(segments)))
+        threads = []
+        for segment in segments[1:]:
+            thread = threading.Thread(target=download_segment, args=(segment, ))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        if segments:
+            download_segment(segments[0], f=f)
+        for thread in threads:
+            thread.join()
+        if errors:
+            if [e for e in errors if e[0] is RangeIgnored]:
+                self._partial_downloads[(url, file_name)] = None
+            raise errors[0][0], errors[0][1], errors[0][2]
+
     def _download_file(self, url, file_name):
         """ Helper script for download_file()
+
+            If the server supports Range requests, the file is downloaded
+            in up to self.config['download_segments'] (default 4) concurrent
+            segments of at least self.config['download_min_segment_size']
+            bytes, and a retry picks up where the last attempt left off.
             """
         try:
             f_length = None
             f = urllib2.urlopen(url, timeout=30)
+            segments = self._query_partial_download(url, file_name, f.info())
+            if segments is not None:
+                self._download_file_in_segments(url, file_name, segments, f)
+                # file_name was created at its full length, so check every
+                # segment got all its bytes rather than the file size.
+                for segment in segments:
+                    if segment['pos'] != segment['end'] + 1:
+                        raise urllib2.URLError("Download incomplete; bytes %d-%d stopped at %d" %
+                                               (segment['start'], segment['end'], segment['pos']))
+                self._partial_downloads.pop((url, file_name))
+                return file_name
             if f.info().get('content-length') is not None:
                 f_length = int(f.info()['content-length'])
                 got_length = 0
@@ -232,12 +529,105 @@ class ScriptMixin(object):
             error_level=error_level,
         )
 
+    def query_download_cache(self):
+        """Return the DownloadCache in self.config['download_cache_dir'],
+        or None if there isn't one configured.
+
+        self.config['download_cache_max_size'] is the size budget in bytes.
+        """
+        if self.download_cache is None and self.config.get('download_cache_dir'):
+            self.download_cache = DownloadCache(
+                self.config['download_cache_dir'],
+                max_size=self.config.get('download_cache_max_size'))
+        return self.download_cache
+
+    def _query_url_headers(self, url):
+        """ HEAD url and return the headers the download cache validates
+            against.
+            """
+        request = urllib2.Request(url)
+        request.get_method = lambda: 'HEAD'
+        f = urllib2.urlopen(request, timeout=30)
+        try:
+            info = f.info()
+            return dict((h, info.get(h)) for h in DownloadCache.VALIDATORS
+                        if info.get(h) is not None)
+        finally:
+            f.close()
+
+    def _download_file_via_cache(self, url, file_name, error_level, sha512=None):
+        """ Helper method for download_file() when there's a download cache.
+
+            Copy the cached copy of url to file_name if it's still current,
+            otherwise download it into the cache first.  A cached copy that
+            doesn't match its sha512 any more, or that another process
+            evicts before we can copy it, is downloaded again.
+            """
+        cache = self.query_download_cache()
+        cached_sha512 = None
+        if sha512 and cache.query_object_path(sha512):
+            cached_sha512 = sha512
+        else:
+            try:
+                headers = self._query_url_headers(url)
+            except (urllib2.URLError, socket.timeout, socket.error), e:
+                self.info("Can't check %s against the download cache: %s" % (url, str(e)))
+                return self._retry_download_file(url, file_name, error_level)
+            cached_sha512 = cache.query_cached_sha512(url, headers, sha512=sha512)
+            if not cached_sha512 and not (headers.get('etag') or headers.get('last-modified') or sha512):
+                self.info("%s has no ETag or Last-Modified; not caching." % url)
+                return self._retry_download_file(url, file_name, error_level)
+        downloaded = not cached_sha512
+        if cached_sha512:
+            self.info("Using cached copy of %s." % url)
+        else:
+            tmp_file = cache.mkstemp()
+            status = self._retry_download_file(url, tmp_file, error_level)
+            if status != tmp_file:
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+                return status
+            cached_sha512 = cache.add(url, tmp_file, headers)
+            for path in cache.evict(keep=cached_sha512):
+                self.info("Evicted %s from the download cache." % path)
+            if sha512 and cached_sha512 != sha512:
+                self.log("%s has sha512 %s; expected %s!" % (url, cached_sha512, sha512),
+                         level=error_level)
+                return None
+        try:
+            intact = cache.copy(cached_sha512, file_name)
+        except (IOError, OSError), e:
+            if e.errno == errno.ENOENT and not cache.query_object_path(cached_sha512):
+                if downloaded:
+                    self.warning("%s was evicted from the download cache as we added it; "
+                                 "downloading it directly." % url)
+                    return self._retry_download_file(url, file_name, error_level)
+                self.warning("Cached copy of %s was evicted; downloading it again." % url)
+                return self._download_file_via_cache(url, file_name, error_level,
+                                                     sha512=sha512)
+            self.log("Can't copy %s out of the download cache: %s" % (url, str(e)),
+                     level=error_level)
+            return None
+        if not intact:
+            if downloaded:
+                self.log("%s changed in the download cache as we added it!" % url,
+                         level=error_level)
+                return None
+            self.warning("Cached copy of %s is corrupt; downloading it again." % url)
+            return self._download_file_via_cache(url, file_name, error_level,
+                                                 sha512=sha512)
+        return file_name
+
     # http://www.techniqal.com/blog/2008/07/31/python-file-read-write-with-urllib2/
-    # TODO thinking about creating a transfer object.
     def download_file(self, url, file_name=None, parent_dir=None,
                       create_parent_dir=True, error_level=ERROR,
-                      exit_code=3):
+                      exit_code=3, sha512=None):
         """ Python wget.
+
+        If self.config['download_cache_dir'] is set, downloads go through
+        a DownloadCache there, and a url that hasn't changed since the last
+        time (or whose sha512, if passed, we already have) isn't downloaded
+        again.
         """
         if not file_name:
             try:
@@ -251,7 +641,11 @@ class ScriptMixin(object):
             if create_parent_dir:
                 self.mkdir_p(parent_dir, error_level=error_level)
         self.info("Downloading %s to %s" % (url, file_name))
-        status = self._retry_download_file(url, file_name, error_level)
+        if self.query_download_cache():
+            status = self._download_file_via_cache(url, file_name, error_level,
+                                                   sha512=sha512)
+        else:
+            status = self._retry_download_file(url, file_name, error_level)
         if status == file_name:
             self.info("Downloaded %d bytes." % os.path.getsize(file_name))
         return status
@@ -616,7 +1010,6 @@ class ScriptMixin(object):
         output_timeout is the number of seconds without output before the process
         is killed.
 
-        TODO: context_lines
         TODO: error_level_override?
 
         output_parser lets you provide an instance of your own OutputParser
@@ -624,10 +1017,10 @@ class ScriptMixin(object):
 
         error_list example:
         [{'regex': re.compile('^Error: LOL J/K'), level=IGNORE},
-         {'regex': re.compile('^Error:'), level=ERROR, contextLines='5:5'},
-         {'substr': 'THE WORLD IS ENDING', level=FATAL, contextLines='20:'}
+         {'regex': re.compile('^Error:'), level=ERROR, context_lines='5:5'},
+         {'substr': 'THE WORLD IS ENDING', level=FATAL, context_lines='20:'}
         ]
-        (context_lines isn't written yet)
+        context_lines is 'pre:post'; see OutputParser.
         """
         if success_codes is None:
             success_codes = [0]
@@ -661,7 +1054,11 @@ class ScriptMixin(object):
             parser = output_parser
 
         try:
-            if output_timeout:
+            if not self._is_windows():
+                returncode = self._pump_command_output(command, shell, cwd,
+                                                       env, parser,
+                                                       output_timeout)
+            elif output_timeout:
                 def processOutput(line):
                     parser.add_lines(line)
 
@@ -726,12 +1123,46 @@ class ScriptMixin(object):
             return parser.num_errors
         return returncode
 
+    def _pump_command_output(self, command, shell, cwd, env, parser,
+                             output_timeout=None):
+        """run_command() helper for non-Windows platforms.
+
+        Feeds the command's output to parser in batches as it arrives,
+        killing the command if it goes output_timeout seconds without
+        any output.  Returns the command's exit status.
+        """
+        if output_timeout:
+            self.info("Calling %s with output_timeout %d" % (command, output_timeout))
+            # Give the command its own process group, so a timeout kills
+            # anything it spawned as well.  Not through preexec_fn; see
+            # query_setsid_command().
+            command = query_setsid_command(command, shell=shell)
+            shell = False
+        p = subprocess.Popen(command, shell=shell, stdout=subprocess.PIPE,
+                             cwd=cwd, stderr=subprocess.STDOUT, env=env)
+        pump = OutputPump()
+        pump.add_stream(p.stdout, parser.add_lines)
+        if not pump.run(output_timeout=output_timeout):
+            self.info("Automation Error: timed out after %s seconds running %s" % (str(output_timeout), str(command)))
+            try:
+                os.killpg(p.pid, signal.SIGKILL)
+            except OSError:
+                # Already gone.
+                pass
+            p.stdout.close()
+            p.wait()
+            self.error('timed out after %s seconds of no output' % output_timeout)
+        else:
+            p.wait()
+        return p.returncode
+
     def get_output_from_command(self, command, cwd=None,
                                 halt_on_failure=False, env=None,
                                 silent=False, log_level=INFO,
                                 tmpfile_base_path='tmpfile',
                                 return_type='output', save_tmpfiles=False,
-                                throw_exception=False, fatal_exit_code=2):
+                                throw_exception=False, fatal_exit_code=2,
+                                keep_first_lines=None, keep_last_lines=None):
         """Similar to run_command, but where run_command is an
         os.system(command) analog, get_output_from_command is a `command`
         analog.
@@ -739,11 +1170,23 @@ class ScriptMixin(object):
         Less error checking by design, though if we figure out how to
         do it without borking the output, great.
 
+        return_type 'output' returns stdout as a string.  stdout and
+        stderr are read straight from pipes; if keep_first_lines and/or
+        keep_last_lines are set, only that many lines from the start
+        and/or end of stdout are kept and returned.
+
+        return_type 'generator' returns a generator over the lines of
+        stdout (without line endings), yielded as the command writes
+        them.  The command is only run as the generator is iterated, and
+        halt_on_failure or throw_exception kick in once it's exhausted.
+
+        Any other return_type, or save_tmpfiles, writes stdout and stderr
+        to tmpfile_base_path + '_stdout' and '_stderr', and returns the
+        pair of filenames for anything but 'output'.
+
         TODO: binary mode? silent is kinda like that.
         TODO: since p.wait() can take a long time, optionally log something
         every N seconds?
-        TODO: optionally only keep the first or last (N) line(s) of output?
-        TODO: optionally only return the tmp_stdout_filename?
         """
         if cwd:
             if not os.path.isdir(cwd):
@@ -758,6 +1201,162 @@ class ScriptMixin(object):
             self.info("Getting output from command: %s" % command)
         if isinstance(command, list):
             self.info("Copy/paste: %s" % subprocess.list2cmdline(command))
+        if return_type == 'generator':
+            return self._iter_output_from_command(
+                command, cwd=cwd, env=env, silent=silent, log_level=log_level,
+                halt_on_failure=halt_on_failure,
+                throw_exception=throw_exception,
+                fatal_exit_code=fatal_exit_code,
+            )
+        if return_type != 'output' or save_tmpfiles:
+            return self._get_output_from_command_via_tmpfiles(
+                command, cwd=cwd, env=env, silent=silent, log_level=log_level,
+                halt_on_failure=halt_on_failure,
+                tmpfile_base_path=tmpfile_base_path, return_type=return_type,
+                save_tmpfiles=save_tmpfiles, throw_exception=throw_exception,
+                fatal_exit_code=fatal_exit_code,
+            )
+        result = {}
+        lines = self._iter_output_from_command(
+            command, cwd=cwd, env=env, silent=silent, log_level=log_level,
+            halt_on_failure=halt_on_failure, throw_exception=throw_exception,
+            fatal_exit_code=fatal_exit_code, result=result,
+        )
+        if keep_first_lines is None and keep_last_lines is None:
+            output_lines = list(lines)
+        else:
+            output_lines = list(itertools.islice(lines, keep_first_lines or 0))
+            # This also runs the generator to the end.
+            output_lines.extend(deque(lines, maxlen=keep_last_lines or 0))
+        if not output_lines:
+            return None
+        output = '\n'.join(output_lines)
+        if result['trailing_newline']:
+            output += '\n'
+        if not silent:
+            output = '\n'.join(output.rstrip().splitlines())
+        # Hm, options on how to return this? I bet often we'll want
+        # output_lines[0] with no newline.
+        return output
+
+    def _iter_output_from_command(self, command, cwd=None, env=None,
+                                  silent=False, log_level=INFO,
+                                  halt_on_failure=False,
+                                  throw_exception=False, fatal_exit_code=2,
+                                  result=None):
+        """get_output_from_command() helper: a generator that runs command
+        and yields its stdout a line at a time, without line endings, as
+        the output arrives.  stdout is logged as it goes unless silent;
+        stderr is kept and logged once the command is done.
+
+        result, if given, gets 'trailing_newline' set to whether stdout
+        ended with a newline.
+
+        If the generator isn't run to the end, the command is killed.
+        """
+        if result is None:
+            result = {}
+        shell = True
+        if isinstance(command, list):
+            shell = False
+        p = subprocess.Popen(command, shell=shell, stdout=subprocess.PIPE,
+                             cwd=cwd, stderr=subprocess.PIPE, env=env)
+        stdout_chunks = []
+        stderr_chunks = []
+        pump = None
+        if self._is_windows():
+            # select() doesn't work on pipes on Windows; communicate()
+            # drains both with threads instead.
+            stdout, stderr = p.communicate()
+            stdout_chunks.append(stdout)
+            stderr_chunks.append(stderr)
+        else:
+            pump = OutputPump()
+            pump.add_stream(p.stdout, stdout_chunks.append, split_lines=False)
+            pump.add_stream(p.stderr, stderr_chunks.append, split_lines=False)
+        partial = ''
+        header_logged = False
+        try:
+            while True:
+                if stdout_chunks:
+                    lines = (partial + ''.join(stdout_chunks)).split('\n')
+                    del stdout_chunks[:]
+                    partial = lines.pop()
+                    for line in lines:
+                        if not silent:
+                            if not header_logged:
+                                self.log("Output received:", level=log_level)
+                                header_logged = True
+                            if line and not line.isspace():
+                                self.log(' %s' % line.rstrip().decode("utf-8"),
+                                         level=log_level)
+                        yield line
+                if pump is None or not pump.streams:
+                    break
+                pump.pump()
+            if partial:
+                if not silent:
+                    if not header_logged:
+                        self.log("Output received:", level=log_level)
+                    if not partial.isspace():
+                        self.log(' %s' % partial.rstrip().decode("utf-8"),
+                                 level=log_level)
+                yield partial
+            p.wait()
+        finally:
+            if p.returncode is None:
+                self.info("Killing unfinished command %s" % command)
+                try:
+                    p.kill()
+                except OSError:
+                    pass
+                p.wait()
+            p.stdout.close()
+            p.stderr.close()
+        result['trailing_newline'] = not partial
+        self._check_output_from_command(
+            command, p.returncode, ''.join(stderr_chunks),
+            halt_on_failure=halt_on_failure, throw_exception=throw_exception,
+            fatal_exit_code=fatal_exit_code,
+        )
+
+    def _check_output_from_command(self, command, returncode, errors,
+                                   halt_on_failure=False,
+                                   throw_exception=False, fatal_exit_code=2):
+        """get_output_from_command() helper: log stderr and the return
+        code, and raise or halt as requested.
+        """
+        return_level = DEBUG
+        if errors:
+            return_level = ERROR
+            self.error("Errors received:")
+            for line in errors.rstrip().splitlines():
+                if not line or line.isspace():
+                    continue
+                line = line.decode("utf-8")
+                self.error(' %s' % line)
+        elif returncode:
+            return_level = ERROR
+        if returncode and throw_exception:
+            raise subprocess.CalledProcessError(returncode, command)
+        self.log("Return code: %d" % returncode, level=return_level)
+        if halt_on_failure and return_level == ERROR:
+            self.return_code = fatal_exit_code
+            self.fatal("Halting on failure while running %s" % command,
+                       exit_code=fatal_exit_code)
+
+    def _get_output_from_command_via_tmpfiles(self, command, cwd=None,
+                                              env=None, silent=False,
+                                              log_level=INFO,
+                                              halt_on_failure=False,
+                                              tmpfile_base_path='tmpfile',
+                                              return_type='output',
+                                              save_tmpfiles=False,
+                                              throw_exception=False,
+                                              fatal_exit_code=2):
+        """get_output_from_command() helper for when the caller wants
+        stdout and stderr saved to files.
+        """
         # This could potentially return something?
         tmp_stdout = None
         tmp_stderr = None
@@ -794,7 +1393,6 @@ class ScriptMixin(object):
         p.wait()
         tmp_stdout.close()
         tmp_stderr.close()
-        return_level = DEBUG
         output = None
         if os.path.exists(tmp_stdout_filename) and os.path.getsize(tmp_stdout_filename):
             output = self.read_from_file(tmp_stdout_filename,
@@ -808,31 +1406,18 @@ class ScriptMixin(object):
                     line = line.decode("utf-8")
                     self.log(' %s' % line, level=log_level)
                 output = '\n'.join(output_lines)
+        errors = None
         if os.path.exists(tmp_stderr_filename) and os.path.getsize(tmp_stderr_filename):
-            return_level = ERROR
-            self.error("Errors received:")
             errors = self.read_from_file(tmp_stderr_filename,
                                          verbose=False)
-            for line in errors.rstrip().splitlines():
-                if not line or line.isspace():
-                    continue
-                line = line.decode("utf-8")
-                self.error(' %s' % line)
-        elif p.returncode:
-            return_level = ERROR
         # Clean up.
         if not save_tmpfiles:
             self.rmtree(tmp_stderr_filename, log_level=DEBUG)
             self.rmtree(tmp_stdout_filename, log_level=DEBUG)
-        if p.returncode and throw_exception:
-            raise subprocess.CalledProcessError(p.returncode, command)
-        self.log("Return code: %d" % p.returncode, level=return_level)
-        if halt_on_failure and return_level == ERROR:
-            self.return_code = fatal_exit_code
-            self.fatal("Halting on failure while running %s" % command,
-                       exit_code=fatal_exit_code)
-        # Hm, options on how to return this? I bet often we'll want
-        # output_lines[0] with no newline.
+        self._check_output_from_command(
+            command, p.returncode, errors, halt_on_failure=halt_on_failure,
+            throw_exception=throw_exception, fatal_exit_code=fatal_exit_code,
+        )
         if return_type != 'output':
             return (tmp_stdout_filename, tmp_stderr_filename)
         else:
@@ -853,22 +1438,440 @@ class ScriptMixin(object):
 
         os.utime(file_name, times)
 
-    def unpack(self, filename, extract_to):
+    def _query_extract_path(self, name, extract_to):
+        """Return where archive member name goes under extract_to, or None
+        if it would end up outside of it.
+        """
+        path = os.path.normpath(os.path.join(extract_to, name))
+        if os.path.isabs(name) or \
+                not path.startswith(os.path.join(os.path.normpath(extract_to), '')):
+            self.warning("Not extracting %s; it's outside of %s." % (name, extract_to))
+            return None
+        return path
+
+    def _zip_member_is_current(self, info, path):
+        """Is path already the same size and CRC as zip member info?"""
+        try:
+            if os.path.islink(path) or os.path.getsize(path) != info.file_size:
+                return False
+            crc = 0
+            fh = open(path, 'rb')
+            try:
+                while True:
+                    block = fh.read(1024 ** 2)
+                    if not block:
+                        break
+                    crc = zlib.crc32(block, crc)
+            finally:
+                fh.close()
+        except (IOError, OSError):
+            return False
+        return crc & 0xffffffff == info.CRC
+
+    def _extract_zip_member(self, bundle, info, path):
+        """Stream zip member info from bundle to path, with its permissions.
+        """
+        mode = info.external_attr >> 16
+        if stat.S_ISLNK(mode):
+            if os.path.lexists(path):
+                os.remove(path)
+            os.symlink(bundle.read(info), path)
+            return
+        if os.path.islink(path):
+            os.remove(path)
+        src = bundle.open(info)
+        try:
+            dest = open(path, 'wb')
+            try:
+                shutil.copyfileobj(src, dest, 1024 ** 2)
+            finally:
+                dest.close()
+        finally:
+            src.close()
+        if mode & 0777:
+            os.chmod(path, mode & 0777)
+
+    def extract_zip(self, filename, extract_to, members=None, error_level=ERROR):
+        """Extract filename into extract_to, without shelling out to unzip.
+
+        members is a list of unzip-style glob patterns (e.g. 'bin/*') to
+        extract; by default everything is.  Members are spread across
+        self.config.get('extract_workers', 4) threads, each with its own
+        handle on the zip, and streamed to disk.  Files that are already
+        there with the right size and CRC are left alone, so extracting
+        over an earlier extraction is cheap.
+
+        Returns 0 on success, 11 (like unzip) if members didn't match
+        anything, and -1 on failure.
+        """
+        return self._extract_zip(filename, extract_to, members=members,
+                                 error_level=error_level)
+
+    def _extract_zip(self, filename, extract_to, members=None, error_level=ERROR,
+                     wait_for_bytes=None):
+        """Helper method for extract_zip().
+
+        If filename is still being downloaded, wait_for_bytes(n) has to
+        block until its first n bytes are there, or return False if they
+        never will be, in which case we give up and return None.  Members
+        are then extracted in the order they're stored in.
+        """
+        self.info("Extracting %s to %s" % (filename, extract_to))
+        try:
+            bundle = zipfile.ZipFile(filename)
+            infos = bundle.infolist()
+            bundle.close()
+        except (IOError, zipfile.BadZipfile), e:
+            self.log("Can't read %s: %s" % (filename, str(e)), level=error_level)
+            return -1
+        # Each member's data ends where the next one (or the central
+        # directory) starts.
+        offsets = sorted(i.header_offset for i in infos) + [bundle.start_dir]
+        data_end = dict(zip(offsets, offsets[1:]))
+        if members:
+            infos = [i for i in infos if
+                     any(fnmatch.fnmatchcase(i.filename, m) for m in members)]
+            if not infos:
+                self.info("Nothing in %s matches %s." % (filename, ' '.join(members)))
+                return 11
+        files = []
+        for info in infos:
+            path = self._query_extract_path(info.filename, extract_to)
+            if path is None:
+                continue
+            if info.filename.endswith('/'):
+                dirname = path
+            else:
+                dirname = os.path.dirname(path)
+                files.append((info, path))
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+        if wait_for_bytes:
+            files.sort(key=lambda f: f[0].header_offset)
+        else:
+            # Biggest first, so one huge member doesn't end up last.
+            files.sort(key=lambda f: f[0].file_size, reverse=True)
+        queue = Queue.Queue()
+        for f in files:
+            queue.put(f)
+        errors = []
+        skipped = []
+        gave_up = []
+
+        def extract_members():
+            try:
+                bundle = zipfile.ZipFile(filename)
+            except Exception, e:
+                errors.append("%s: %s" % (filename, str(e)))
+                return
+            try:
+                while True:
+                    try:
+                        info, path = queue.get_nowait()
+                    except Queue.Empty:
+                        return
+                    try:
+                        if self._zip_member_is_current(info, path):
+                            skipped.append(info.filename)
+                            continue
+                        if wait_for_bytes and \
+                                not wait_for_bytes(data_end[info.header_offset]):
+                            gave_up.append(info.filename)
+                            return
+                        self._extract_zip_member(bundle, info, path)
+                    except Exception, e:
+                        errors.append("%s: %s" % (info.filename, str(e)))
+            finally:
+                bundle.close()
+
+        threads = []
+        for _ in range(max(1, min(self.config.get('extract_workers', 4), len(files)))):
+            thread = threading.Thread(target=extract_members)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if gave_up:
+            return None
+        if errors:
+            self.log("Errors extracting %s:\n%s" % (filename, '\n'.join(errors)),
+                     level=error_level)
+            return -1
+        self.info("Extracted %d files (%d already up to date)." %
+                  (len(files) - len(skipped), len(skipped)))
+        return 0
+
+    def extract_tar(self, filename, extract_to, members=None, error_level=ERROR):
+        """Extract filename (optionally gzip/bzip2 compressed) into
+        extract_to, without shelling out to tar.
+
+        The tarball is read as a stream, so memory use doesn't depend on
+        its size.  members and the return value are as in extract_zip();
+        files already there with the right size and mtime are skipped.
+        """
+        self.info("Extracting %s to %s" % (filename, extract_to))
+        try:
+            fileobj = open(filename, 'rb')
+        except IOError, e:
+            self.log("Can't read %s: %s" % (filename, str(e)), level=error_level)
+            return -1
+        try:
+            return self._extract_tar_stream(fileobj, extract_to, members=members,
+                                            error_level=error_level)
+        finally:
+            fileobj.close()
+
+    def _extract_tar_stream(self, fileobj, extract_to, members=None, error_level=ERROR):
+        """Helper method for extract_tar(); fileobj only needs read()."""
+        extracted = skipped = 0
+        try:
+            tar = tarfile.open(fileobj=fileobj, mode='r|*')
+            try:
+                for member in tar:
+                    if members and not any(fnmatch.fnmatchcase(member.name, m)
+                                           for m in members):
+                        continue
+                    path = self._query_extract_path(member.name, extract_to)
+                    if path is None:
+                        continue
+                    if member.isfile() and os.path.isfile(path) and \
+                            not os.path.islink(path) and \
+                            os.path.getsize(path) == member.size and \
+                            int(os.path.getmtime(path)) == member.mtime:
+                        skipped += 1
+                        continue
+                    if (member.isfile() or member.issym()) and os.path.lexists(path):
+                        os.remove(path)
+                    tar.extract(member, extract_to)
+                    extracted += 1
+            finally:
+                tar.close()
+        except (IOError, OSError, tarfile.TarError), e:
+            self.log("Can't extract to %s: %s" % (extract_to, str(e)),
+                     level=error_level)
+            return -1
+        if members and not extracted + skipped:
+            self.info("Nothing matches %s." % ' '.join(members))
+            return 11
+        self.info("Extracted %d members (%d already up to date)." % (extracted, skipped))
+        return 0
+
+    def _download_and_extract_tar(self, url, file_name, extract_to, members=None):
+        """Helper method for download_and_unpack(); decompress and extract
+        the tarball while it's being downloaded.
+        """
+        f = urllib2.urlopen(url, timeout=30)
+        try:
+            local_file = open(file_name, 'wb')
+            try:
+                reader = TeeReader(f, local_file)
+                # Problems here only mean we fall back to extracting the
+                # old way, which reports them properly.
+                status = self._extract_tar_stream(reader, extract_to, members=members,
+                                                  error_level=WARNING)
+                if reader.error or status == -1:
+                    return None
+                # Whatever comes after the end-of-archive marker.
+                reader.drain()
+            finally:
+                local_file.close()
+        finally:
+            f.close()
+        length = f.info().get('content-length')
+        if length is not None and os.path.getsize(file_name) != int(length):
+            self.warning("Download incomplete; content-length was %s, but only received %d" %
+                         (length, os.path.getsize(file_name)))
+            return None
+        return status
+
+    def _download_and_extract_zip(self, url, file_name, extract_to, members=None):
+        """Helper method for download_and_unpack().
+
+        Fetch the central directory at the end of the zip with a Range
+        request, then download the rest from the start while extracting
+        each member as soon as all of its bytes are there.
+        """
+        request = urllib2.Request(url, headers={'Range': 'bytes=-%d' % (64 * 1024 + 22)})
+        f = urllib2.urlopen(request, timeout=30)
+        try:
+            m = re.match(r'bytes (\d+)-(\d+)/(\d+)$', f.info().get('content-range', ''))
+            if f.getcode() != 206 or not m:
+                self.info("%s doesn't support Range requests." % url)
+                return None
+            tail = f.read()
+        finally:
+            f.close()
+        tail_start, length = int(m.group(1)), int(m.group(3))
+        eocd = tail.rfind('PK\x05\x06')
+        if eocd < 0 or len(tail) < eocd + 22:
+            self.info("Can't find the central directory of %s." % url)
+            return None
+        cd_offset = struct.unpack('<I', tail[eocd + 16:eocd + 20])[0]
+        if cd_offset == 0xffffffff:
+            self.info("%s is a zip64 file." % url)
+            return None
+        if cd_offset < tail_start:
+            request = urllib2.Request(url, headers={
+                'Range': 'bytes=%d-%d' % (cd_offset, tail_start - 1)})
+            f = urllib2.urlopen(request, timeout=30)
+            try:
+                tail = f.read() + tail
+            finally:
+                f.close()
+            tail_start = cd_offset
+        local_file = open(file_name, 'wb')
+        local_file.truncate(length)
+        local_file.seek(tail_start)
+        local_file.write(tail)
+        local_file.close()
+
+        progress = {'bytes': 0, 'done': False, 'error': None}
+        condition = threading.Condition()
+
+        def download():
+            try:
+                f = urllib2.urlopen(url, timeout=30)
+                local_file = open(file_name, 'r+b')
+                try:
+                    while True:
+                        block = f.read(1024 ** 2)
+                        if not block:
+                            break
+                        local_file.write(block)
+                        local_file.flush()
+                        with condition:
+                            progress['bytes'] += len(block)
+                            condition.notify_all()
+                finally:
+                    local_file.close()
+                    f.close()
+                if progress['bytes'] != length:
+                    raise urllib2.URLError("Download incomplete; content-length was %d, but only received %d" %
+                                           (length, progress['bytes']))
+            except Exception, e:
+                progress['error'] = e
+            with condition:
+                progress['done'] = True
+                condition.notify_all()
+
+        def wait_for_bytes(n):
+            with condition:
+                while progress['bytes'] < n and not progress['done']:
+                    condition.wait(1)
+                return progress['bytes'] >= n
+
+        thread = threading.Thread(target=download)
+        thread.daemon = True
+        thread.start()
+        status = self._extract_zip(file_name, extract_to, members=members,
+                                   error_level=WARNING,
+                                   wait_for_bytes=wait_for_bytes)
+        thread.join()
+        if progress['error'] is not None:
+            self.warning("Error downloading %s: %s" % (url, str(progress['error'])))
+            return None
+        if status == -1:
+            return None
+        return status
+
+    def _add_to_download_cache(self, url, file_name, headers):
+        """ Put a copy of file_name, which we downloaded from url, in the
+            download cache.
+            """
+        cache = self.query_download_cache()
+        try:
+            tmp_file = cache.mkstemp()
+            shutil.copyfile(file_name, tmp_file)
+            sha512 = cache.add(url, tmp_file, headers)
+        except (IOError, OSError), e:
+            self.warning("Can't add %s to the download cache: %s" % (url, str(e)))
+            return
+        for path in cache.evict(keep=sha512):
+            self.info("Evicted %s from the download cache." % path)
+
+    def download_and_unpack(self, url, file_name, extract_to, members=None,
+                            error_level=ERROR):
+        """Download url to file_name, extracting it into extract_to as the
+        bytes come in, so this takes about as long as the slower of the two
+        instead of both added up.
+
+        Tarballs are decompressed straight off the network.  For zips, the
+        server has to support Range requests.  If it doesn't, or if anything
+        goes wrong with the network along the way, we fall back to
+        download_file() (with its retries) and then unpack.  members and the
+        return value are as in extract_zip().
+
+        With a download cache, a url the cache has a current copy of is
+        taken from there by download_file() instead, and what we download
+        is added to the cache.
+        """
+        if re.search(r'\.(tar(\.(bz2|gz))?|tgz|tbz2)$', file_name):
+            pipeline, extract = self._download_and_extract_tar, self.extract_tar
+        elif re.search(r'\.(zip|apk|jar)$', file_name):
+            pipeline, extract = self._download_and_extract_zip, self.extract_zip
+        else:
+            self.log("Don't know how to unpack %s!" % file_name, level=error_level)
+            return -1
+        self.mkdir_p(os.path.dirname(os.path.abspath(file_name)))
+        self.mkdir_p(extract_to)
+        cache = self.query_download_cache()
+        headers = None
+        cached_sha512 = None
+        status = None
+        if cache:
+            try:
+                headers = self._query_url_headers(url)
+            except (urllib2.URLError, socket.timeout, socket.error), e:
+                self.info("Can't check %s against the download cache: %s" % (url, str(e)))
+            if headers is not None:
+                cached_sha512 = cache.query_cached_sha512(url, headers)
+            if cached_sha512:
+                self.info("%s is in the download cache." % url)
+                pipeline = None
+        if pipeline:
+            self.info("Downloading %s to %s and extracting it to %s" % (url, file_name, extract_to))
+            try:
+                status = pipeline(url, file_name, extract_to, members=members)
+            except (urllib2.URLError, socket.timeout, socket.error, IOError), e:
+                self.warning("Error downloading %s: %s" % (url, str(e)))
+                status = None
+            if status is not None and headers and \
+                    (headers.get('etag') or headers.get('last-modified')):
+                self._add_to_download_cache(url, file_name, headers)
+        if status is None:
+            if pipeline:
+                self.info("Downloading %s before extracting it instead." % url)
+            if self.download_file(url, file_name=file_name, sha512=cached_sha512,
+                                  error_level=error_level) != file_name:
+                return -1
+            status = extract(file_name, extract_to, members=members,
+                             error_level=error_level)
+        return status
+
+    def unpack(self, filename, extract_to, members=None,
+               error_level=FATAL, fatal_exit_code=2):
         '''
         This method allows us to extract a file regardless of its extension
+
+        Zips (also apk and jar) and tarballs are supported; see
+        extract_zip() for members.  Returns 0 on success.
         '''
-        # XXX: Make sure that filename has a extension of one of our supported file formats
-        m = re.search('\.tar\.(bz2|gz)$', filename)
-        if m:
-            command = self.query_exe('tar', return_type='list')
-            tar_cmd = "jxfv"
-            if m.group(1) == "gz":
-                tar_cmd = "zxfv"
-            command.extend([tar_cmd, filename, "-C", extract_to])
-            self.run_command(command, halt_on_failure=True)
+        if re.search(r'\.(tar(\.(bz2|gz))?|tgz|tbz2)$', filename):
+            extract = self.extract_tar
+        elif re.search(r'\.(zip|apk|jar)$', filename):
+            extract = self.extract_zip
         else:
-            # XXX implement
-            pass
+            self.log("Don't know how to unpack %s!" % filename,
+                     level=error_level, exit_code=fatal_exit_code)
+            return -1
+        self.mkdir_p(extract_to)
+        # extract_*() log the details; we decide whether that's fatal.
+        status = extract(filename, extract_to, members=members)
+        if status not in (0, 11):
+            self.log("Unable to unpack %s!" % filename, level=error_level,
+                     exit_code=fatal_exit_code)
+        return status
 
 
 def PreScriptRun(func):
@@ -999,6 +2002,7 @@ class BaseScript(ScriptMixin, LogMixin, object):
         self.config = rw_config.get_read_only_config()
         self.actions = tuple(rw_config.actions)
         self.all_actions = tuple(rw_config.all_actions)
+        self.action_dependencies = dict(getattr(rw_config, 'action_dependencies', {}))
         self.env = None
         self.new_log_obj(default_log_level=default_log_level)
 
@@ -1177,6 +2181,74 @@ class BaseScript(ScriptMixin, LogMixin, object):
             if not post_success:
                 self.fatal("Aborting due to failure in post-action listener.")
 
+    def query_action_dependencies(self, action):
+        """Return the actions that have to be finished before action starts.
+
+        Actions that aren't in self.action_dependencies depend on every
+        action before them in all_actions, same as a sequential run.
+        """
+        if action in self.action_dependencies:
+            return self.action_dependencies[action]
+        return self.all_actions[:self.all_actions.index(action)]
+
+    def _run_actions_in_parallel(self, max_parallel_actions):
+        """Run self.all_actions, starting each action in its own thread as
+        soon as everything it depends on has finished.
+
+        The first exception (including the SystemExit from self.fatal())
+        stops us from starting any more actions; we wait for the running
+        ones to finish and then re-raise it here.
+        """
+        pending = list(self.all_actions)
+        done = set()
+        running = {}
+        results = Queue.Queue()
+        failure = None
+
+        def run_action_in_thread(action):
+            try:
+                self.run_action(action)
+                results.put((action, None))
+            except:
+                results.put((action, sys.exc_info()))
+
+        while pending or running:
+            if failure is None:
+                for action in pending[:]:
+                    if len(running) >= max_parallel_actions:
+                        break
+                    if not done.issuperset(self.query_action_dependencies(action)):
+                        continue
+                    pending.remove(action)
+                    if action not in self.actions:
+                        # Just logs the skip.
+                        self.run_action(action)
+                        done.add(action)
+                        continue
+                    thread = threading.Thread(target=run_action_in_thread,
+                                              args=(action, ),
+                                              name="action-%s" % action)
+                    thread.daemon = True
+                    running[action] = thread
+                    thread.start()
+            if not running:
+                break
+            try:
+                # Block with a timeout so KeyboardInterrupt still gets through.
+                action, exc_info = results.get(True, 1)
+            except Queue.Empty:
+                continue
+            running.pop(action).join()
+            if exc_info is None:
+                done.add(action)
+            elif failure is None:
+                failure = exc_info
+                if pending:
+                    self.error("Not starting %s after %s failed." %
+                               (', '.join(pending), action))
+        if failure is not None:
+            raise failure[0], failure[1], failure[2]
+
     def run(self):
         """Default run method.
         This is the "do everything" method, based on actions and all_actions.
@@ -1191,6 +2263,12 @@ class BaseScript(ScriptMixin, LogMixin, object):
 
         Postflight is quick testing for success after an action.
 
+        If the script was created with action_dependencies, independent
+        actions run concurrently, up to self.config['max_parallel_actions']
+        (default 4) at a time; set that to 1 to run them one by one.
+        Actions that may run in parallel must not chdir() or otherwise
+        touch process-wide state that another action relies on.
+
         """
         for fn in self._listeners['pre_run']:
             try:
@@ -1212,9 +2290,13 @@ class BaseScript(ScriptMixin, LogMixin, object):
                 self.fatal("Aborting due to failure in pre-run listener.")
 
         self.dump_config()
+        max_parallel_actions = self.config.get('max_parallel_actions', 4)
         try:
-            for action in self.all_actions:
-                self.run_action(action)
+            if self.action_dependencies and max_parallel_actions > 1:
+                self._run_actions_in_parallel(max_parallel_actions)
+            else:
+                for action in self.all_actions:
+                    self.run_action(action)
         except Exception:
             self.fatal("Uncaught exception: %s" % traceback.format_exc())
         finally:
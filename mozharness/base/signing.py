@@ -9,9 +9,17 @@
 
 import getpass
 import hashlib
+import mmap
+from multiprocessing.pool import ThreadPool
 import os
 import re
 import subprocess
+import threading
+try:
+    import simplejson as json
+    assert json
+except ImportError:
+    import json
 
 from mozharness.base.errors import JarsignerErrorList, ZipErrorList, ZipalignErrorList
 from mozharness.base.log import OutputParser, IGNORE, DEBUG, INFO, ERROR, FATAL
@@ -31,24 +39,151 @@ TestJarsignerErrorList = [{
 }] + JarsignerErrorList
 
 
+def hash_file(file_path, algorithms=('sha512', ), chunk_size=4 * 1024 ** 2):
+    """Return {algorithm: hexdigest} for file_path, computing every digest
+    in one pass over an mmap of the file, so even multi-GB files don't end
+    up in memory.  hashlib lets go of the GIL while it works, so several
+    threads can hash at once.
+    """
+    hashes = [hashlib.new(a) for a in algorithms]
+    fh = open(file_path, 'rb')
+    try:
+        try:
+            data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError):
+            # Empty, or something we can't map; read it instead.
+            data = None
+        if data is not None:
+            try:
+                for offset in xrange(0, len(data), chunk_size):
+                    chunk = buffer(data, offset, chunk_size)
+                    for h in hashes:
+                        h.update(chunk)
+            finally:
+                data.close()
+        else:
+            while True:
+                chunk = fh.read(chunk_size)
+                if not chunk:
+                    break
+                for h in hashes:
+                    h.update(chunk)
+    finally:
+        fh.close()
+    return dict((a, h.hexdigest()) for a, h in zip(algorithms, hashes))
+
+
 # BaseSigningMixin {{{1
 class BaseSigningMixin(object):
     """Generic signing helper methods.
+
+    Digests are memoized per (path, size, mtime, inode), and also saved to
+    self.config['hash_cache_file'] if that's set, so the same file isn't
+    hashed again by later steps or scripts.
     """
+    _hash_cache = None
+    _hash_cache_lock = threading.Lock()
+
     def query_filesize(self, file_path):
         self.info("Determining filesize for %s" % file_path)
         length = os.path.getsize(file_path)
         self.info(" %s" % str(length))
         return length
 
-    # TODO this should be parallelized with the to-be-written BaseHelper!
+    def _query_hash_cache(self):
+        if self._hash_cache is None:
+            self._hash_cache = {}
+            cache_file = self.config.get('hash_cache_file')
+            if cache_file and os.path.exists(cache_file):
+                try:
+                    fh = open(cache_file)
+                    try:
+                        self._hash_cache = json.load(fh)
+                    finally:
+                        fh.close()
+                except (IOError, ValueError), e:
+                    self.warning("Ignoring unreadable hash cache %s: %s" % (cache_file, str(e)))
+        return self._hash_cache
+
+    def _save_hash_cache(self):
+        """Write the hash cache out, without the files that are gone.
+        Call with self._hash_cache_lock held.
+        """
+        cache_file = self.config.get('hash_cache_file')
+        if not cache_file:
+            return
+        for file_path in self._hash_cache.keys():
+            if not os.path.exists(file_path):
+                del self._hash_cache[file_path]
+        tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+        try:
+            fh = open(tmp_file, 'w')
+            try:
+                json.dump(self._hash_cache, fh)
+            finally:
+                fh.close()
+            os.rename(tmp_file, cache_file)
+        except (IOError, OSError), e:
+            self.warning("Can't write hash cache %s: %s" % (cache_file, str(e)))
+
+    def _query_file_digests(self, file_path, algorithms):
+        """Helper method for query_file(s)_digests(): returns the digests,
+        and whether we had to hash the file, and so the hash cache needs
+        saving.
+        """
+        file_path = os.path.abspath(file_path)
+        st = os.stat(file_path)
+        stamp = [st.st_size, st.st_mtime, st.st_ino]
+        with self._hash_cache_lock:
+            entry = self._query_hash_cache().get(file_path)
+            if not entry or entry['stamp'] != stamp:
+                entry = {'stamp': stamp, 'digests': {}}
+            missing = [a for a in algorithms if a not in entry['digests']]
+        if missing:
+            self.debug("Hashing %s (%s)" % (file_path, ', '.join(missing)))
+            digests = hash_file(file_path, missing)
+            with self._hash_cache_lock:
+                entry['digests'].update(digests)
+                self._hash_cache[file_path] = entry
+        return dict((a, entry['digests'][a]) for a in algorithms), bool(missing)
+
+    def query_file_digests(self, file_path, algorithms=('sha512', )):
+        """Return {algorithm: hexdigest} for file_path, hashing it (once,
+        for all the algorithms we don't have yet) only if it changed since
+        the last time.
+        """
+        digests, hashed = self._query_file_digests(file_path, algorithms)
+        if hashed:
+            with self._hash_cache_lock:
+                self._save_hash_cache()
+        return digests
+
+    def query_files_digests(self, file_paths, algorithms=('sha512', ),
+                            num_threads=None):
+        """query_file_digests() for many files at once, in
+        num_threads (default self.config.get('hash_threads', 4)) threads.
+        The hash cache is saved once, at the end.
+
+        Returns {file_path: {algorithm: hexdigest}}.
+        """
+        if num_threads is None:
+            num_threads = self.config.get('hash_threads', 4)
+        file_paths = list(file_paths)
+        pool = ThreadPool(max(1, min(num_threads, len(file_paths))))
+        try:
+            results = pool.map(lambda f: self._query_file_digests(f, algorithms),
+                               file_paths)
+        finally:
+            pool.close()
+            pool.join()
+        if [hashed for _, hashed in results if hashed]:
+            with self._hash_cache_lock:
+                self._save_hash_cache()
+        return dict(zip(file_paths, [digests for digests, _ in results]))
+
     def query_sha512sum(self, file_path):
         self.info("Determining sha512sum for %s" % file_path)
-        m = hashlib.sha512()
-        contents = self.read_from_file(file_path, verbose=False,
-                                       open_mode='rb')
-        m.update(contents)
-        sha512 = m.hexdigest()
+        sha512 = self.query_file_digests(file_path)['sha512']
         self.info(" %s" % sha512)
         return sha512
 
@@ -7,8 +7,12 @@
 """Generic ways to upload + download files.
 """
 
+import errno
+import hashlib
 import os
 import pprint
+import tempfile
+import time
 import urllib2
 try:
     import simplejson as json
@@ -20,6 +24,196 @@ from mozharness.base.errors import SSHErrorList
 from mozharness.base.log import DEBUG, ERROR
 
 
+def sha512_of_file(path, block_size=1024 ** 2):
+    h = hashlib.sha512()
+    fh = open(path, 'rb')
+    try:
+        while True:
+            block = fh.read(block_size)
+            if not block:
+                break
+            h.update(block)
+    finally:
+        fh.close()
+    return h.hexdigest()
+
+
+# DownloadCache {{{1
+class DownloadCache(object):
+    """On-disk cache of downloaded files, meant to be shared by every job
+    on a machine.
+
+    Files are stored once, under objects/, named after the sha512 of their
+    contents.  urls/ maps each url to the ETag, Last-Modified and
+    Content-Length the server sent along with it, and the sha512 of what we
+    got.  The mtime of an object is its last use; evict() removes the least
+    recently used objects until we're under max_size bytes.
+
+    Everything lands in its final place via rename(), so several jobs
+    can use the same cache at once.
+    """
+    VALIDATORS = ('etag', 'last-modified', 'content-length')
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        self.objects_dir = os.path.join(self.cache_dir, 'objects')
+        self.urls_dir = os.path.join(self.cache_dir, 'urls')
+        self.tmp_dir = os.path.join(self.cache_dir, 'tmp')
+        for d in (self.objects_dir, self.urls_dir, self.tmp_dir):
+            try:
+                os.makedirs(d)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def _url_info_path(self, url):
+        return os.path.join(self.urls_dir,
+                            hashlib.sha1(url).hexdigest() + '.json')
+
+    def query_object_path(self, sha512):
+        """Return the path of the cached object, or None if we don't have it.
+        """
+        path = os.path.join(self.objects_dir, sha512)
+        if os.path.exists(path):
+            return path
+
+    def query_url_info(self, url):
+        try:
+            fh = open(self._url_info_path(url))
+            try:
+                info = json.load(fh)
+            finally:
+                fh.close()
+        except (IOError, ValueError):
+            return None
+        if info.get('url') == url:
+            return info
+
+    def query_cached_sha512(self, url, headers, sha512=None):
+        """Return the sha512 of our copy of url if it's still what the
+        server would send, going by headers (a dict of lowercased
+        VALIDATORS from a HEAD request).
+
+        We need a matching ETag or Last-Modified to trust it; a mismatch in
+        any header we have on both sides means it changed.
+        """
+        info = self.query_url_info(url)
+        if not info or not self.query_object_path(info['sha512']):
+            return None
+        if sha512 and info['sha512'] != sha512:
+            return None
+        validated = False
+        for header in self.VALIDATORS:
+            if headers.get(header) is None or info['headers'].get(header) is None:
+                continue
+            if headers[header] != info['headers'][header]:
+                return None
+            if header != 'content-length':
+                validated = True
+        if validated:
+            return info['sha512']
+
+    def mkstemp(self):
+        """Return the path to a new empty file inside the cache, to
+        download into and then add().
+        """
+        fd, path = tempfile.mkstemp(dir=self.tmp_dir)
+        os.close(fd)
+        return path
+
+    def add(self, url, path, headers):
+        """Move the file at path (from mkstemp()) into the cache as the
+        contents of url, and return its sha512.
+        """
+        sha512 = sha512_of_file(path)
+        object_path = os.path.join(self.objects_dir, sha512)
+        if os.path.exists(object_path):
+            os.remove(path)
+        else:
+            os.chmod(path, 0444)
+            os.rename(path, object_path)
+        self.touch(sha512)
+        info_path = self.mkstemp()
+        fh = open(info_path, 'w')
+        try:
+            json.dump({'url': url, 'sha512': sha512,
+                       'headers': dict((h, headers.get(h)) for h in self.VALIDATORS),
+                       'time': time.time()}, fh)
+        finally:
+            fh.close()
+        os.rename(info_path, self._url_info_path(url))
+        return sha512
+
+    def touch(self, sha512):
+        os.utime(os.path.join(self.objects_dir, sha512), None)
+
+    def copy(self, sha512, dest, block_size=1024 ** 2):
+        """Copy the cached object to dest.  Returns False, and drops the
+        object from the cache, if it doesn't match its sha512 any more.
+
+        We copy rather than hardlink so nothing done to dest can change
+        the cached object.
+        """
+        object_path = os.path.join(self.objects_dir, sha512)
+        if os.path.lexists(dest):
+            os.remove(dest)
+        h = hashlib.sha512()
+        src = open(object_path, 'rb')
+        try:
+            out = open(dest, 'wb')
+            try:
+                while True:
+                    block = src.read(block_size)
+                    if not block:
+                        break
+                    h.update(block)
+                    out.write(block)
+            finally:
+                out.close()
+        finally:
+            src.close()
+        if h.hexdigest() != sha512:
+            os.remove(dest)
+            os.remove(object_path)
+            return False
+        self.touch(sha512)
+        return True
+
+    def evict(self, keep=None):
+        """Remove the least recently used objects until the cache is under
+        max_size.  Returns the list of removed paths.
+        """
+        removed = []
+        if not self.max_size:
+            return removed
+        objects = []
+        total = 0
+        for name in os.listdir(self.objects_dir):
+            path = os.path.join(self.objects_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            objects.append((st.st_mtime, st.st_size, name, path))
+            total += st.st_size
+        objects.sort()
+        for _, size, name, path in objects:
+            if total <= self.max_size:
+                break
+            if name == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed.append(path)
+        # Nothing to do for urls/; query_url_info() entries whose object is
+        # gone are simply misses.
+        return removed
+
+
 # TransferMixin {{{1
 class TransferMixin(object):
     """
@@ -10,20 +10,37 @@ Largely copied/ported from
 https://hg.mozilla.org/build/tools/file/cf265ea8fb5e/lib/python/util/hg.py .
 """
 
+from distutils.spawn import find_executable
 import os
 import re
+import socket
 import subprocess
+import threading
+import time
+import urllib2
 from urlparse import urlsplit
+try:
+    import simplejson as json
+    assert json
+except ImportError:
+    import json
 
 import sys
 sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.dirname(sys.path[0]))))
 
 from mozharness.base.errors import HgErrorList, VCSException
-from mozharness.base.log import LogMixin
+from mozharness.base.log import LogMixin, WARNING
 from mozharness.base.script import ScriptMixin
 
 HG_OPTIONS = ['--config', 'ui.merge=internal:merge']
 
+# What we know about hg and the repos in a share base, so later jobs can
+# skip work; see MercurialVCS._query_share_state().
+SHARE_STATE_FILE = '.mozharness_share_state.json'
+_share_state_lock = threading.Lock()
+# hg stamp -> can_share, for this process.
+_can_share_cache = {}
+
 # MercurialVCS {{{1
 # TODO Make the remaining functions more mozharness-friendly.
 # TODO Add the various tag functionality that are currently in
@@ -72,6 +89,7 @@ class MercurialVCS(ScriptMixin, LogMixin, object):
         #  repo: repository,
         #  branch: branch,
         #  revision: revision,
+        #  bundle: bundle,
         #  ssh_username: ssh_username,
         #  ssh_key: ssh_key,
         # }
@@ -167,6 +185,10 @@ class MercurialVCS(ScriptMixin, LogMixin, object):
         If `revision` is set, only the specified revision and its ancestors
         will be cloned.  If revision is set, branch is ignored.
 
+        If there are bundles for `repo` (see query_bundles()), `dest` is
+        bootstrapped from the first one that works and only the rest is
+        pulled from `repo`; otherwise it's a plain hg clone.
+
         If `update_dest` is set, then `dest` will be updated to `revision`
         if set, otherwise to `branch`, otherwise to the head of default.
         """
@@ -183,6 +205,21 @@ class MercurialVCS(ScriptMixin, LogMixin, object):
             self.info("Removing %s before clone." % dest)
             self.rmtree(dest)
 
+        for bundle in self.query_bundles(repo):
+            try:
+                self._clone_from_bundle(bundle, repo, dest, branch=branch,
+                                        revision=revision)
+            except VCSException:
+                self.warning("Unable to bootstrap %s from %s; falling back." %
+                             (dest, bundle))
+                self.exception(level='debug')
+                if os.path.exists(dest):
+                    self.rmtree(dest)
+                continue
+            if update_dest:
+                return self.update(dest, branch, revision)
+            return
+
         cmd = self.hg + ['clone']
         if not update_dest:
             cmd.append('-U')
@@ -205,6 +242,63 @@ class MercurialVCS(ScriptMixin, LogMixin, object):
         if update_dest:
             return self.update(dest, branch, revision)
 
+    def query_bundles(self, repo):
+        """Returns the bundles to try bootstrapping a clone of `repo` from,
+        in order.
+
+        That's self.vcs_config['bundle'] (a local path or a url) when
+        cloning the configured repo, then <base>/<repo name>.hg for each
+        base in self.config['hg_base_bundle_urls'] (or
+        'vcs_base_bundle_urls', like hgtool) when repo is remote.
+        """
+        bundles = []
+        if self.vcs_config.get('bundle') and repo == self.vcs_config.get('repo'):
+            bundles.append(self.vcs_config['bundle'])
+        if "://" in repo and not repo.startswith("file://"):
+            for base in self.config.get('hg_base_bundle_urls',
+                                        self.config.get('vcs_base_bundle_urls', [])):
+                bundles.append("%s/%s.hg" % (base.rstrip('/'), self.get_repo_name(repo)))
+        return bundles
+
+    def _clone_from_bundle(self, bundle, repo, dest, branch=None, revision=None):
+        """Creates `dest` from `bundle`, then pulls whatever the bundle is
+        missing (only up to `revision`, if set) from `repo`.
+
+        Urls are fetched with download_file(), so they go through the
+        download cache if there is one.  Raises VCSException on failure.
+        """
+        self.info("Bootstrapping %s from bundle %s." % (dest, bundle))
+        bundle_file = bundle
+        if "://" in bundle:
+            # Don't let download_file() retry a bundle that isn't there.
+            try:
+                self._query_url_headers(bundle)
+            except (urllib2.URLError, socket.error, socket.timeout), e:
+                raise VCSException("Can't get %s: %s" % (bundle, str(e)))
+            bundle_file = "%s.bundle" % dest.rstrip(os.sep)
+            if self.download_file(bundle, file_name=bundle_file,
+                                  error_level=WARNING) != bundle_file:
+                raise VCSException("Unable to download %s!" % bundle)
+        elif not os.path.exists(bundle):
+            raise VCSException("No bundle at %s!" % bundle)
+        try:
+            self.mkdir_p(dest)
+            if self.run_command(self.hg + ['init', dest], error_list=HgErrorList):
+                raise VCSException("Unable to create %s!" % dest)
+            output_timeout = self.config.get("vcs_output_timeout",
+                                             self.vcs_config.get("output_timeout"))
+            if self.run_command(self.hg + ['unbundle', os.path.abspath(bundle_file)],
+                                cwd=dest, error_list=HgErrorList,
+                                output_timeout=output_timeout):
+                raise VCSException("Unable to unbundle %s in %s!" % (bundle, dest))
+        finally:
+            if bundle_file != bundle and os.path.exists(bundle_file):
+                self.rmtree(bundle_file)
+        hgrc = open(os.path.join(dest, '.hg', 'hgrc'), 'w')
+        hgrc.write("[paths]\ndefault = %s\n" % self._make_absolute(repo))
+        hgrc.close()
+        self.pull(repo, dest, update_dest=False, branch=branch, revision=revision)
+
     def common_args(self, revision=None, branch=None, ssh_username=None,
                     ssh_key=None):
         """Fill in common hg arguments, encapsulating logic checks that
@@ -304,9 +398,126 @@ class MercurialVCS(ScriptMixin, LogMixin, object):
         return status
 
     # hg share methods {{{2
-    def query_can_share(self):
+    def _query_hg_stamp(self):
+        """Return something that changes whenever the hg we run, or its
+        configuration, might have: the hg executable's path, size and mtime,
+        and those of the hgrc files.  None if we can't find hg.
+        """
+        hg = self.hg[0]
+        if not os.path.isabs(hg):
+            hg = find_executable(hg)
+        if not hg or not os.path.exists(hg):
+            return None
+        st = os.stat(hg)
+        stamp = [hg, st.st_size, st.st_mtime]
+        if 'HGRCPATH' in os.environ:
+            rc_files = [f for f in os.environ['HGRCPATH'].split(os.pathsep) if f]
+        else:
+            rc_files = [os.path.expanduser('~/.hgrc')]
+        for rc_file in rc_files:
+            mtime = None
+            if os.path.exists(rc_file):
+                mtime = os.path.getmtime(rc_file)
+            stamp.append([rc_file, mtime])
+        return stamp
+
+    def _query_share_state(self, share_base):
+        """Return the contents of SHARE_STATE_FILE in share_base:
+
+          {'hg': {'stamp': _query_hg_stamp(), 'version': [...],
+                  'can_share': bool},
+           'repos': {repo: {'heads': [...], 'pulled': timestamp}}}
+        """
+        state = {}
+        state_file = os.path.join(share_base, SHARE_STATE_FILE)
+        if os.path.exists(state_file):
+            try:
+                fh = open(state_file)
+                try:
+                    state = json.load(fh)
+                finally:
+                    fh.close()
+            except (IOError, ValueError), e:
+                self.warning("Ignoring unreadable %s: %s" % (state_file, str(e)))
+                state = {}
+        state.setdefault('repos', {})
+        return state
+
+    def _update_share_state(self, share_base, update):
+        """Call update(state) on the current share state, and save it."""
+        with _share_state_lock:
+            state = self._query_share_state(share_base)
+            update(state)
+            state_file = os.path.join(share_base, SHARE_STATE_FILE)
+            tmp_file = "%s.%d.tmp" % (state_file, os.getpid())
+            try:
+                if not os.path.isdir(share_base):
+                    os.makedirs(share_base)
+                fh = open(tmp_file, 'w')
+                try:
+                    json.dump(state, fh, indent=2)
+                finally:
+                    fh.close()
+                os.rename(tmp_file, state_file)
+            except (IOError, OSError), e:
+                self.warning("Can't write %s: %s" % (state_file, str(e)))
+
+    def _query_heads(self, path):
+        output = self.get_output_from_command(
+            self.hg + ['heads', '--template', '{node}\n'], cwd=path, silent=True)
+        return sorted((output or '').split())
+
+    def _record_share_pull(self, share_base, repo, shared_repo):
+        heads = self._query_heads(shared_repo)
+
+        def update(state):
+            state['repos'][repo] = {'heads': heads, 'pulled': time.time()}
+        self._update_share_state(share_base, update)
+
+    def _query_share_is_current(self, share_base, repo, shared_repo, revision=None):
+        """Can we skip pulling repo into shared_repo?
+
+        Yes if revision is a changeset id that shared_repo already has.
+        If we're after a branch instead, only if we pulled less than
+        self.config['vcs_share_max_age'] seconds ago (off by default), and
+        nobody's changed the heads since.
+        """
+        if revision and re.match('^[0-9a-f]{12,40}$', revision):
+            output = self.get_output_from_command(
+                self.hg + ['log', '-r', 'present(%s)' % revision, '--template', '{node}'],
+                cwd=shared_repo, silent=True)
+            return bool(output and output.startswith(revision))
+        max_age = self.config.get('vcs_share_max_age')
+        if not max_age or revision:
+            return False
+        repo_state = self._query_share_state(share_base)['repos'].get(repo)
+        if not repo_state or time.time() - repo_state['pulled'] > max_age:
+            return False
+        return repo_state['heads'] == self._query_heads(shared_repo)
+
+    def query_can_share(self, share_base=None):
+        """Does 'hg share' work?
+
+        Finding out means running hg, so we remember the answer for as
+        long as hg and its config don't change: for this process, and in
+        share_base's SHARE_STATE_FILE if share_base is given.
+        """
         if self.can_share is not None:
             return self.can_share
+        stamp = self._query_hg_stamp()
+        key = repr(stamp)
+        if stamp and key in _can_share_cache:
+            self.can_share = _can_share_cache[key]
+            return self.can_share
+        if stamp and share_base:
+            hg_state = self._query_share_state(share_base).get('hg', {})
+            if hg_state.get('stamp') == stamp:
+                self.can_share = hg_state['can_share']
+                _can_share_cache[key] = self.can_share
+                self.info("hg share %s, going by %s." %
+                          (self.can_share and "works" or "doesn't work",
+                           os.path.join(share_base, SHARE_STATE_FILE)))
+                return self.can_share
         # Check that 'hg share' works
         self.can_share = True
         try:
@@ -328,6 +539,15 @@ class MercurialVCS(ScriptMixin, LogMixin, object):
             self.can_share = False
         if self.can_share:
             self.info("hg share works.")
+        if stamp:
+            _can_share_cache[key] = self.can_share
+            if share_base:
+                hg_state = {'stamp': stamp, 'version': list(self.hg_ver()),
+                            'can_share': self.can_share}
+
+                def update(state):
+                    state['hg'] = hg_state
+                self._update_share_state(share_base, update)
         return self.can_share
 
     def _ensure_shared_repo_and_revision(self, share_base):
@@ -345,7 +565,7 @@ class MercurialVCS(ScriptMixin, LogMixin, object):
         repo = c['repo']
         revision = c.get('revision')
         branch = c.get('branch')
-        if not self.query_can_share():
+        if not self.query_can_share(share_base):
             raise VCSException("%s called when sharing is not allowed!" % __name__)
 
         # If the working directory already exists and isn't using share
@@ -375,18 +595,26 @@ class MercurialVCS(ScriptMixin, LogMixin, object):
 
         self.info("Updating shared repo")
         if os.path.exists(shared_repo):
-            try:
-                self.pull(repo, shared_repo)
-            except VCSException:
-                self.warning("Error pulling changes into %s from %s; clobbering" % (shared_repo, repo))
-                self.exception(level='debug')
-                self.clone(repo, shared_repo)
+            if self._query_share_is_current(share_base, repo, shared_repo, revision):
+                self.info("%s is up to date; not pulling from %s." % (shared_repo, repo))
+            else:
+                try:
+                    self.pull(repo, shared_repo, revision=revision)
+                except VCSException:
+                    self.warning("Error pulling changes into %s from %s; clobbering" % (shared_repo, repo))
+                    self.exception(level='debug')
+                    self.clone(repo, shared_repo)
+                # Only a full pull tells us shared_repo is up to date.
+                if not revision:
+                    self._record_share_pull(share_base, repo, shared_repo)
         else:
             self.clone(repo, shared_repo)
+            self._record_share_pull(share_base, repo, shared_repo)
 
         if os.path.exists(dest):
+            # dest is a share of shared_repo (we clobbered it above
+            # otherwise), so it already has everything shared_repo has.
             try:
-                self.pull(shared_repo, dest)
                 status = self.update(dest, branch=branch, revision=revision)
                 return status
             except VCSException:
@@ -451,7 +679,7 @@ class MercurialVCS(ScriptMixin, LogMixin, object):
         if share_base:
             msg += " using shared directory %s" % share_base
         self.info("%s." % msg)
-        if share_base and not self.query_can_share():
+        if share_base and not self.query_can_share(share_base):
             share_base = None
 
         if share_base:
@@ -460,7 +688,7 @@ class MercurialVCS(ScriptMixin, LogMixin, object):
         # Non-shared
         if os.path.exists(dest):
             try:
-                self.pull(repo, dest)
+                self.pull(repo, dest, revision=revision)
                 return self.update(dest, branch=branch, revision=revision)
             except VCSException:
                 self.warning("Error pulling changes into %s from %s; clobbering" % (dest, repo))
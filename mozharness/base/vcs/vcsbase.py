@@ -9,12 +9,16 @@
 
 from copy import deepcopy
 import os
+import Queue
+import re
 import sys
+import threading
+import urlparse
 
 sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.dirname(sys.path[0]))))
 
 from mozharness.base.errors import VCSException
-from mozharness.base.log import FATAL
+from mozharness.base.log import BufferedLogger, FATAL
 from mozharness.base.script import BaseScript
 from mozharness.base.vcs.mercurial import MercurialVCS
 from mozharness.base.vcs.hgtool import HgtoolVCS
@@ -27,6 +31,18 @@ VCS_DICT = {
     'gittool': GittoolVCS,
 }
 
+# scp-style repos, e.g. git@github.com:mozilla/gecko-dev.git
+SCP_REPO_REGEX = re.compile(r'^[^@/:]+@(?P<host>[^@/:]+):')
+
+
+def query_repo_host(repo):
+    """Return the host repo lives on, or None if it's a local path.
+    """
+    m = SCP_REPO_REGEX.match(repo)
+    if m:
+        return m.group('host')
+    return urlparse.urlsplit(repo).netloc or None
+
 
 # VCSMixin {{{1
 class VCSMixin(object):
@@ -51,8 +67,10 @@ class VCSMixin(object):
             self.rmtree(dest)
             raise
 
-    def vcs_checkout(self, vcs=None, error_level=FATAL, **kwargs):
+    def vcs_checkout(self, vcs=None, error_level=FATAL, log_obj=None, **kwargs):
         """ Check out a single repo.
+
+        The vcs object logs to log_obj if given, else self.log_obj.
         """
         c = self.config
         if not vcs:
@@ -73,7 +91,7 @@ class VCSMixin(object):
         if 'vcs_share_base' not in kwargs:
             kwargs['vcs_share_base'] = c.get('%s_share_base' % vcs, c.get('vcs_share_base'))
         vcs_obj = vcs_class(
-            log_obj=self.log_obj,
+            log_obj=log_obj or self.log_obj,
             config=self.config,
             vcs_config=kwargs,
             script_obj=self,
@@ -85,17 +103,86 @@ class VCSMixin(object):
             args=(vcs_obj, kwargs['dest']),
         )
 
+    def _vcs_checkout_in_parallel(self, checkouts, num_threads):
+        """Helper method for vcs_checkout_repos().
+
+        Run vcs_checkout(**kwargs) for each (key, kwargs) in checkouts in
+        num_threads threads, with no more than
+        self.config.get('vcs_max_connections_per_host', 4) of them talking
+        to the same host, and only one at a time per repo (they may share
+        a repo in vcs_share_base).  Each checkout's log is written out in
+        one piece when it's done.  If any of them raise (including fatal()),
+        no new ones are started, and the first exception is re-raised once
+        the running ones are done.
+
+        Returns {key: revision}.
+        """
+        host_limit = self.config.get('vcs_max_connections_per_host', 4)
+        host_semaphores = {}
+        repo_locks = {}
+        queue = Queue.Queue()
+        for key, kwargs in checkouts:
+            host = query_repo_host(kwargs['repo'])
+            if host and host not in host_semaphores:
+                host_semaphores[host] = threading.Semaphore(host_limit)
+            repo_locks.setdefault(kwargs['repo'], threading.Lock())
+            queue.put((key, kwargs))
+        revisions = {}
+        failures = []
+        log_lock = threading.Lock()
+
+        def checkout_repos():
+            while not failures:
+                try:
+                    key, kwargs = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                log_obj = None
+                if self.log_obj:
+                    log_obj = BufferedLogger(self.log_obj, lock=log_lock)
+                semaphore = host_semaphores.get(query_repo_host(kwargs['repo']))
+                try:
+                    with repo_locks[kwargs['repo']]:
+                        if semaphore:
+                            semaphore.acquire()
+                        try:
+                            revisions[key] = self.vcs_checkout(log_obj=log_obj, **kwargs)
+                        finally:
+                            if semaphore:
+                                semaphore.release()
+                except:
+                    failures.append(sys.exc_info())
+                finally:
+                    if log_obj:
+                        log_obj.flush()
+
+        threads = []
+        for _ in range(num_threads):
+            thread = threading.Thread(target=checkout_repos)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if failures:
+            raise failures[0][0], failures[0][1], failures[0][2]
+        return revisions
+
     def vcs_checkout_repos(self, repo_list, parent_dir=None,
                            tag_override=None, **kwargs):
         """Check out a list of repos.
+
+        Relative dests (and local repo paths) are relative to parent_dir;
+        we don't chdir.  Up to self.config.get('vcs_checkout_threads', 8)
+        repos are checked out at once, unless one goes inside another.
         """
-        orig_dir = os.getcwd()
         c = self.config
         if not parent_dir:
             parent_dir = os.path.join(c['base_work_dir'], c['work_dir'])
+        parent_dir = os.path.abspath(parent_dir)
         self.mkdir_p(parent_dir)
-        self.chdir(parent_dir)
         revision_dict = {}
+        checkouts = []
         kwargs_orig = deepcopy(kwargs)
         for repo_dict in repo_list:
             kwargs = deepcopy(kwargs_orig)
@@ -104,8 +191,24 @@ class VCSMixin(object):
                 kwargs['revision'] = tag_override
             dest = self.query_dest(kwargs)
             revision_dict[dest] = {'repo': kwargs['repo']}
-            revision_dict[dest]['revision'] = self.vcs_checkout(**kwargs)
-        self.chdir(orig_dir)
+            kwargs['dest'] = os.path.join(parent_dir, dest)
+            if '://' not in kwargs['repo'] and not SCP_REPO_REGEX.match(kwargs['repo']):
+                kwargs['repo'] = os.path.join(parent_dir, kwargs['repo'])
+            checkouts.append((dest, kwargs))
+        num_threads = min(c.get('vcs_checkout_threads', 8), len(checkouts))
+        abs_dests = [os.path.join(kw['dest'], '') for _, kw in checkouts]
+        if num_threads > 1 and [d for d in abs_dests for other in abs_dests
+                                if d != other and d.startswith(other)]:
+            self.info("Some of these repos go inside others; checking them out one at a time.")
+            num_threads = 1
+        if num_threads > 1:
+            self.info("Checking out %d repos, %d at a time." % (len(checkouts), num_threads))
+            revisions = self._vcs_checkout_in_parallel(checkouts, num_threads)
+        else:
+            revisions = dict((dest, self.vcs_checkout(**kw))
+                             for dest, kw in checkouts)
+        for dest in revisions:
+            revision_dict[dest]['revision'] = revisions[dest]
         return revision_dict
 
 
@@ -7,20 +7,175 @@
 """Localization.
 """
 
+import errno
+import glob
+import hashlib
 import os
+import shutil
+import tempfile
+import time
 from urlparse import urljoin
 import sys
 from copy import deepcopy
+try:
+    import simplejson as json
+    assert json
+except ImportError:
+    import json
 
 sys.path.insert(1, os.path.dirname(sys.path[0]))
 
 from mozharness.base.config import parse_config_file
 from mozharness.base.errors import PythonErrorList
-from mozharness.base.parallel import ChunkingMixin
+from mozharness.base.parallel import ChunkingMixin, ParallelMixin
+from mozharness.base.signing import hash_file
+
+
+# RepackCache {{{1
+class RepackCache(object):
+    """On-disk cache of locale repack results (installers, MARs), so a
+    repack whose inputs haven't changed can be skipped.
+
+    inputs is a dict of everything that goes into a repack -- the en-US
+    package's hash, the locale's l10n revision, and so on.  Each entry
+    is a dir under entries/, named after the sha1 of its inputs, with
+    the files the repack made (by their path relative to the objdir)
+    under files/, and inputs.json.  The mtime of inputs.json is the
+    entry's last use; evict() removes the least recently used entries
+    until we're under max_size bytes.
+
+    Entries land in their final place via rename(), so several jobs
+    can use the same cache at once.
+    """
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        self.entries_dir = os.path.join(self.cache_dir, 'entries')
+        self.tmp_dir = os.path.join(self.cache_dir, 'tmp')
+        for d in (self.entries_dir, self.tmp_dir):
+            try:
+                os.makedirs(d)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def query_key(self, inputs):
+        return hashlib.sha1(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+    def _entry_dir(self, inputs):
+        return os.path.join(self.entries_dir, self.query_key(inputs))
+
+    def query_files(self, inputs):
+        """Return the list of files cached for inputs, or None if we
+        don't have them.
+        """
+        entry_dir = self._entry_dir(inputs)
+        try:
+            fh = open(os.path.join(entry_dir, 'inputs.json'))
+            try:
+                entry = json.load(fh)
+            finally:
+                fh.close()
+        except (IOError, ValueError):
+            return None
+        if entry.get('inputs') != json.loads(json.dumps(inputs)):
+            return None
+        for f in entry['files']:
+            if not os.path.isfile(os.path.join(entry_dir, 'files', f)):
+                return None
+        return entry['files']
+
+    def restore(self, inputs, dest_dir):
+        """Copy the files cached for inputs into dest_dir, and return
+        their list, or None if we don't have them.
+
+        If a copy fails, the files restored so far are removed again
+        before the error is raised.
+        """
+        files = self.query_files(inputs)
+        if files is None:
+            return None
+        entry_dir = self._entry_dir(inputs)
+        restored = []
+        try:
+            for f in files:
+                dest = os.path.join(dest_dir, f)
+                if not os.path.isdir(os.path.dirname(dest)):
+                    os.makedirs(os.path.dirname(dest))
+                restored.append(dest)
+                shutil.copyfile(os.path.join(entry_dir, 'files', f), dest)
+        except (IOError, OSError):
+            exc_info = sys.exc_info()
+            for dest in restored:
+                if os.path.isfile(dest):
+                    os.remove(dest)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        os.utime(os.path.join(entry_dir, 'inputs.json'), None)
+        return files
+
+    def add(self, inputs, base_dir, files):
+        """Cache files (relative to base_dir) as the results of inputs.
+        """
+        tmp_entry_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+        try:
+            for f in files:
+                dest = os.path.join(tmp_entry_dir, 'files', f)
+                if not os.path.isdir(os.path.dirname(dest)):
+                    os.makedirs(os.path.dirname(dest))
+                shutil.copyfile(os.path.join(base_dir, f), dest)
+            fh = open(os.path.join(tmp_entry_dir, 'inputs.json'), 'w')
+            try:
+                json.dump({'inputs': inputs, 'files': list(files),
+                           'time': time.time()}, fh)
+            finally:
+                fh.close()
+            entry_dir = self._entry_dir(inputs)
+            if os.path.exists(entry_dir):
+                shutil.rmtree(entry_dir)
+            os.rename(tmp_entry_dir, entry_dir)
+        except:
+            shutil.rmtree(tmp_entry_dir, ignore_errors=True)
+            raise
+
+    def evict(self, keep=None):
+        """Remove the least recently used entries until the cache is under
+        max_size.  Returns the list of removed entry dirs.
+        """
+        removed = []
+        if not self.max_size:
+            return removed
+        keep = keep and self.query_key(keep)
+        entries = []
+        total = 0
+        for name in os.listdir(self.entries_dir):
+            entry_dir = os.path.join(self.entries_dir, name)
+            size = 0
+            try:
+                mtime = os.path.getmtime(os.path.join(entry_dir, 'inputs.json'))
+                for dirpath, dirnames, filenames in os.walk(entry_dir):
+                    for f in filenames:
+                        size += os.path.getsize(os.path.join(dirpath, f))
+            except OSError:
+                continue
+            entries.append((mtime, size, name, entry_dir))
+            total += size
+        entries.sort()
+        for _, size, name, entry_dir in entries:
+            if total <= self.max_size:
+                break
+            if name == keep:
+                continue
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+            removed.append(entry_dir)
+        return removed
 
 
 # LocalesMixin {{{1
-class LocalesMixin(ChunkingMixin):
+class LocalesMixin(ChunkingMixin, ParallelMixin):
+    repack_cache = None
+    repack_cache_inputs = None
+
     def __init__(self, **kwargs):
         """ Mixins generally don't have an __init__.
         This breaks super().__init__() for children.
@@ -101,10 +256,11 @@ class LocalesMixin(ChunkingMixin):
                              os.path.join(dirs['abs_compare_locales_dir'],
                                           'lib')})
         compare_locales_error_list = list(PythonErrorList)
-        self.rmtree(dirs['abs_merge_dir'])
-        self.mkdir_p(dirs['abs_merge_dir'])
+        merge_dir = self.query_abs_locale_merge_dir(locale)
+        self.rmtree(merge_dir)
+        self.mkdir_p(merge_dir)
         command = "python %s -m %s l10n.ini %s %s" % (compare_locales_script,
-                  dirs['abs_merge_dir'], dirs['abs_l10n_dir'], locale)
+                  merge_dir, dirs['abs_l10n_dir'], locale)
         self.info("*** BEGIN compare-locales %s" % locale)
         status = self.run_command(command, error_list=compare_locales_error_list,
                                   cwd=dirs['abs_locales_src_dir'], env=env,
@@ -112,6 +268,153 @@ class LocalesMixin(ChunkingMixin):
         self.info("*** END compare-locales %s" % locale)
         return status
 
+    def query_abs_locale_merge_dir(self, locale):
+        """compare-locales merges locale into its own dir, so locales can
+        be repacked side by side."""
+        return os.path.join(self.query_abs_dirs()['abs_merge_dir'], locale)
+
+    def query_locale_make_args(self, locale):
+        """Extra make args for locale's repack targets, from
+        self.config['locale_make_args'].  These can use %(locale)s and
+        %(abs_locale_work_dir)s (a dir of locale's own in the objdir), to
+        keep locales repacking at the same time out of each other's
+        staging dirs.
+        """
+        replace_dict = {
+            'locale': locale,
+            'abs_locale_work_dir': os.path.join(
+                self.query_abs_dirs()['abs_objdir'], 'l10n-work', locale),
+        }
+        return [arg % replace_dict
+                for arg in self.config.get('locale_make_args', [])]
+
+    def query_repack_workers(self):
+        """How many locales to repack at once, from
+        self.config['repack_workers'].  Without locale_make_args, every
+        locale stages into the same dirs, so we only repack one at a time.
+        """
+        num_workers = self.config.get('repack_workers', 1)
+        if num_workers > 1 and not self.config.get('locale_make_args'):
+            self.warning("repack_workers is %d, but locale_make_args isn't set; "
+                         "repacking one locale at a time." % num_workers)
+            num_workers = 1
+        return num_workers
+
+    def query_repack_cache(self):
+        """Return the RepackCache in self.config['repack_cache_dir'],
+        or None if there isn't one configured.
+
+        self.config['repack_cache_max_size'] is the size budget in bytes.
+        """
+        if self.repack_cache is None and self.config.get('repack_cache_dir'):
+            self.repack_cache = RepackCache(
+                self.config['repack_cache_dir'],
+                max_size=self.config.get('repack_cache_max_size'))
+        return self.repack_cache
+
+    def _query_hg_revision(self, path):
+        if not os.path.isdir(os.path.join(path, '.hg')):
+            return None
+        hg = self.query_exe('hg', return_type='list')
+        return self.get_output_from_command(
+            hg + ['parent', '--template', '{node|short}'], cwd=path)
+
+    def query_l10n_revision(self, locale):
+        """The revision of locale's l10n repo we're repacking."""
+        if self.gecko_locale_revisions and locale in self.gecko_locale_revisions:
+            return self.gecko_locale_revisions[locale]['revision']
+        dirs = self.query_abs_dirs()
+        return self._query_hg_revision(os.path.join(dirs['abs_l10n_dir'], locale))
+
+    def query_repack_cache_inputs(self, locale, en_us_package, repack_env=None):
+        """Everything that goes into repacking locale from en_us_package,
+        as a RepackCache key: the en-US package and mozconfig hashes, the
+        compare-locales and l10n revisions, and from repack_env, the update
+        channel and whether we sign.
+
+        Returns None if we can't tell, so locale shouldn't be cached.
+        """
+        dirs = self.query_abs_dirs()
+        if self.repack_cache_inputs is None:
+            if not os.path.exists(en_us_package):
+                self.warning("Can't find %s; not using the repack cache." % en_us_package)
+                return None
+            mozconfig = os.path.join(dirs['abs_mozilla_dir'], '.mozconfig')
+            self.repack_cache_inputs = {
+                'en_us_package': hash_file(en_us_package, ('sha1', ))['sha1'],
+                'mozconfig': None,
+                'compare_locales_revision': self._query_hg_revision(
+                    dirs['abs_compare_locales_dir']),
+            }
+            if os.path.exists(mozconfig):
+                self.repack_cache_inputs['mozconfig'] = hash_file(mozconfig, ('sha1', ))['sha1']
+        inputs = dict(self.repack_cache_inputs)
+        inputs['locale'] = locale
+        inputs['l10n_revision'] = self.query_l10n_revision(locale)
+        inputs['locale_make_args'] = self.query_locale_make_args(locale)
+        if repack_env is not None:
+            inputs['update_channel'] = repack_env.get('MOZ_UPDATE_CHANNEL')
+            # MOZ_SIGN_CMD names this run's signing servers and token, so
+            # only whether it's set goes into the key.
+            inputs['signed'] = bool(repack_env.get('MOZ_SIGN_CMD'))
+        if not inputs['l10n_revision'] or not inputs['compare_locales_revision']:
+            self.warning("Can't tell which revisions %s is repacked from; not using the repack cache." % locale)
+            return None
+        return inputs
+
+    def restore_repack_from_cache(self, inputs):
+        """Put the results of an earlier repack with the same inputs back
+        in the objdir.  Returns True if we had them.
+        """
+        cache = self.query_repack_cache()
+        if not cache or not inputs:
+            return False
+        try:
+            files = cache.restore(inputs, self.query_abs_dirs()['abs_objdir'])
+        except (IOError, OSError), e:
+            self.warning("Can't restore the cached repack of %s: %s; repacking it." %
+                         (inputs['locale'], str(e)))
+            return False
+        if files is None:
+            return False
+        self.info("Reusing the cached repack of %s." % inputs['locale'])
+        for f in files:
+            self.info("Restored %s." % f)
+        return True
+
+    def add_repack_to_cache(self, inputs, file_patterns, since):
+        """Cache the files matching file_patterns (globs relative to the
+        objdir, with %(locale)s) made since the time since, as the
+        results of repacking inputs.
+        """
+        cache = self.query_repack_cache()
+        if not cache or not inputs:
+            return
+        abs_objdir = self.query_abs_dirs()['abs_objdir']
+        files = []
+        for pattern in file_patterns:
+            for path in glob.glob(os.path.join(abs_objdir, pattern % {'locale': inputs['locale']})):
+                # Leftovers from earlier repacks aren't ours.
+                if os.path.isfile(path) and os.path.getmtime(path) >= since:
+                    files.append(os.path.relpath(path, abs_objdir))
+        if not files:
+            self.warning("Found nothing to cache for %s!" % inputs['locale'])
+            return
+        self.info("Adding %s to the repack cache." % ', '.join(files))
+        try:
+            cache.add(inputs, abs_objdir, files)
+            cache.evict(keep=inputs)
+        except (IOError, OSError), e:
+            self.warning("Can't add %s to the repack cache: %s" % (inputs['locale'], str(e)))
+
+    def run_per_locale(self, func, locales, num_workers=1, log_name=None):
+        """Call func(locale) for each of locales, in up to num_workers
+        threads, and yield (locale, result) as they finish.  See
+        run_in_parallel(); the logs are <log_name>-<locale>.log.
+        """
+        return self.run_in_parallel(func, locales, num_workers=num_workers,
+                                    log_name=log_name)
+
     def query_abs_dirs(self):
         if self.abs_dirs:
             return self.abs_dirs
@@ -153,7 +153,7 @@ class MultiLocaleBuild(LocalesMixin, MercurialScript):
             self.run_compare_locales(locale, halt_on_failure=True)
             command = 'make chrome-%s L10NBASEDIR=%s' % (locale, dirs['abs_l10n_dir'])
             if c['merge_locales']:
-                command += " LOCALE_MERGEDIR=%s" % dirs['abs_merge_dir']
+                command += " LOCALE_MERGEDIR=%s" % self.query_abs_locale_merge_dir(locale)
             status = self._process_command(command=command,
                                            cwd=dirs['abs_locales_dir'],
                                            error_list=MakefileErrorList)
@@ -6,6 +6,12 @@
 # ***** END LICENSE BLOCK *****
 """Support for hg/git mapper
 """
+from array import array
+import heapq
+import mmap
+import os
+import shutil
+import tempfile
 import urllib2
 import time
 try:
@@ -14,10 +20,314 @@ except ImportError:
     import json
 
 
+class MapfileIndex(object):
+    """ Look up revisions in a local mapfile: one "<git sha> <hg sha>"
+        line per changeset, in any order (as hg-git writes them).
+
+        The file is mmapped once; each direction gets an array of line
+        offsets sorted by that column the first time it's asked for, and
+        lookups are binary searches over those.  Revisions can be
+        abbreviated.
+        """
+    LINE_LENGTH = 82
+    COLUMNS = {'git': 0, 'hg': 41}
+
+    def __init__(self, path):
+        self.path = path
+        st = os.stat(path)
+        self.stamp = (st.st_size, st.st_mtime)
+        self._offsets = None
+        self._sorted = {}
+        self._map = None
+        fh = open(path, 'rb')
+        try:
+            if st.st_size:
+                self._map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fh.close()
+
+    def __len__(self):
+        return len(self._query_offsets())
+
+    def is_current(self):
+        """ Is the mapfile on disk still the one we mmapped?
+            """
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        return (st.st_size, st.st_mtime) == self.stamp
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._offsets = None
+        self._sorted = {}
+
+    def _query_offsets(self):
+        """ Offsets of the well-formed lines, in file order.
+            """
+        if self._offsets is None:
+            offsets = array('L')
+            m = self._map
+            if m is not None:
+                size = len(m)
+                offset = 0
+                while offset < size:
+                    end = m.find('\n', offset)
+                    if end < 0:
+                        end = size
+                    if end - offset == self.LINE_LENGTH - 1 and m[offset + 40] == ' ':
+                        offsets.append(offset)
+                    offset = end + 1
+            self._offsets = offsets
+        return self._offsets
+
+    def _query_sorted(self, column):
+        if column not in self._sorted:
+            m = self._map
+            start = self.COLUMNS[column]
+            self._sorted[column] = array('L', sorted(
+                self._query_offsets(), key=lambda o: m[o + start:o + start + 40]))
+        return self._sorted[column]
+
+    def _search(self, column, revision, lo=0):
+        """ Returns the index in the column's sorted offsets of the first
+            line whose `column` sha is >= revision, starting at lo.
+            """
+        offsets = self._query_sorted(column)
+        start = self.COLUMNS[column]
+        length = len(revision)
+        m = self._map
+        hi = len(offsets)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            o = offsets[mid] + start
+            if m[o:o + length] < revision:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _lookup(self, column, revision, lo=0):
+        """ Returns (mapped revision or None, where the search ended).
+            """
+        revision = revision.lower()
+        i = self._search(column, revision, lo)
+        offsets = self._query_sorted(column)
+        if i < len(offsets):
+            o = offsets[i]
+            start = self.COLUMNS[column]
+            if self._map[o + start:o + start + len(revision)] == revision:
+                other = 41 - start
+                return self._map[o + other:o + other + 40], i
+        return None, i
+
+    def query_git_revision(self, hg_revision):
+        """ Returns the git sha for hg_revision, or None.
+            """
+        return self._lookup('hg', hg_revision)[0]
+
+    def query_hg_revision(self, git_revision):
+        """ Returns the hg sha for git_revision, or None.
+            """
+        return self._lookup('git', git_revision)[0]
+
+    def resolve(self, revisions, vcs='git'):
+        """ Map a bunch of revisions in one pass: they're looked up in
+            sorted order, each search starting where the last one ended.
+
+            vcs is the vcs you want revisions for, like query_mapper().
+            Returns a dict of revision -> mapped revision or None.
+            """
+        column = 'hg' if vcs == 'git' else 'git'
+        results = {}
+        lo = 0
+        for revision in sorted(set(revisions), key=lambda r: r.lower()):
+            results[revision], lo = self._lookup(column, revision, lo)
+        return results
+
+
+def _mapfile_key(line):
+    """ The hg revision of a mapfile line, like `sort -t ' ' --key=2`.
+        """
+    return line.partition(' ')[2]
+
+
+def _keyed_mapfile_lines(fh, rank):
+    """ (key, rank, line) for each line of fh; rank breaks ties between
+        sources in heapq.merge().
+        """
+    for line in fh:
+        yield (_mapfile_key(line), rank, line)
+
+
+def _sort_mapfile_lines(lines):
+    """ Sort (key, line) pairs by key only, so lines with the same key
+        stay in the order they were read.
+        """
+    lines.sort(key=lambda l: l[0])
+
+
+def _mapfile_unchanged(path, path_state):
+    """ Is what we merged from path last time still the start of it?
+        """
+    try:
+        if os.path.getsize(path) < path_state['offset']:
+            return False
+        last_line = path_state['last_line']
+        fh = open(path, 'rb')
+        try:
+            fh.seek(path_state['offset'] - len(last_line))
+            return fh.read(len(last_line)) == last_line
+        finally:
+            fh.close()
+    except (IOError, OSError, KeyError):
+        return False
+
+
+def combine_mapfiles(mapfiles, combined_mapfile, run_lines=100000):
+    """ Keep combined_mapfile the union of mapfiles, sorted by hg revision
+        with one line per revision, as `sort --unique -t ' ' --key=2` would,
+        but incrementally.
+
+        Like sort --unique, if several lines have the same hg revision we
+        keep the first one read, going through mapfiles in order.  When
+        merging incrementally, lines already in combined_mapfile come
+        first, so a revision's line never changes once it's there.
+
+        How far into each mapfile we've merged is kept in
+        combined_mapfile.state.  Only what's been appended since is read;
+        it's sorted in runs of at most run_lines lines (spilled to temp
+        files), and the runs are heap-merged with the existing combined
+        mapfile into a new file that atomically replaces it.  The previous
+        one is kept as combined_mapfile.old.  If a mapfile was rewritten
+        rather than appended to, or dropped from mapfiles, everything is
+        merged again from scratch.
+
+        Returns the number of new lines read, or None if there were none
+        and combined_mapfile was left alone.
+        """
+    combined_dir = os.path.dirname(os.path.abspath(combined_mapfile))
+    state_path = "%s.state" % combined_mapfile
+    mapfiles = [os.path.abspath(f) for f in mapfiles]
+    state = {}
+    if os.path.exists(combined_mapfile) and os.path.exists(state_path):
+        try:
+            fh = open(state_path)
+            try:
+                state = json.load(fh)
+            finally:
+                fh.close()
+        except ValueError:
+            pass
+    if set(state) - set(mapfiles) or \
+            [f for f in state if not _mapfile_unchanged(f, state[f])]:
+        state = {}
+    incremental = bool(state)
+
+    runs = []
+    lines = []
+    new_lines = 0
+    try:
+        for path in mapfiles:
+            path_state = state.setdefault(path, {'offset': 0, 'last_line': ''})
+            fh = open(path, 'rb')
+            try:
+                fh.seek(path_state['offset'])
+                for line in fh:
+                    if not line.endswith('\n'):
+                        # Still being written.
+                        break
+                    path_state['offset'] += len(line)
+                    path_state['last_line'] = line
+                    lines.append((_mapfile_key(line), line))
+                    if len(lines) >= run_lines:
+                        _sort_mapfile_lines(lines)
+                        run = tempfile.TemporaryFile(dir=combined_dir)
+                        run.writelines(l for _, l in lines)
+                        run.seek(0)
+                        runs.append(run)
+                        new_lines += len(lines)
+                        lines = []
+            finally:
+                fh.close()
+        new_lines += len(lines)
+        if not new_lines and incremental:
+            return None
+        _sort_mapfile_lines(lines)
+        # Rank the sources in the order their lines were read.
+        sources = [_keyed_mapfile_lines(f, rank + 1) for rank, f in enumerate(runs)]
+        sources.append((key, len(runs) + 1, line) for key, line in lines)
+        if incremental:
+            combined = open(combined_mapfile, 'rb')
+            runs.append(combined)
+            sources.append(_keyed_mapfile_lines(combined, 0))
+
+        fd, tmp_path = tempfile.mkstemp(
+            dir=combined_dir, prefix="%s." % os.path.basename(combined_mapfile))
+        try:
+            out = os.fdopen(fd, 'wb')
+            try:
+                previous_key = None
+                for key, _, line in heapq.merge(*sources):
+                    if key != previous_key:
+                        out.write(line)
+                        previous_key = key
+            finally:
+                out.close()
+            os.chmod(tmp_path, 0644)
+            if os.path.exists(combined_mapfile):
+                old_path = "%s.old" % combined_mapfile
+                if os.path.exists(old_path):
+                    os.remove(old_path)
+                try:
+                    os.link(combined_mapfile, old_path)
+                except OSError:
+                    shutil.copyfile(combined_mapfile, old_path)
+            os.rename(tmp_path, combined_mapfile)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    finally:
+        for run in runs:
+            run.close()
+
+    fd, tmp_path = tempfile.mkstemp(dir=combined_dir)
+    fh = os.fdopen(fd, 'w')
+    try:
+        json.dump(state, fh)
+    finally:
+        fh.close()
+    os.rename(tmp_path, state_path)
+    return new_lines
+
+
 class MapperMixin:
+    mapfile_indexes = None
+
+    def query_mapfile_index(self, mapfile):
+        """
+        Returns a MapfileIndex for mapfile, reusing the one from an earlier
+        call unless the file has changed since.
+        """
+        if self.mapfile_indexes is None:
+            self.mapfile_indexes = {}
+        path = os.path.abspath(mapfile)
+        index = self.mapfile_indexes.get(path)
+        if index is not None and not index.is_current():
+            index.close()
+            index = None
+        if index is None:
+            index = MapfileIndex(path)
+            self.mapfile_indexes[path] = index
+        return index
+
     def query_mapper(self, mapper_url, project, vcs, rev,
                      require_answer=True, attempts=30, sleeptime=30,
-                     project_name=None):
+                     project_name=None, mapfile=None):
         """
         Returns the mapped revision for the target vcs via a mapper service
 
@@ -36,12 +346,24 @@ class MapperMixin:
             project_name (str): Used for logging only to give a more
                 descriptive name to the project, otherwise just uses the
                 project parameter
+            mapfile (str): A local mapfile to look rev up in before asking
+                the mapper service.  Defaults to
+                self.config['mapper_mapfiles'][project], if set.
 
         Returns:
             A revision string, or None
         """
         if project_name is None:
             project_name = project
+        if mapfile is None:
+            mapfile = self.config.get('mapper_mapfiles', {}).get(project)
+        if mapfile and os.path.exists(mapfile):
+            mapped = self.query_mapfile_index(mapfile).resolve([rev], vcs=vcs)[rev]
+            if mapped:
+                self.info('Mapped %s revision %s to %s %s using %s' %
+                          (project_name, rev, vcs, mapped, mapfile))
+                return mapped
+            self.info("%s isn't in %s; asking the mapper service." % (rev, mapfile))
         url = mapper_url.format(project=project, vcs=vcs, rev=rev)
         self.info('Mapping %s revision to %s using %s' % (project_name, vcs, url))
         n = 1
@@ -11,14 +11,18 @@ https://hg.mozilla.org/build/tools/file/default/sut_tools
 '''
 
 import datetime
+from multiprocessing.pool import ThreadPool
 import os
+import Queue
+import random
 import re
 import subprocess
 import sys
+import threading
 import time
 
 from mozharness.base.errors import ADBErrorList
-from mozharness.base.log import LogMixin, DEBUG
+from mozharness.base.log import LogMixin, OutputParser, PrefixLogger, DEBUG, ERROR, FATAL, INFO
 from mozharness.base.script import ScriptMixin
 
 
@@ -33,23 +37,165 @@ DEVICE_CANT_REMOVE_DEVROOT = 0x06
 DEVICE_CANT_REMOVE_ETC_HOSTS = 0x07
 DEVICE_CANT_SET_TIME = 0x08
 
+DEVICE_FLAG_NAMES = {
+    DEVICE_UNREACHABLE: 'unreachable',
+    DEVICE_NOT_CONNECTED: 'not connected',
+    DEVICE_MISSING_SDCARD: 'missing sdcard',
+    DEVICE_HOST_ERROR: 'host error',
+    DEVICE_NOT_REBOOTED: 'not rebooted',
+    DEVICE_CANT_REMOVE_DEVROOT: "can't remove device root",
+    DEVICE_CANT_REMOVE_ETC_HOSTS: "can't remove /etc/hosts",
+    DEVICE_CANT_SET_TIME: "can't set time",
+}
+
+
+# `uptime` on the device, e.g. "up time: 2 days, 04:10:33, idle time: ..."
+UPTIME_REGEX = re.compile(r'up time: (?:(\d+) days?, )?(\d+):(\d\d):(\d\d)')
+
 
 class DeviceException(Exception):
     pass
 
 
+# ADBShellSession {{{1
+class ADBShellSession(object):
+    """One `adb shell` kept open to run many commands on a device.
+
+    Old versions of adb don't pass on the exit code of shell commands,
+    and each `adb shell` is a new process plus a new connection to the
+    device, so commands are written to one long-running shell instead.
+    Each command's output is fenced in by marker lines; the closing one
+    carries its exit code:
+
+        echo <start>; <command>; echo <end> $?
+
+    The device shell may echo the command lines back, end lines with
+    \\r\\n, and print its prompt in front of the start marker, so a line
+    starts a command's output if it ends with the start marker.  An
+    echoed command line never does.
+    """
+    def __init__(self, adb, device_id, timeout=60):
+        self.adb = adb
+        self.device_id = device_id
+        self.timeout = timeout
+        self.proc = None
+        self.lines = None
+        self.lock = threading.Lock()
+        self.marker = "__MOZHARNESS_%d_%d__" % (os.getpid(), random.randint(0, 1000000))
+        self.count = 0
+
+    def _start(self):
+        self.proc = subprocess.Popen([self.adb, "-s", self.device_id, "shell"],
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT)
+        self.lines = Queue.Queue()
+
+        def read_lines(stdout, lines):
+            for line in iter(stdout.readline, ''):
+                lines.put(line.rstrip('\r\n'))
+            lines.put(None)
+        reader = threading.Thread(target=read_lines,
+                                  args=(self.proc.stdout, self.lines))
+        reader.daemon = True
+        reader.start()
+
+    def run(self, commands, timeout=None):
+        """Run each of commands in the shell, in one round-trip, and
+        return a list of (exit_code, output) for them.
+
+        Raises DeviceException, and closes the session, if the shell goes
+        away or takes more than timeout seconds to answer.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        with self.lock:
+            markers = []
+            script = []
+            for command in commands:
+                self.count += 1
+                start = "%s%d_START" % (self.marker, self.count)
+                end = "%s%d_END" % (self.marker, self.count)
+                markers.append((start, re.compile(r"%s (\d+)$" % end)))
+                script.append("echo %s; %s; echo %s $?\n" % (start, command, end))
+            try:
+                if self.proc is None:
+                    self._start()
+                self.proc.stdin.write(''.join(script))
+                self.proc.stdin.flush()
+                deadline = time.time() + timeout
+                results = []
+                for start, end_re in markers:
+                    output = None
+                    while True:
+                        try:
+                            line = self.lines.get(timeout=max(0, deadline - time.time()))
+                        except Queue.Empty:
+                            raise DeviceException("Timed out waiting for adb shell on %s" % self.device_id)
+                        if line is None:
+                            raise DeviceException("adb shell on %s went away" % self.device_id)
+                        if output is None:
+                            if line.endswith(start):
+                                output = []
+                            continue
+                        m = end_re.search(line)
+                        if m:
+                            # The command's output may not end in a newline.
+                            output.append(line[:m.start()])
+                            results.append((int(m.group(1)), '\n'.join(output).rstrip('\n')))
+                            break
+                        output.append(line)
+                return results
+            except DeviceException:
+                self._close()
+                raise
+            except (IOError, OSError), e:
+                self._close()
+                raise DeviceException("Can't talk to adb shell on %s: %s" %
+                                      (self.device_id, str(e)))
+
+    def _close(self):
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+        except IOError:
+            pass
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+        self.proc = None
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+
 # BaseDeviceHandler {{{1
 class BaseDeviceHandler(ScriptMixin, LogMixin):
     device_id = None
     device_root = None
     default_port = None
     device_flags = []
+    # Set while DeviceMixin.run_on_devices() runs an operation on us.
+    raise_on_fatal = False
 
     def __init__(self, log_obj=None, config=None, script_obj=None):
         super(BaseDeviceHandler, self).__init__()
         self.config = config
         self.log_obj = log_obj
         self.script_obj = script_obj
+        self.device_flags = []
+
+    def log(self, message, level=INFO, exit_code=-1):
+        """If raise_on_fatal is set, a fatal error only fails this
+        device: log it as an error and raise DeviceException instead of
+        logging the script's exit.
+        """
+        if level == FATAL and self.raise_on_fatal:
+            super(BaseDeviceHandler, self).log(message, level=ERROR)
+            raise DeviceException(message)
+        super(BaseDeviceHandler, self).log(message, level=level, exit_code=exit_code)
 
     def add_device_flag(self, flag):
         if flag not in self.device_flags:
@@ -68,6 +214,21 @@ class BaseDeviceHandler(ScriptMixin, LogMixin):
         self.device_id = device_id
         return self.device_id
 
+    def query_poll_intervals(self, interval, max_attempts):
+        """Yield how long wait_for_device() should sleep before each
+        check: self.config['device_poll_initial_interval'] seconds at
+        first, doubling up to interval, for as long as max_attempts
+        checks interval seconds apart would have taken.
+        """
+        timeout = interval * (max_attempts + 1)
+        sleep = min(self.config.get('device_poll_initial_interval', 5), interval)
+        slept = 0
+        while slept < timeout:
+            sleep = min(sleep, timeout - slept)
+            yield sleep
+            slept += sleep
+            sleep = min(sleep * 2, interval)
+
     def query_download_filename(self, file_id=None):
         pass
 
@@ -98,6 +259,8 @@ class ADBDeviceHandler(BaseDeviceHandler):
     def __init__(self, **kwargs):
         super(ADBDeviceHandler, self).__init__(**kwargs)
         self.default_port = 5555
+        self.shell_session = None
+        self.attached_devices = None
 
     def query_device_exe(self, exe_name):
         return self.query_exe(exe_name, exe_dict="device_exes")
@@ -125,6 +288,77 @@ class ADBDeviceHandler(BaseDeviceHandler):
         self.device_id = device_id
         return self.device_id
 
+    def query_shell_session(self):
+        """Returns the ADBShellSession for the device, or None if
+        self.config['adb_shell_session'] is False.
+        """
+        if self.shell_session:
+            return self.shell_session
+        if not self.config.get('adb_shell_session', True):
+            return None
+        self.shell_session = ADBShellSession(
+            self.query_exe('adb'), self.query_device_id(),
+            timeout=self.config.get('adb_shell_timeout', 60))
+        return self.shell_session
+
+    def close_shell_session(self):
+        if self.shell_session:
+            self.shell_session.close()
+            self.shell_session = None
+
+    def run_shell_commands(self, commands, silent=False):
+        """Run each of commands in the device's shell, and return a list
+        of their outputs (None where we couldn't run them).
+
+        With a shell session that's one round-trip to the device;
+        otherwise it's an `adb shell` per command.
+        """
+        session = self.query_shell_session()
+        if session is None:
+            device_id = self.query_device_id()
+            adb = self.query_exe('adb')
+            return [self.get_output_from_command([adb, "-s", device_id,
+                                                  "shell", command],
+                                                 silent=silent)
+                    for command in commands]
+        if not silent:
+            self.info("Running in the adb shell on %s: %s" %
+                      (session.device_id, '; '.join(commands)))
+        try:
+            results = session.run(commands)
+        except DeviceException, e:
+            self.warning(str(e))
+            return [None] * len(commands)
+        outputs = []
+        for status, output in results:
+            if not silent and output:
+                self.info(output)
+            outputs.append(output)
+        return outputs
+
+    def query_shell_output(self, command, silent=False):
+        return self.run_shell_commands([command], silent=silent)[0]
+
+    def _query_failed_shell_commands(self, commands, outputs,
+                                     error_list=ADBErrorList):
+        """Given commands and their outputs from run_shell_commands(),
+        return the set of indexes of the commands that failed: those we
+        couldn't run, or whose output matches an error in error_list.
+        """
+        failed = set()
+        for i, (command, output) in enumerate(zip(commands, outputs)):
+            if output is None:
+                self.error("Couldn't run '%s' on the device!" % command)
+                failed.add(i)
+                continue
+            parser = OutputParser(config=self.config, log_obj=self.log_obj,
+                                  error_list=error_list, log_output=False)
+            parser.add_lines(output.splitlines())
+            if parser.num_errors:
+                self.error("'%s' failed on the device:\n%s" % (command, output))
+                failed.add(i)
+        return failed
+
     # maintenance {{{2
     def ping_device(self, auto_connect=False, silent=False):
         if auto_connect and not self._query_attached_devices():
@@ -132,11 +366,8 @@ class ADBDeviceHandler(BaseDeviceHandler):
         if not silent:
             self.info("Determining device connectivity over adb...")
         device_id = self.query_device_id()
-        adb = self.query_exe('adb')
         uptime = self.query_device_exe('uptime')
-        output = self.get_output_from_command([adb, "-s", device_id,
-                                               "shell", uptime],
-                                              silent=silent)
+        output = self.query_shell_output(uptime, silent=silent)
         if str(output).startswith("up time:"):
             if not silent:
                 self.info("Found %s." % device_id)
@@ -151,6 +382,14 @@ class ADBDeviceHandler(BaseDeviceHandler):
             return False
 
     def _query_attached_devices(self):
+        """Returns the devices `adb devices` lists.  The answer is reused
+        for self.config['adb_devices_cache_ttl'] seconds, or until we
+        connect or disconnect a device.
+        """
+        if self.attached_devices:
+            timestamp, devices = self.attached_devices
+            if time.time() - timestamp < self.config.get('adb_devices_cache_ttl', 5):
+                return devices
         devices = []
         adb = self.query_exe('adb')
         output = self.get_output_from_command([adb, "devices"])
@@ -158,7 +397,7 @@ class ADBDeviceHandler(BaseDeviceHandler):
         if output is None:
             self.add_device_flag(DEVICE_HOST_ERROR)
             self.fatal("Can't get output from 'adb devices'; install the Android SDK!")
-        for line in output:
+        for line in output.splitlines():
             if 'adb: command not found' in line:
                 self.add_device_flag(DEVICE_HOST_ERROR)
                 self.fatal("Can't find adb; install the Android SDK!")
@@ -169,8 +408,9 @@ class ADBDeviceHandler(BaseDeviceHandler):
                 continue
             # TODO somehow otherwise determine whether this is an actual
             # device?
-            if starting_list:
+            if starting_list and line.strip():
                 devices.append(re.split('\s+', line)[0])
+        self.attached_devices = (time.time(), devices)
         return devices
 
     def connect_device(self):
@@ -186,10 +426,13 @@ class ADBDeviceHandler(BaseDeviceHandler):
             cmd.append(device_id)
         # TODO error check
         self.run_command(cmd, error_list=ADBErrorList)
+        self.attached_devices = None
 
     def disconnect_device(self):
         self.info("Disconnecting device...")
         device_id = self.query_device_id()
+        self.close_shell_session()
+        self.attached_devices = None
         if device_id:
             adb = self.query_exe('adb')
             # TODO error check
@@ -214,18 +457,20 @@ class ADBDeviceHandler(BaseDeviceHandler):
             return False
         device_id = self.query_device_id()
         self.info("Rebooting device...")
+        self.close_shell_session()
         adb = self.query_exe('adb')
         cmd = [adb, "-s", device_id, "reboot"]
         self.info("Running command (in the background): %s" % cmd)
         # This won't exit until much later, but we don't need to wait.
         # However, some error checking would be good.
+        rebooted_at = time.time()
         p = subprocess.Popen(cmd, stdout=subprocess.PIPE,
                              stderr=subprocess.STDOUT)
         time.sleep(10)
         self.disconnect_device()
         status = False
         try:
-            self.wait_for_device()
+            self.wait_for_device(rebooted_at=rebooted_at)
             status = True
         except DeviceException:
             self.error("Can't reconnect to device!")
@@ -237,19 +482,37 @@ class ADBDeviceHandler(BaseDeviceHandler):
     def cleanup_device(self, reboot=False):
         self.info("Cleaning up device.")
         c = self.config
-        device_id = self.query_device_id()
-        status = self.remove_device_root()
-        if not status:
+        device_root = self.query_device_root()
+        if device_root is None:
+            self.add_device_flag(DEVICE_UNREACHABLE)
+            self.fatal("Can't connect to device!")
+        # Everything but the uninstall goes to the device in one go; see
+        # remove_device_root() and remove_etc_hosts().
+        self.info("Removing device root %s." % device_root)
+        commands = ["rm -r %s" % device_root, "ls -d %s" % device_root]
+        hosts_file = "/system/etc/hosts"
+        remove_etc_hosts = c.get("enable_automation") and \
+            c.get("device_type") in ("tegra250",)
+        if remove_etc_hosts:
+            self.info("Removing %s file." % hosts_file)
+            commands += ["mount -o remount,rw -t yaffs2 /dev/block/mtdblock3 /system",
+                         "rm %s" % hosts_file, "ls -d %s" % hosts_file]
+        if c.get("device_package_name"):
+            killall = self.query_device_exe('killall')
+            commands.append("%s %s" % (killall, c["device_package_name"]))
+        outputs = self.run_shell_commands(commands)
+        failed = self._query_failed_shell_commands(commands, outputs)
+        if outputs[1] is None:
+            self.add_device_flag(DEVICE_UNREACHABLE)
+            self.fatal("Can't connect to device!")
+        if failed.intersection([0, 1]) or outputs[1].rstrip() == device_root:
             self.add_device_flag(DEVICE_CANT_REMOVE_DEVROOT)
             self.fatal("Can't remove device root!")
-        if c.get("enable_automation"):
-            self.remove_etc_hosts()
+        if remove_etc_hosts and (failed.intersection([2, 3, 4]) or
+                                 outputs[4].rstrip() == hosts_file):
+            self.add_device_flag(DEVICE_CANT_REMOVE_ETC_HOSTS)
+            self.fatal("Unable to remove %s!" % hosts_file)
         if c.get("device_package_name"):
-            adb = self.query_exe('adb')
-            killall = self.query_device_exe('killall')
-            self.run_command([adb, "-s", device_id, "shell",
-                              killall, c["device_package_name"]],
-                             error_list=ADBErrorList)
             self.uninstall_app(c['device_package_name'])
         if reboot:
             self.reboot_device()
@@ -259,10 +522,7 @@ class ADBDeviceHandler(BaseDeviceHandler):
         if self.device_root:
             return self.device_root
         device_root = None
-        device_id = self.query_device_id()
-        adb = self.query_exe('adb')
-        output = self.get_output_from_command("%s -s %s shell df" % (adb, device_id),
-                                              silent=silent)
+        output = self.query_shell_output("df", silent=silent)
         # TODO this assumes we're connected; error checking?
         if output is None or ' not found' in str(output):
             self.error("Can't get output from 'adb shell df'!\n%s" % output)
@@ -277,24 +537,43 @@ class ADBDeviceHandler(BaseDeviceHandler):
         return self.device_root
 
     # TODO from here on down needs to be copied to Base+SUT
-    def wait_for_device(self, interval=60, max_attempts=20):
+    def wait_for_device(self, interval=60, max_attempts=20, rebooted_at=None):
+        """Wait for the device to answer.  If rebooted_at is when we
+        rebooted it, a device that answers only counts as back once we've
+        seen it go away, or its uptime says it came up since then;
+        otherwise it may not have started rebooting yet.
+        """
         self.info("Waiting for device to come back...")
-        time.sleep(interval)
         tries = 0
-        while tries <= max_attempts:
+        seen_offline = False
+        for sleep in self.query_poll_intervals(interval, max_attempts):
+            time.sleep(sleep)
             tries += 1
             self.info("Try %d" % tries)
-            if self.ping_device(auto_connect=True, silent=True):
-                return self.ping_device()
-            time.sleep(interval)
+            if not self.ping_device(auto_connect=True, silent=True):
+                seen_offline = True
+                continue
+            if rebooted_at is not None and not seen_offline:
+                uptime = self.query_device_uptime(silent=True)
+                if uptime is None or uptime > time.time() - rebooted_at:
+                    self.info("Device hasn't rebooted yet.")
+                    continue
+            return self.ping_device()
         raise DeviceException("Remote Device Error: waiting for device timed out.")
 
+    def query_device_uptime(self, silent=False):
+        """Returns how many seconds the device has been up, or None."""
+        output = self.query_shell_output(self.query_device_exe('uptime'),
+                                         silent=silent)
+        m = UPTIME_REGEX.search(str(output))
+        if not m:
+            return None
+        days, hours, minutes, seconds = m.groups()
+        return ((int(days or 0) * 24 + int(hours)) * 60 + int(minutes)) * 60 + int(seconds)
+
     def query_device_time(self):
-        device_id = self.query_device_id()
-        adb = self.query_exe('adb')
         # adb shell 'date' will give a date string
-        date_string = self.get_output_from_command([adb, "-s", device_id,
-                                                    "shell", "date"])
+        date_string = self.query_shell_output("date")
         # TODO what to do when we error?
         return date_string
 
@@ -312,29 +591,28 @@ class ADBDeviceHandler(BaseDeviceHandler):
         return status
 
     def query_device_file_exists(self, file_name):
-        device_id = self.query_device_id()
-        adb = self.query_exe('adb')
-        output = self.get_output_from_command([adb, "-s", device_id,
-                                               "shell", "ls", "-d", file_name])
+        output = self.query_shell_output("ls -d %s" % file_name)
         if str(output).rstrip() == file_name:
             return True
         return False
 
     def remove_device_root(self, error_level='error'):
         device_root = self.query_device_root()
-        device_id = self.query_device_id()
         if device_root is None:
             self.add_device_flag(DEVICE_UNREACHABLE)
             self.fatal("Can't connect to device!")
-        adb = self.query_exe('adb')
-        if self.query_device_file_exists(device_root):
-            self.info("Removing device root %s." % device_root)
-            self.run_command([adb, "-s", device_id, "shell", "rm",
-                              "-r", device_root], error_list=ADBErrorList)
-            if self.query_device_file_exists(device_root):
-                self.add_device_flag(DEVICE_CANT_REMOVE_DEVROOT)
-                self.log("Unable to remove device root!", level=error_level)
-                return False
+        self.info("Removing device root %s." % device_root)
+        commands = ["rm -r %s" % device_root, "ls -d %s" % device_root]
+        outputs = self.run_shell_commands(commands)
+        failed = self._query_failed_shell_commands(commands, outputs)
+        if outputs[1] is None:
+            self.add_device_flag(DEVICE_UNREACHABLE)
+            self.log("Can't connect to device!", level=error_level)
+            return False
+        if failed or outputs[1].rstrip() == device_root:
+            self.add_device_flag(DEVICE_CANT_REMOVE_DEVROOT)
+            self.log("Unable to remove device root!", level=error_level)
+            return False
         return True
 
     def install_app(self, file_path):
@@ -345,12 +623,8 @@ class ADBDeviceHandler(BaseDeviceHandler):
         if c['enable_automation']:
             self.set_device_time()
         if self._log_level_at_least(DEBUG):
-            self.run_command([adb, "-s", device_id, "shell", "ps"],
-                             error_list=ADBErrorList)
+            self.run_shell_commands(["ps", uptime])
         # TODO dm.getInfo('memory')
-        if self._log_level_at_least(DEBUG):
-            self.run_command([adb, "-s", "shell", uptime],
-                             error_list=ADBErrorList)
         # TODO getResolution ?        # for tegra250:
         # adb shell getprop persist.tegra.dpy3.mode.width
         # adb shell getprop persist.tegra.dpy3.mode.height
@@ -376,10 +650,8 @@ class ADBDeviceHandler(BaseDeviceHandler):
                               file_path],
                              error_list=ADBErrorList)
         else:
-            output = self.get_output_from_command([adb, "-s", device_id,
-                                                   "shell",
-                                                   "ls -d /data/data/%s" %
-                                                   c['device_package_name']])
+            output = self.query_shell_output("ls -d /data/data/%s" %
+                                             c['device_package_name'])
             if output is not None and "No such file" not in output:
                 self.run_command([adb, "-s", device_id, "uninstall",
                                   c['device_package_name']],
@@ -414,17 +686,16 @@ class ADBDeviceHandler(BaseDeviceHandler):
         if c['device_type'] not in ("tegra250",):
             self.debug("No need to remove /etc/hosts on a non-Tegra250.")
             return
-        device_id = self.query_device_id()
         if self.query_device_file_exists(hosts_file):
             self.info("Removing %s file." % hosts_file)
-            adb = self.query_exe('adb')
-            self.run_command([adb, "-s", device_id, "shell",
-                              "mount", "-o", "remount,rw", "-t", "yaffs2",
-                              "/dev/block/mtdblock3", "/system"],
-                             error_list=ADBErrorList)
-            self.run_command([adb, "-s", device_id, "shell", "rm",
-                              hosts_file])
-            if self.query_device_file_exists(hosts_file):
+            commands = ["mount -o remount,rw -t yaffs2 /dev/block/mtdblock3 /system",
+                        "rm %s" % hosts_file, "ls -d %s" % hosts_file]
+            outputs = self.run_shell_commands(commands)
+            failed = self._query_failed_shell_commands(commands, outputs)
+            if outputs[2] is None:
+                self.add_device_flag(DEVICE_UNREACHABLE)
+                self.fatal("Can't connect to device!")
+            if failed or outputs[2].rstrip() == hosts_file:
                 self.add_device_flag(DEVICE_CANT_REMOVE_ETC_HOSTS)
                 self.fatal("Unable to remove %s!" % hosts_file)
         else:
@@ -473,16 +744,15 @@ class SUTDeviceHandler(BaseDeviceHandler):
 
     def wait_for_device(self, interval=60, max_attempts=20):
         self.info("Waiting for device to come back...")
-        time.sleep(interval)
         success = False
         attempts = 0
-        while attempts <= max_attempts:
+        for sleep in self.query_poll_intervals(interval, max_attempts):
+            time.sleep(sleep)
             attempts += 1
             self.info("Try %d" % attempts)
             if self.query_device_root() is not None:
                 success = True
                 break
-            time.sleep(interval)
         if not success:
             self.add_device_flag(DEVICE_UNREACHABLE)
             self.fatal("Waiting for tegra timed out.")
@@ -718,18 +988,26 @@ device_config_options = [[
 class DeviceMixin(object):
     '''BaseScript mixin, designed to interface with the device.
 
+    To look after several devices at once, list them in
+    self.config['devices'], each as a dict of config overrides (e.g.
+    device_id or device_ip), and use check_devices(), cleanup_devices()
+    and reboot_devices().
     '''
     device_handler = None
+    device_handlers = None
     device_root = None
 
-    def query_device_handler(self):
-        if self.device_handler:
-            return self.device_handler
-        c = self.config
-        device_protocol = c.get('device_protocol')
+    def _query_device_class(self):
+        device_protocol = self.config.get('device_protocol')
         device_class = DEVICE_PROTOCOL_DICT.get(device_protocol)
         if not device_class:
             self.fatal("Unknown device_protocol %s; set via --device-protocol!" % str(device_protocol))
+        return device_class
+
+    def query_device_handler(self):
+        if self.device_handler:
+            return self.device_handler
+        device_class = self._query_device_class()
         self.device_handler = device_class(
             log_obj=self.log_obj,
             config=self.config,
@@ -737,6 +1015,111 @@ class DeviceMixin(object):
         )
         return self.device_handler
 
+    def query_device_handlers(self):
+        """Returns a (name, device handler) pair for each device in
+        self.config['devices'], or just for query_device_handler() if
+        that's not set.  Each handler logs with its device's name in
+        front.
+        """
+        if self.device_handlers:
+            return self.device_handlers
+        c = self.config
+        if not c.get('devices'):
+            dh = self.query_device_handler()
+            name = dh.device_id or c.get('device_id') or c.get('device_ip') or 'device'
+            self.device_handlers = [(name, dh)]
+            return self.device_handlers
+        device_class = self._query_device_class()
+        device_handlers = []
+        for device_config in c['devices']:
+            config = dict(c.items() + device_config.items())
+            name = config.get('device_id') or config.get('device_ip') or \
+                'device %d' % (len(device_handlers) + 1)
+            log_obj = self.log_obj
+            if log_obj:
+                log_obj = PrefixLogger(log_obj, "%s: " % name)
+            dh = device_class(
+                log_obj=log_obj,
+                config=config,
+                script_obj=self,
+            )
+            device_handlers.append((name, dh))
+        self.device_handlers = device_handlers
+        return self.device_handlers
+
+    def run_on_devices(self, operation, *args, **kwargs):
+        """Call operation(*args, **kwargs) on each device's handler, all
+        devices at once, and return a status report with a dict per
+        device:
+
+            {'device': name, 'operation': operation,
+             'status': 'ok' or 'failed', 'error': why it failed or None,
+             'flags': names of the device's flags, 'duration': seconds}
+
+        A device fails if the operation returns False or raises
+        DeviceException; the other devices carry on either way.  A
+        handler's fatal() raises DeviceException here rather than exiting,
+        so it's up to the caller whether a failed device is fatal.
+        """
+        device_handlers = self.query_device_handlers()
+
+        def run(device_handler):
+            name, dh = device_handler
+            start_time = time.time()
+            status = 'ok'
+            error = None
+            dh.raise_on_fatal = True
+            try:
+                if getattr(dh, operation)(*args, **kwargs) is False:
+                    status = 'failed'
+                    error = '%s failed' % operation
+            except DeviceException, e:
+                status = 'failed'
+                error = str(e)
+            finally:
+                dh.raise_on_fatal = False
+            return {
+                'device': name,
+                'operation': operation,
+                'status': status,
+                'error': error,
+                'flags': [DEVICE_FLAG_NAMES.get(f, str(f)) for f in dh.device_flags],
+                'duration': time.time() - start_time,
+            }
+
+        pool = ThreadPool(len(device_handlers))
+        try:
+            report = pool.map(run, device_handlers)
+        finally:
+            pool.close()
+            pool.join()
+        for device_status in report:
+            message = "%(device)s: %(operation)s %(status)s after %(duration)ds" % device_status
+            if device_status['flags']:
+                message += "; flags: %s" % ', '.join(device_status['flags'])
+            if device_status['status'] == 'ok':
+                self.info(message)
+            else:
+                self.error("%s: %s" % (message, device_status['error']))
+        return report
+
+    def query_device_flags(self):
+        """Returns the flags of all the devices together.
+        """
+        flags = set()
+        for name, dh in self.query_device_handlers():
+            flags.update(dh.device_flags)
+        return sorted(flags)
+
+    def check_devices(self):
+        return self.run_on_devices('check_device')
+
+    def cleanup_devices(self, **kwargs):
+        return self.run_on_devices('cleanup_device', **kwargs)
+
+    def reboot_devices(self):
+        return self.run_on_devices('reboot_device')
+
     def check_device(self):
         dh = self.query_device_handler()
         return dh.check_device()
@@ -59,6 +59,12 @@ testing_config_options = [
      "choices": ['ondemand', 'true'],
      "help": "Download and extract crash reporter symbols.",
       }],
+    [["--extract-while-downloading"],
+     {"action": "store_true",
+     "dest": "extract_while_downloading",
+     "default": False,
+     "help": "Extract the test zip and symbols while they're downloading.",
+      }],
 ] + copy.deepcopy(virtualenv_config_options)
 
 
@@ -211,28 +217,36 @@ You can set this by:
         dirs = self.query_abs_dirs()
         zipfile = self.download_file(url, parent_dir=dirs['abs_work_dir'],
                                      error_level=FATAL)
-        command = self.query_exe('unzip', return_type='list')
-        command.extend(['-q', '-o', zipfile])
-        self.run_command(command, cwd=parent_dir, halt_on_failure=True,
-                         fatal_exit_code=3, output_timeout=1760)
+        if self.extract_zip(zipfile, parent_dir):
+            self.fatal("Unable to extract %s!" % zipfile, exit_code=3)
+
+    def _download_and_extract_test_zip(self, target_unzip_dirs=None):
+        """Like _download_test_zip() + _extract_test_zip(), but both at
+        the same time."""
+        dirs = self.query_abs_dirs()
+        file_name = self.test_zip_path
+        if not file_name:
+            file_name = os.path.join(dirs['abs_work_dir'],
+                                     self.get_filename_from_url(self.test_url))
+        test_install_dir = dirs.get('abs_test_install_dir',
+                                    os.path.join(dirs['abs_work_dir'], 'tests'))
+        if self.download_and_unpack(self.test_url, file_name, test_install_dir,
+                                    members=target_unzip_dirs) not in (0, 11):
+            self.fatal("Unable to download and extract %s!" % self.test_url,
+                       exit_code=3)
+        self.test_zip_path = os.path.realpath(file_name)
 
     def _extract_test_zip(self, target_unzip_dirs=None):
         dirs = self.query_abs_dirs()
-        unzip = self.query_exe("unzip")
         test_install_dir = dirs.get('abs_test_install_dir',
                                     os.path.join(dirs['abs_work_dir'], 'tests'))
         self.mkdir_p(test_install_dir)
-        # adding overwrite flag otherwise subprocess.Popen hangs on waiting for
-        # input in a hidden pipe whenever this action is run twice without
-        # clobber
-        unzip_cmd = [unzip, '-q', '-o', self.test_zip_path]
-        if target_unzip_dirs:
-            unzip_cmd.extend(target_unzip_dirs)
-        # TODO error_list
-        # unzip return code 11 is 'no matching files were found'
-        self.run_command(unzip_cmd, cwd=test_install_dir,
-                         halt_on_failure=True, success_codes=[0, 11],
-                         fatal_exit_code=3)
+        # target_unzip_dirs are unzip-style globs; 11 means none matched,
+        # which is fine.  Files left over from a previous run without
+        # clobber are only rewritten if they changed.
+        if self.extract_zip(self.test_zip_path, test_install_dir,
+                            members=target_unzip_dirs) not in (0, 11):
+            self.fatal("Unable to extract %s!" % self.test_zip_path, exit_code=3)
 
     def _read_tree_config(self):
         """Reads an in-tree config file"""
@@ -280,13 +294,20 @@ You can set this by:
         if not self.symbols_path:
             self.symbols_path = os.path.join(dirs['abs_work_dir'], 'symbols')
         self.mkdir_p(self.symbols_path)
-        source = self.download_file(self.symbols_url,
-                                    parent_dir=self.symbols_path,
-                                    error_level=FATAL)
+        if self.config.get('extract_while_downloading'):
+            source = os.path.join(self.symbols_path,
+                                  self.get_filename_from_url(self.symbols_url))
+            status = self.download_and_unpack(self.symbols_url, source,
+                                              self.symbols_path)
+        else:
+            source = self.download_file(self.symbols_url,
+                                        parent_dir=self.symbols_path,
+                                        error_level=FATAL)
+            status = self.extract_zip(source, self.symbols_path)
         self.set_buildbot_property("symbols_url", self.symbols_url,
                                    write_to_file=True)
-        self.run_command(['unzip', '-q', source], cwd=self.symbols_path,
-                         halt_on_failure=True, fatal_exit_code=3)
+        if status:
+            self.fatal("Unable to extract %s!" % source, exit_code=3)
 
     def download_and_extract(self, target_unzip_dirs=None):
         """
@@ -304,8 +325,11 @@ You can set this by:
                 setattr(self, attr, new_url)
 
         if self.test_url:
-            self._download_test_zip()
-            self._extract_test_zip(target_unzip_dirs=target_unzip_dirs)
+            if self.config.get('extract_while_downloading'):
+                self._download_and_extract_test_zip(target_unzip_dirs=target_unzip_dirs)
+            else:
+                self._download_test_zip()
+                self._extract_test_zip(target_unzip_dirs=target_unzip_dirs)
             self._read_tree_config()
         self._download_installer()
         if self.config.get('download_symbols'):
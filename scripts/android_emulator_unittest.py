@@ -18,19 +18,21 @@ import tempfile
 # load modules from parent dir
 sys.path.insert(1, os.path.dirname(sys.path[0]))
 
-from mozharness.base.log import FATAL
-from mozharness.base.script import BaseScript
+from mozharness.base.log import FATAL, PrefixLogger
+from mozharness.base.parallel import ParallelMixin
+from mozharness.base.script import BaseScript, OutputPump
 from mozharness.base.vcs.vcsbase import VCSMixin
 from mozharness.mozilla.blob_upload import BlobUploadMixin, blobupload_config_options
-from mozharness.mozilla.buildbot import TBPL_WORST_LEVEL_TUPLE
+from mozharness.mozilla.buildbot import TBPL_RETRY, TBPL_WORST_LEVEL_TUPLE
 from mozharness.mozilla.testing.testbase import TestingMixin, testing_config_options
 from mozharness.mozilla.testing.unittest import DesktopUnittestOutputParser, EmulatorMixin
 from mozharness.mozilla.tooltool import TooltoolMixin
 
-from mozharness.mozilla.testing.device import ADBDeviceHandler
+from mozharness.mozilla.testing.device import ADBDeviceHandler, DeviceMixin
 
 
-class AndroidEmulatorTest(BlobUploadMixin, TestingMixin, TooltoolMixin, EmulatorMixin, VCSMixin, BaseScript):
+class AndroidEmulatorTest(BlobUploadMixin, TestingMixin, TooltoolMixin, EmulatorMixin, VCSMixin,
+                          DeviceMixin, ParallelMixin, BaseScript):
     config_options = [[
         ["--robocop-url"],
         {"action": "store",
@@ -92,6 +94,20 @@ class AndroidEmulatorTest(BlobUploadMixin, TestingMixin, TooltoolMixin, Emulator
                              'install',
                              'run-tests',
                              'stop-emulators'],
+            # Booting the emulators takes minutes and doesn't need the
+            # build or the tests, so it runs alongside fetching those.
+            # create-virtualenv activates the virtualenv process-wide and
+            # starts the resource monitor, so it waits for both.
+            action_dependencies={
+                'download-cacheable-artifacts': ['clobber'],
+                'setup-avds': ['download-cacheable-artifacts'],
+                'start-emulators': ['setup-avds'],
+                'download-and-extract': ['clobber', 'read-buildbot-config'],
+                'create-virtualenv': ['download-and-extract', 'start-emulators'],
+                'install': ['start-emulators', 'download-and-extract'],
+                'run-tests': ['install', 'create-virtualenv'],
+                'stop-emulators': ['run-tests'],
+            },
             require_config_file=require_config_file,
             config={
                 'virtualenv_modules': self.virtualenv_modules,
@@ -153,11 +169,16 @@ class AndroidEmulatorTest(BlobUploadMixin, TestingMixin, TooltoolMixin, Emulator
             return []
         return [str(option), str(value)]
 
-    def _redirectSUT(self, emulator_index):
+    def _redirectSUT(self, emulator_index, timeout=None):
         '''
         This redirects the default SUT ports for a given emulator.
         This is needed if more than one emulator is started.
+
+        We keep trying to reach the emulator's console for up to timeout
+        seconds (self.config.get('emulator_redirect_timeout', 150)).
         '''
+        if timeout is None:
+            timeout = self.config.get('emulator_redirect_timeout', 150)
         emulator = self.emulators[emulator_index]
         emuport = emulator["emulator_port"]
         sutport1 = emulator["sut_port1"]
@@ -165,13 +186,8 @@ class AndroidEmulatorTest(BlobUploadMixin, TestingMixin, TooltoolMixin, Emulator
         attempts = 0
         tn = None
         redirect_completed = False
-        while attempts < 5:
-            if attempts == 0:
-                self.info("Sleeping 10 seconds")
-                time.sleep(10)
-            else:
-                self.info("Sleeping 30 seconds")
-                time.sleep(30)
+        deadline = time.time() + timeout
+        while True:
             attempts += 1
             self.info("  Attempt #%d to redirect ports: (%d, %d, %d)" %
                       (attempts, emuport, sutport1, sutport2))
@@ -179,8 +195,11 @@ class AndroidEmulatorTest(BlobUploadMixin, TestingMixin, TooltoolMixin, Emulator
                 tn = telnetlib.Telnet('localhost', emuport, 300)
                 break
             except socket.error, e:
-                self.info("Trying again after exception: %s" % str(e))
-                pass
+                if time.time() + 5 > deadline:
+                    self.info("Giving up after exception: %s" % str(e))
+                    break
+                self.info("Trying again in 5 seconds after exception: %s" % str(e))
+                time.sleep(5)
 
         if tn is not None:
             res = tn.read_until('OK')
@@ -229,6 +248,41 @@ class AndroidEmulatorTest(BlobUploadMixin, TestingMixin, TooltoolMixin, Emulator
             "tmp_stdout": tmp_stdout
         }
 
+    def _start_emulator(self, emulator_index):
+        '''
+        Launch an emulator and redirect its SUT ports.  If we can't, kill
+        just this emulator and launch it again, up to
+        self.config.get('emulator_launch_attempts', 3) times.
+
+        The emulators intermittently fail to respond to telnet connections
+        right after startup: bug 949740.  In this case, the emulator log
+        shows "ioctl(KVM_CREATE_VM) failed: Interrupted system call".  We
+        do not know how to avoid this error and the only way we have found
+        to recover is to kill the emulator and start again.
+
+        Returns the emulator process dict, or None if we never managed.
+        '''
+        emulator = self.emulators[emulator_index]
+        attempts = self.config.get('emulator_launch_attempts', 3)
+        start_time = time.time()
+        for attempt in range(1, attempts + 1):
+            if attempt > 1:
+                self.info("Sleeping 30 seconds before retry")
+                time.sleep(30)
+            self.info('Attempt #%d to launch %s...' % (attempt, emulator["name"]))
+            emulator_proc = self._launch_emulator(emulator_index)
+            if self._redirectSUT(emulator_index):
+                self.info("%s: %s; sut port: %s/%s" %
+                          (emulator["name"], emulator["emulator_port"], emulator["sut_port1"], emulator["sut_port2"]))
+                self.record_resource_timing("%s startup" % emulator["name"],
+                                            time.time() - start_time)
+                return emulator_proc
+            self._dump_emulator_log(emulator_index, emulator_proc)
+            self.info("Killing %s" % emulator["name"])
+            emulator_proc["process"].kill()
+            emulator_proc["process"].wait()
+        return None
+
     def _check_emulator(self, emulator):
         self.info('Checking emulator %s' % emulator["name"])
 
@@ -323,10 +377,12 @@ class AndroidEmulatorTest(BlobUploadMixin, TestingMixin, TooltoolMixin, Emulator
         out, err = p.communicate()
         self.info('%s:\n%s\n%s' % (ps_cmd, out, err))
 
-    def _dump_emulator_log(self, emulator_index):
+    def _dump_emulator_log(self, emulator_index, emulator_proc=None):
         emulator = self.emulators[emulator_index]
+        if emulator_proc is None:
+            emulator_proc = self.emulator_procs[emulator_index]
         self.info("##### %s emulator log begins" % emulator["name"])
-        output = self.read_from_file(self.emulator_procs[emulator_index]["tmp_file"].name, verbose=False)
+        output = self.read_from_file(emulator_proc["tmp_file"].name, verbose=False)
         if output:
             self.info(output)
         self.info("##### %s emulator log ends" % emulator["name"])
@@ -424,9 +480,10 @@ class AndroidEmulatorTest(BlobUploadMixin, TestingMixin, TooltoolMixin, Emulator
         Run a test suite on an emulator
 
         We return a dictionary with the following information:
-         - subprocess object that is running the test on the emulator
-         - the filename where the stdout is going to
-         - the stdout where the output is going to
+         - subprocess object that is running the test on the emulator,
+           with its stdout and stderr on a pipe
+         - the parser for that output, which logs each line with the
+           suite name in front of it
          - the suite name that is associated
         """
         dirs = self.query_abs_dirs()
@@ -443,13 +500,15 @@ class AndroidEmulatorTest(BlobUploadMixin, TestingMixin, TooltoolMixin, Emulator
         env['MINIDUMP_SAVE_PATH'] = self.query_abs_dirs()['abs_blob_upload_dir']
 
         self.info("Running on %s the command %s" % (self.emulators[emulator_index]["name"], subprocess.list2cmdline(cmd)))
-        tmp_file = tempfile.NamedTemporaryFile(mode='w')
-        tmp_stdout = open(tmp_file.name, 'w')
-        self.info("Created temp file %s." % tmp_file.name)
+        parser = DesktopUnittestOutputParser(
+            suite_category=self.test_suite_definitions[suite_name]["category"],
+            config=self.config,
+            log_obj=PrefixLogger(self.log_obj, "%s: " % suite_name),
+            error_list=self.error_list)
         return {
-            "process": subprocess.Popen(cmd, cwd=cwd, stdout=tmp_stdout, stderr=tmp_stdout, env=env),
-            "tmp_file": tmp_file,
-            "tmp_stdout": tmp_stdout,
+            "process": subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT, env=env),
+            "parser": parser,
             "suite_name": suite_name,
             "emulator_index": emulator_index
         }
@@ -473,18 +532,73 @@ class AndroidEmulatorTest(BlobUploadMixin, TestingMixin, TooltoolMixin, Emulator
                 file_url = os.path.join(c["tooltool_url"], file_shasum)
                 self.download_file(file_url, file_path, c["tooltool_cache_path"])
 
+    def _query_avd_template_dir(self):
+        '''
+        Returns a directory with the AVD templates unpacked, from
+        avd_template_cache_dir, or None if we don't keep them.
+
+        Templates are keyed by the shasum of the AVD tar ball in the
+        tooltool manifest, so a new tar ball gets a new template; the
+        avd_template_cache_keep most recently used ones are kept.
+        '''
+        c = self.config
+        cache_dir = c.get("avd_template_cache_dir")
+        if not cache_dir:
+            return None
+        avd_tar_ball, avd_shasum = c["tooltool_cacheable_artifacts"]["avd_tar_ball"][:2]
+        template_dir = os.path.join(cache_dir, avd_shasum)
+        if os.path.isdir(template_dir):
+            self.info("Using AVD templates in %s" % template_dir)
+            os.utime(template_dir, None)
+            return template_dir
+
+        self.info("Caching AVD templates from %s in %s" % (avd_tar_ball, template_dir))
+        self.mkdir_p(cache_dir)
+        tmp_dir = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp-')
+        try:
+            self.unpack(os.path.join(c["tooltool_cache_path"], avd_tar_ball), tmp_dir)
+            try:
+                os.rename(tmp_dir, template_dir)
+            except OSError:
+                # Another job on this host beat us to it.
+                if not os.path.isdir(template_dir):
+                    raise
+        finally:
+            if os.path.exists(tmp_dir):
+                self.rmtree(tmp_dir)
+
+        templates = [os.path.join(cache_dir, d) for d in os.listdir(cache_dir)
+                     if not d.startswith('.')]
+        templates.sort(key=os.path.getmtime, reverse=True)
+        for old_template_dir in templates[c.get("avd_template_cache_keep", 2):]:
+            if old_template_dir != template_dir:
+                self.rmtree(old_template_dir)
+        return template_dir
+
     def setup_avds(self):
         '''
         We have a tar ball in ToolTool with the pristine templates.
-        Let's unpack them every time.
+        Let's unpack them every time, or, if avd_template_cache_dir is
+        set, copy them from a copy we unpacked there before.
         '''
         c = self.config
+        start_time = time.time()
         self.rmtree(c[".avds_dir"])
-        avd_tar_ball_path = os.path.join(
-            c["tooltool_cache_path"],
-            c["tooltool_cacheable_artifacts"]["avd_tar_ball"][0])
-        self.mkdir_p(c[".avds_dir"])
-        self.unpack(avd_tar_ball_path, c[".avds_dir"])
+        template_dir = self._query_avd_template_dir()
+        if template_dir:
+            # On filesystems that support it, the images are shared
+            # copy-on-write with the template.
+            self.mkdir_p(c[".avds_dir"])
+            self.run_command(["cp", "-a", "--reflink=auto",
+                              os.path.join(template_dir, "."), c[".avds_dir"]],
+                             halt_on_failure=True)
+        else:
+            avd_tar_ball_path = os.path.join(
+                c["tooltool_cache_path"],
+                c["tooltool_cacheable_artifacts"]["avd_tar_ball"][0])
+            self.mkdir_p(c[".avds_dir"])
+            self.unpack(avd_tar_ball_path, c[".avds_dir"])
+        self.record_resource_timing("setup-avds", time.time() - start_time)
 
     def start_emulators(self):
         '''
@@ -514,46 +628,32 @@ class AndroidEmulatorTest(BlobUploadMixin, TestingMixin, TooltoolMixin, Emulator
                 os.symlink(libfile, linkfile)
                 break
 
-        attempts = 0
-        redirect_failed = True
-        # Launch the required emulators and redirect the SUT ports for each. If unable
-        # to redirect the SUT ports, kill the emulators and try starting them again.
-        # The wait-and-retry logic is necessary because the emulators intermittently fail
-        # to respond to telnet connections immediately after startup: bug 949740. In this
-        # case, the emulator log shows "ioctl(KVM_CREATE_VM) failed: Interrupted system call".
-        # We do not know how to avoid this error and the only way we have found to
-        # recover is to kill the emulator and start again.
-        while attempts < 3 and redirect_failed:
-            if attempts > 0:
-                self.info("Sleeping 30 seconds before retry")
-                time.sleep(30)
-            attempts += 1
-            self.info('Attempt #%d to launch emulators...' % attempts)
-            self.emulator_procs = []
-            emulator_index = 0
-            redirect_failed = False
-            for test in self.test_suites:
-                emulator_proc = self._launch_emulator(emulator_index)
-                self.emulator_procs.append(emulator_proc)
-                if self._redirectSUT(emulator_index):
-                    emulator = self.emulators[emulator_index]
-                    self.info("%s: %s; sut port: %s/%s" %
-                              (emulator["name"], emulator["emulator_port"], emulator["sut_port1"], emulator["sut_port2"]))
-                    emulator_index += 1
-                else:
-                    self._dump_emulator_log(emulator_index)
-                    self._kill_processes(self.config["emulator_process_name"])
-                    redirect_failed = True
-                    break
-        if redirect_failed:
+        # Boot all the emulators at once; one that doesn't come up is
+        # relaunched on its own.
+        self.query_env()
+        start_time = time.time()
+        emulator_indexes = range(len(self.test_suites))
+        self.emulator_procs = [None] * len(emulator_indexes)
+        for emulator_index, emulator_proc in self.run_in_parallel(
+                self._start_emulator, emulator_indexes,
+                num_workers=len(emulator_indexes)):
+            self.emulator_procs[emulator_index] = emulator_proc
+        if None in self.emulator_procs:
             self.fatal('We have not been able to establish a telnet connection with the emulator')
 
         # Verify that we can communicate with each emulator
-        emulator_index = 0
-        for test in self.test_suites:
-            emulator = self.emulators[emulator_index]
-            emulator_index += 1
-            self._check_emulator(emulator)
+        for _ in self.run_in_parallel(
+                lambda emulator_index: self._check_emulator(self.emulators[emulator_index]),
+                emulator_indexes, num_workers=len(emulator_indexes)):
+            pass
+        # ... and that adb can reach each one.
+        failed = [d['device'] for d in self.check_devices() if d['status'] != 'ok']
+        for name, dh in self.query_device_handlers():
+            dh.close_shell_session()
+        if failed:
+            self.fatal("adb can't reach %s!" % ', '.join(failed))
+        self.record_resource_timing("start-emulators", time.time() - start_time)
+
         # Start logcat for each emulator. Each adb process runs until the
         # corresponding emulator is killed. Output is written directly to
         # the blobber upload directory so that it is uploaded automatically
@@ -586,94 +686,129 @@ class AndroidEmulatorTest(BlobUploadMixin, TestingMixin, TooltoolMixin, Emulator
         self.mkdir_p(dirs['abs_xre_dir'])
         self._download_unzip(self.host_utils_url, dirs['abs_xre_dir'])
 
-    def install(self):
-        assert self.installer_path is not None, \
-            "Either add installer_path to the config or use --installer-path."
+    def query_device_handlers(self):
+        """
+        One ADBDeviceHandler per emulator we run tests on, for
+        DeviceMixin.run_on_devices().
+        """
+        if self.device_handlers:
+            return self.device_handlers
+        self.device_handlers = []
+        for emulator in self.emulators[:len(self.test_suites)]:
+            config = dict(self.config.items() + [('device_id', emulator['device_id'])])
+            dh = ADBDeviceHandler(
+                config=config,
+                log_obj=PrefixLogger(self.log_obj, "%s: " % emulator['name']))
+            dh.device_id = emulator['device_id']
+            self.device_handlers.append((emulator['name'], dh))
+        return self.device_handlers
 
-        emulator_index = 0
-        for suite_name in self.test_suites:
-            emulator = self.emulators[emulator_index]
-            emulator_index += 1
+    def _install_apps(self, emulator_index):
+        emulator = self.emulators[emulator_index]
+        suite_name = self.test_suites[emulator_index]
 
-            config = {
-                'device-id': emulator["device_id"],
-                'enable_automation': True,
-                'device_package_name': self._query_package_name()
-            }
-            config = dict(config.items() + self.config.items())
+        config = {
+            'device-id': emulator["device_id"],
+            'enable_automation': True,
+            'device_package_name': self._query_package_name()
+        }
+        config = dict(config.items() + self.config.items())
 
-            self.info("Creating ADBDevicHandler for %s with config %s" % (emulator["name"], config))
-            dh = ADBDeviceHandler(config=config, log_obj=self.log_obj)
-            dh.device_id = emulator['device_id']
+        self.info("Creating ADBDevicHandler for %s with config %s" % (emulator["name"], config))
+        dh = ADBDeviceHandler(config=config, log_obj=self.log_obj)
+        dh.device_id = emulator['device_id']
 
-            # Install Fennec
-            self.info("Installing Fennec for %s" % emulator["name"])
-            dh.install_app(self.installer_path)
+        # Install Fennec
+        self.info("Installing Fennec for %s" % emulator["name"])
+        dh.install_app(self.installer_path)
 
-            # Install the robocop apk if required
-            if suite_name.startswith('robocop'):
-                self.info("Installing Robocop for %s" % emulator["name"])
-                config['device_package_name'] = self.config["robocop_package_name"]
-                dh.install_app(self.robocop_path)
+        # Install the robocop apk if required
+        if suite_name.startswith('robocop'):
+            self.info("Installing Robocop for %s" % emulator["name"])
+            config['device_package_name'] = self.config["robocop_package_name"]
+            dh.install_app(self.robocop_path)
+        dh.close_shell_session()
 
-            self.info("Finished installing apps for %s" % emulator["name"])
+        self.info("Finished installing apps for %s" % emulator["name"])
+
+    def install(self):
+        """
+        Install the apps on all the emulators at once.
+        """
+        assert self.installer_path is not None, \
+            "Either add installer_path to the config or use --installer-path."
+
+        # Unzips the apk; do it before the threads need it.
+        self._query_package_name()
+        emulator_indexes = range(len(self.test_suites))
+        for _ in self.run_in_parallel(self._install_apps, emulator_indexes,
+                                      num_workers=len(emulator_indexes)):
+            pass
+
+    def _parse_test_output(self, p, lines):
+        """
+        Parse lines of a suite's output as they arrive, and say so right
+        away if the harness has asked for a retry or the app crashed.
+        """
+        parser = p["parser"]
+        for line in lines:
+            parser.parse_single_line(line)
+        if parser.tbpl_status == TBPL_RETRY and not p.get("retry_reported"):
+            p["retry_reported"] = True
+            self.warning("%s: the harness asked for a retry." % p["suite_name"])
+        if parser.crashed and not p.get("crash_reported"):
+            p["crash_reported"] = True
+            self.warning("%s: the application crashed." % p["suite_name"])
 
     def run_tests(self):
         """
         Run the tests
+
+        Every suite's output is parsed (and logged, with the suite name in
+        front) as it arrives; each suite is done as soon as it exits.
         """
         procs = []
+        pump = OutputPump()
 
         emulator_index = 0
         for suite_name in self.test_suites:
-            procs.append(self._trigger_test(suite_name, emulator_index))
+            p = self._trigger_test(suite_name, emulator_index)
+            pump.add_stream(p["process"].stdout,
+                            lambda lines, p=p: self._parse_test_output(p, lines))
+            procs.append(p)
             emulator_index += 1
 
         joint_tbpl_status = None
         joint_log_level = None
-        start_time = int(time.time())
-        while True:
-            for p in procs:
-                emulator_index = p["emulator_index"]
+        last_output = time.time()
+        while procs:
+            if pump.pump(timeout=1):
+                last_output = time.time()
+            for p in procs[:]:
                 return_code = p["process"].poll()
-                if return_code is not None:
-                    suite_name = p["suite_name"]
-                    # To make reading the log of the suite not mix with the previous line
-                    sys.stdout.write('\n')
-                    self.info("##### %s log begins" % p["suite_name"])
-                    # Let's close the stdout
-                    p["tmp_stdout"].close()
-                    # Let's read the file that now has the output
-                    output = self.read_from_file(p["tmp_file"].name, verbose=False)
-                    # Let's parse the output (which also prints it)
-                    # and determine what the results should be
-                    parser = DesktopUnittestOutputParser(
-                        suite_category=self.test_suite_definitions[p["suite_name"]]["category"],
-                        config=self.config,
-                        log_obj=self.log_obj,
-                        error_list=self.error_list)
-                    for line in output.splitlines():
-                        parser.parse_single_line(line)
-
-                    # After parsing each line we should know what the summary for this suite should be
-                    tbpl_status, log_level = parser.evaluate_parser(return_code)
-                    parser.append_tinderboxprint_line(p["suite_name"])
-                    # After running all jobs we will report the worst status of all emulator runs
-                    joint_tbpl_status = self.worst_level(tbpl_status, joint_tbpl_status, TBPL_WORST_LEVEL_TUPLE)
-                    joint_log_level = self.worst_level(log_level, joint_log_level)
-
-                    self.info("##### %s log ends" % p["suite_name"])
-                    self._dump_emulator_log(emulator_index)
-                    procs.remove(p)
-            if procs == []:
-                break
-            else:
-                # Every 5 minutes let's print something to stdout
-                # so buildbot won't kill the process due to lack of output
-                if int(time.time()) - start_time > 5 * 60:
-                    self.info('#')
-                    start_time = int(time.time())
-                time.sleep(30)
+                if return_code is None:
+                    continue
+                # Whatever the suite wrote before it exited; anything it
+                # started may still have the pipe open, so don't wait for EOF.
+                pump.remove_stream(p["process"].stdout)
+                p["process"].stdout.close()
+                parser = p["parser"]
+                self.info("##### %s exited with return code %d" % (p["suite_name"], return_code))
+
+                # After parsing each line we should know what the summary for this suite should be
+                tbpl_status, log_level = parser.evaluate_parser(return_code)
+                parser.append_tinderboxprint_line(p["suite_name"])
+                # After running all jobs we will report the worst status of all emulator runs
+                joint_tbpl_status = self.worst_level(tbpl_status, joint_tbpl_status, TBPL_WORST_LEVEL_TUPLE)
+                joint_log_level = self.worst_level(log_level, joint_log_level)
+
+                self._dump_emulator_log(p["emulator_index"])
+                procs.remove(p)
+            # If the suites are quiet for 5 minutes, let's print something
+            # to stdout so buildbot won't kill the process due to lack of output
+            if procs and time.time() - last_output > 5 * 60:
+                self.info('#')
+                last_output = time.time()
 
         self.buildbot_status(joint_tbpl_status, level=joint_log_level)
 
@@ -681,11 +816,11 @@ class AndroidEmulatorTest(BlobUploadMixin, TestingMixin, TooltoolMixin, Emulator
         '''
         Report emulator health, then make sure that every emulator has been stopped
         '''
-        emulator_index = 0
-        for test in self.test_suites:
-            emulator = self.emulators[emulator_index]
-            emulator_index += 1
-            self._check_emulator(emulator)
+        emulator_indexes = range(len(self.test_suites))
+        for _ in self.run_in_parallel(
+                lambda emulator_index: self._check_emulator(self.emulators[emulator_index]),
+                emulator_indexes, num_workers=len(emulator_indexes)):
+            pass
         self._kill_processes(self.config["emulator_process_name"])
 
 if __name__ == '__main__':
@@ -15,10 +15,12 @@
     which appears on TBPL, so sheriffs can blame the appropriate changes.
 """
 
+import hashlib
 import os
 import sys
 from multiprocessing.pool import ThreadPool
 import subprocess
+import tempfile
 import time
 from urlparse import urlparse
 try:
@@ -79,8 +81,10 @@ class B2GBumper(VCSScript, MapperMixin):
         # Mapping of device name to manifest
         self.device_manifests = {}
 
-        # Cache of (remote url, refname) to revision hashes
-        self._git_ref_cache = {}
+        # Cache of remote url to [(refname, revision hash)]
+        self._remote_refs = {}
+        # Remotes whose refs came from the on-disk cache
+        self._cached_remotes = set()
 
         # Cache of new remotes to original upstreams
         self._remote_mappings = {}
@@ -105,6 +109,9 @@ class B2GBumper(VCSScript, MapperMixin):
             'gecko_local_dir':
             os.path.join(abs_dirs['abs_work_dir'],
                          self.config['gecko_local_dir']),
+            'abs_git_ref_cache_dir':
+            self.config.get('git_ref_cache_dir',
+                            os.path.join(abs_dirs['abs_work_dir'], 'git_ref_cache')),
         })
         self.abs_dirs = abs_dirs
         return self.abs_dirs
@@ -142,32 +149,132 @@ class B2GBumper(VCSScript, MapperMixin):
             return m
         repo_manifest.rewrite_remotes(manifest, mapping_func)
 
-    def resolve_git_ref(self, remote_url, revision):
-        cmd = ['git', 'ls-remote', remote_url, revision]
+    def _query_remote_refs_cache_path(self, remote_url):
+        dirs = self.query_abs_dirs()
+        return os.path.join(dirs['abs_git_ref_cache_dir'],
+                            '%s.json' % hashlib.sha1(remote_url).hexdigest())
+
+    def _read_remote_refs_cache(self, remote_url):
+        """ Returns the refs on remote_url we cached on disk less than
+            self.config['git_ref_cache_ttl'] seconds ago, or None.
+            """
+        ttl = self.config.get('git_ref_cache_ttl', 120)
+        if not ttl:
+            return None
+        try:
+            fh = open(self._query_remote_refs_cache_path(remote_url))
+            try:
+                cached = json.load(fh)
+            finally:
+                fh.close()
+        except (IOError, ValueError):
+            return None
+        if cached.get('url') != remote_url or \
+                not 0 <= time.time() - cached.get('time', 0) <= ttl:
+            return None
+        return [tuple(r) for r in cached['refs']]
+
+    def _write_remote_refs_cache(self, remote_url, refs):
+        path = self._query_remote_refs_cache_path(remote_url)
+        try:
+            self.mkdir_p(os.path.dirname(path))
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            fh = os.fdopen(fd, 'w')
+            try:
+                json.dump({'url': remote_url, 'time': time.time(), 'refs': refs}, fh)
+            finally:
+                fh.close()
+            os.rename(tmp_path, path)
+        except (IOError, OSError), e:
+            self.warning("Can't cache refs for %s: %s" % (remote_url, str(e)))
+
+    def ls_remote(self, remote_url):
+        """ Returns a list of (refname, revision) for every ref on
+            remote_url, in `git ls-remote` order, or None.
+            """
+        cmd = ['git', 'ls-remote', remote_url]
         self.info("Running %s" % cmd)
         # Retry this a few times, in case there are network errors or somesuch
         max_retries = 5
         for _ in range(max_retries):
             proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                    stderr=subprocess.STDOUT)
-            if proc.wait() != 0:
+                                    stderr=subprocess.PIPE)
+            output, errors = proc.communicate()
+            if proc.returncode != 0:
                 self.warning("Returned %i - sleeping and retrying" %
                              proc.returncode)
-                self.warning("Got output: %s" % proc.stdout.read())
+                self.warning("Got output: %s" % (output + errors))
                 time.sleep(30)
                 continue
-            output = proc.stdout.read()
-            self.info("Got output: %s" % output)
-            revision = output.split()[0].strip()
-            self._git_ref_cache[remote_url, revision] = revision
-            return revision
+            refs = []
+            for line in output.splitlines():
+                parts = line.split()
+                if len(parts) == 2:
+                    refs.append((parts[1], parts[0]))
+            self.info("Got %d refs from %s" % (len(refs), remote_url))
+            return refs
         return None
 
-    def resolve_refs(self, manifest):
-        worker_pool = ThreadPool(20)
-        results = []
+    def query_remote_refs(self, remote_url, use_cache=True):
+        """ Returns all the refs on remote_url, as in ls_remote().
+
+            Each remote is only asked once per run, so all devices get the
+            same answer; between runs, answers are cached on disk for
+            self.config['git_ref_cache_ttl'] seconds.
+            """
+        if use_cache:
+            if remote_url in self._remote_refs:
+                return self._remote_refs[remote_url]
+            refs = self._read_remote_refs_cache(remote_url)
+            if refs is not None:
+                self.info("Using cached refs for %s" % remote_url)
+                self._cached_remotes.add(remote_url)
+                self._remote_refs[remote_url] = refs
+                return refs
+        refs = self.ls_remote(remote_url)
+        if refs is not None:
+            self._write_remote_refs_cache(remote_url, refs)
+            self._cached_remotes.discard(remote_url)
+            self._remote_refs[remote_url] = refs
+        return refs
+
+    def query_all_remote_refs(self, remote_urls):
+        """ Fetch the refs for each of remote_urls we don't have yet, in
+            parallel.
+            """
+        remote_urls = [u for u in set(remote_urls) if u not in self._remote_refs]
+        if not remote_urls:
+            return
+        worker_pool = ThreadPool(min(20, len(remote_urls)))
+        try:
+            worker_pool.map(self.query_remote_refs, remote_urls)
+        finally:
+            worker_pool.close()
+            worker_pool.join()
+
+    def resolve_git_ref(self, remote_url, revision):
+        """ Returns the revision of ref `revision` on remote_url, or None.
+
+            Like `git ls-remote remote_url revision`, revision matches
+            refs it's a trailing part of, and the first match wins.
+            """
+        for use_cache in (True, False):
+            refs = self.query_remote_refs(remote_url, use_cache=use_cache)
+            if refs is None:
+                return None
+            for ref, abs_revision in refs:
+                if ref == revision or ref.endswith('/%s' % revision):
+                    return abs_revision
+            # Maybe the ref is newer than our cached refs.
+            if remote_url not in self._cached_remotes:
+                return None
+        return None
 
-        # Resolve refnames
+    def _query_unresolved_projects(self, manifest):
+        """ Returns (project, remote_url, refname) for each project in
+            manifest that isn't locked to a revision yet.
+            """
+        unresolved = []
         for p in manifest.getElementsByTagName('project'):
             name = p.getAttribute('name')
             remote_url = repo_manifest.get_project_remote_url(manifest, p)
@@ -192,43 +299,27 @@ class B2GBumper(VCSScript, MapperMixin):
                 p.setAttribute('revision', self.gaia_git_rev)
                 continue
 
-            # Check to see if we've looked up this revision on this remote
-            # before If we have, reuse the previous value rather than looking
-            # it up again This will make sure revisions for the same ref name
-            # are consistent between devices, as long as they use the same
-            # remote/refname
-            if (remote_url, revision) in self._git_ref_cache:
-                abs_revision = self._git_ref_cache[remote_url, revision]
-                self.info(
-                    "Re-using previous lookup %s:%s -> %s" %
-                    (remote_url, revision, abs_revision))
-                p.setAttribute('revision', abs_revision)
-                continue
-
             # If there's no '/' in the revision, assume it's a head
             if '/' not in revision:
                 revision = 'refs/heads/%s' % revision
+            unresolved.append((p, remote_url, revision))
+        return unresolved
 
-            self.debug("Getting revision for %s (currently %s)" %
-                       (name, revision))
-            async_result = worker_pool.apply_async(self.resolve_git_ref,
-                                                   (remote_url, revision))
-            results.append((p, async_result))
+    def resolve_refs(self, manifest):
+        unresolved = self._query_unresolved_projects(manifest)
+        self.query_all_remote_refs([remote_url for _, remote_url, _ in unresolved])
 
         # TODO: alert/notify on missing repositories
-        # TODO: Add external caching
         abort = False
         failed = []
-        for p, result in results:
-            abs_revision = result.get()
-            remote_url = repo_manifest.get_project_remote_url(manifest, p)
-            revision = repo_manifest.get_project_revision(manifest, p)
+        for p, remote_url, revision in unresolved:
+            self.debug("Getting revision for %s (currently %s)" %
+                       (p.getAttribute('name'), revision))
+            abs_revision = self.resolve_git_ref(remote_url, revision)
             if not abs_revision:
                 abort = True
                 self.error("Couldn't resolve %s %s" % (remote_url, revision))
                 failed.append(p)
-            # Save to our cache
-            self._git_ref_cache[remote_url, revision] = abs_revision
             p.setAttribute('revision', abs_revision)
         if abort:
             # Write message about how to set up syncing
@@ -475,12 +566,22 @@ class B2GBumper(VCSScript, MapperMixin):
         Finally, we'll resolve absolute refs for projects that aren't fully
         specified.
         """
-        for device, device_config in self.query_devices().items():
+        devices = self.query_devices()
+        for device, device_config in devices.items():
             self.info("Massaging manifests for %s" % device)
             manifest = self.query_manifest(device)
             self.filter_projects(device_config, manifest)
             self.filter_groups(device_config, manifest)
             self.map_remotes(manifest)
+        # Devices share most of their remotes; look each one up just once.
+        remote_urls = []
+        for device in devices:
+            remote_urls.extend(remote_url for _, remote_url, _ in
+                               self._query_unresolved_projects(self.query_manifest(device)))
+        self.query_all_remote_refs(remote_urls)
+        for device in devices:
+            self.info("Resolving refs for %s" % device)
+            manifest = self.query_manifest(device)
             self.resolve_refs(manifest)
             repo_manifest.cleanup(manifest)
             self.device_manifests[device] = manifest
@@ -14,6 +14,7 @@ import os
 import re
 import subprocess
 import sys
+import time
 
 try:
     import simplejson as json
@@ -51,6 +52,14 @@ class DesktopSingleLocale(LocalesMixin, ReleaseMixin, MobileSigningMixin,
                           MockMixin, PurgeMixin, BuildbotMixin, TransferMixin,
                           VCSMixin, SigningMixin, BaseScript):
     """Manages desktop repacks"""
+    # what repacking a locale makes, for the repack cache;
+    # globs relative to the objdir
+    repack_cache_files = [
+        'dist/*.%(locale)s.*',
+        'dist/install/sea/*.%(locale)s.*',
+        'dist/*/xpi/*.%(locale)s.*',
+        'dist/update/*.%(locale)s.complete.mar',
+    ]
     config_options = [[
         ['--locale', ],
         {"action": "extend",
@@ -105,6 +114,13 @@ class DesktopSingleLocale(LocalesMixin, ReleaseMixin, MobileSigningMixin,
          "dest": "partials_from",
          "type": "string",
          "help": "Specify the total number of chunks of locales"}
+    ], [
+        ['--repack-workers', ],
+        {"action": "store",
+         "dest": "repack_workers",
+         "type": "int",
+         "help": "Specify the number of locales to repack at once "
+                 "(needs locale_make_args)"}
     ]]
 
     def __init__(self, require_config_file=True):
@@ -458,19 +474,22 @@ class DesktopSingleLocale(LocalesMixin, ReleaseMixin, MobileSigningMixin,
 
     def make_installers(self, locale):
         """wrapper for make installers-(locale)"""
-        env = self.query_repack_env()
+        env = deepcopy(self.query_repack_env())
         env['L10NBASEDIR'] = self.l10n_dir
         self._mar_tools_download()
+        # compare-locales merged this locale into a dir of its own
+        merge_dir = "%s/" % self.query_abs_locale_merge_dir(locale)
         # make.py: error: l10n-base required when using locale-mergedir
         # adding a replace(...) because make.py doesn't like
         # --locale-mergedir=e:\...\...\...
         # replacing \ with /
         # this kind of hacks makes me sad
-        env['LOCALE_MERGEDIR'] = env['LOCALE_MERGEDIR'].replace("\\", "/")
+        env['LOCALE_MERGEDIR'] = merge_dir.replace("\\", "/")
         dirs = self.query_abs_dirs()
         cwd = os.path.join(dirs['abs_locales_dir'])
         target = ["installers-%s" % locale,
                   "LOCALE_MERGEDIR=%s" % env["LOCALE_MERGEDIR"]]
+        target.extend(self.query_locale_make_args(locale))
         return self._make(target=target, cwd=cwd,
                           env=env, halt_on_failure=False)
 
@@ -486,29 +505,81 @@ class DesktopSingleLocale(LocalesMixin, ReleaseMixin, MobileSigningMixin,
         cmd = os.path.join(dirs['abs_objdir'], config['update_packaging_dir'])
         cmd = ['-C', cmd, 'full-update', 'AB_CD=%s' % locale,
                'PACKAGE_BASE_DIR=%s' % package_basedir]
+        cmd.extend(self.query_locale_make_args(locale))
         self._make(target=cmd, cwd=dirs['abs_mozilla_dir'], env=env)
 
+    def _query_en_us_package(self):
+        """returns the full path of the en-US package wget-en-US fetched"""
+        return os.path.join(self._abs_dist_dir(),
+                            self.query_base_package_name('en-US'))
+
+    def _repack_locale(self, locale, cache_inputs=None):
+        """runs compare-locales, make installers and generates the partials
+           for locale, stopping at the first step that fails.
+           installers and complete mars come from the repack cache, if
+           it has them for cache_inputs.
+           Returns a dict of step: result"""
+        result = {}
+        start_time = int(time.time())
+        if self.restore_repack_from_cache(cache_inputs):
+            result['repack_cache'] = 'hit'
+            result['partials'] = self.generate_partials(locale)
+            return result
+        result['compare_locales'] = self.run_compare_locales(locale)
+        if result['compare_locales']:
+            return result
+        result['installers'] = self.make_installers(locale)
+        if result['installers']:
+            return result
+        result['partials'] = self.generate_partials(locale)
+        self.add_repack_to_cache(
+            cache_inputs,
+            self.config.get('repack_cache_files', self.repack_cache_files),
+            start_time)
+        return result
+
     def repack(self):
-        """creates the repacks and udpates"""
-        # TODO per-locale logs and reporting.
+        """creates the repacks and udpates
+           up to repack_workers locales are repacked at once; each locale
+           also gets its own log, repack-(locale).log.
+           if repack_cache_dir is set, locales whose inputs haven't changed
+           since an earlier repack reuse its results"""
         self.enable_mock()
+        # look these up once, rather than in every locale at once
+        self.query_repack_env()
+        self._mar_tools_download()
         locales = self.query_locales()
-        results = {}
-        for locale in locales:
-            compare_locales = self.run_compare_locales(locale)
-            installers = self.make_installers(locale)
-            partials = self.generate_partials(locale)
+        cache_inputs = {}
+        if self.query_repack_cache():
+            en_us_package = self._query_en_us_package()
+            for locale in locales:
+                cache_inputs[locale] = self.query_repack_cache_inputs(
+                    locale, en_us_package, repack_env=self.query_repack_env())
+        success_count = 0
+        total_count = 0
+        cached_count = 0
+        for locale, result in self.run_per_locale(
+                lambda locale: self._repack_locale(locale, cache_inputs.get(locale)),
+                locales,
+                num_workers=self.query_repack_workers(),
+                log_name='repack'):
+            total_count += 1
             # log results:
-            result = {}
-            result['compare_locales'] = compare_locales
-            result['installers'] = installers
-            result['partials'] = partials
-            results[locale] = result
-        for locale in results:
             self.info(locale)
-            steps = results[locale]
-            for step in steps:
-                self.info("%s: %s" % (step, steps[step]))
+            for step in result:
+                self.info("%s: %s" % (step, result[step]))
+            if result.get('compare_locales'):
+                self.add_failure(locale, message="%s failed in compare-locales!" % locale)
+            elif result.get('installers'):
+                self.add_failure(locale, message="%s failed in make installers-%s!" % (locale, locale))
+            else:
+                success_count += 1
+                if result.get('repack_cache'):
+                    cached_count += 1
+        if self.query_repack_cache():
+            self.info("Reused %d repacks from the repack cache." % cached_count)
+        self.summarize_success_count(success_count, total_count,
+                                     message="Repacked %d of %d binaries successfully.")
 
     def upload_repacks(self):
         """calls make upload <locale>"""
@@ -668,10 +739,11 @@ class DesktopSingleLocale(LocalesMixin, ReleaseMixin, MobileSigningMixin,
 
     def get_previous_mar(self, locale):
         """downloads the previous mar file"""
-        self.mkdir_p(self.previous_mar_dir())
+        previous_mar_filename = self._previous_mar_filename(locale)
+        self.mkdir_p(os.path.dirname(previous_mar_filename))
         self.download_file(self._previous_mar_url(locale),
-                           self._previous_mar_filename())
-        return self._previous_mar_filename()
+                           previous_mar_filename)
+        return previous_mar_filename
 
     def _localized_mar(self, locale):
         """returns localized mar name"""
@@ -679,10 +751,10 @@ class DesktopSingleLocale(LocalesMixin, ReleaseMixin, MobileSigningMixin,
         version = self.query_version()
         return config["localized_mar"] % {'version': version, 'locale': locale}
 
-    def _previous_mar_filename(self):
-        """returns the complete path to previous.mar"""
+    def _previous_mar_filename(self, locale):
+        """returns the complete path to locale's previous.mar"""
         config = self.config
-        return os.path.join(self.previous_mar_dir(),
+        return os.path.join(self.previous_mar_dir(), locale,
                             config['previous_mar_filename'])
 
     def create_mar_dirs(self):
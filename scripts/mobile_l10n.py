@@ -15,6 +15,8 @@ import os
 import re
 import subprocess
 import sys
+import threading
+import time
 
 try:
     import simplejson as json
@@ -42,6 +44,9 @@ from mozharness.mozilla.mock import MockMixin
 class MobileSingleLocale(MockMixin, LocalesMixin, ReleaseMixin,
                          MobileSigningMixin, TransferMixin, TooltoolMixin,
                          BuildbotMixin, PurgeMixin, MercurialScript):
+    # What repacking a locale makes, for the repack cache; globs relative
+    # to the objdir.
+    repack_cache_files = ['dist/*.%(locale)s.*']
     config_options = [[
         ['--locale', ],
         {"action": "extend",
@@ -100,6 +105,14 @@ class MobileSingleLocale(MockMixin, LocalesMixin, ReleaseMixin,
          "type": "int",
          "help": "Specify the total number of chunks of locales"
          }
+    ], [
+        ['--repack-workers', ],
+        {"action": "store",
+         "dest": "repack_workers",
+         "type": "int",
+         "help": "Specify the number of locales to repack at once "
+                 "(needs locale_make_args)"
+         }
     ]]
 
     def __init__(self, require_config_file=True):
@@ -129,6 +142,8 @@ class MobileSingleLocale(MockMixin, LocalesMixin, ReleaseMixin,
         self.version = None
         self.upload_urls = {}
         self.locales_property = {}
+        # enable_mock()/disable_mock() aren't per-thread
+        self.mock_lock = threading.Lock()
 
     # Helper methods {{{2
     def query_repack_env(self):
@@ -377,35 +392,41 @@ class MobileSingleLocale(MockMixin, LocalesMixin, ReleaseMixin,
         buildid = self.query_buildid()
         self._setup_configure(buildid=buildid)
 
-    def repack(self):
-        # TODO per-locale logs and reporting.
+    def _repack_locale(self, locale, cache_inputs=None):
+        """ Repack locale, and verify the signature of the result, unless
+            the repack cache has it for cache_inputs.
+
+            Returns a failure message, or None.
+            """
+        start_time = int(time.time())
+        if self.restore_repack_from_cache(cache_inputs):
+            return None
         c = self.config
         dirs = self.query_abs_dirs()
-        locales = self.query_locales()
         make = self.query_exe("make")
-        repack_env = self.query_repack_env()
+        # compare-locales merges each locale into a dir of its own.
+        repack_env = deepcopy(self.query_repack_env())
+        repack_env['LOCALE_MERGEDIR'] = "%s/" % self.query_abs_locale_merge_dir(locale)
         base_package_name = self.query_base_package_name()
         base_package_dir = os.path.join(dirs['abs_objdir'], 'dist')
-        success_count = total_count = 0
-        for locale in locales:
-            total_count += 1
+        with self.mock_lock:
             self.enable_mock()
             result = self.run_compare_locales(locale)
             self.disable_mock()
-            if result:
-                self.add_failure(locale, message="%s failed in compare-locales!" % locale)
-                continue
-            if self.run_command_m([make, "installers-%s" % locale],
-                                  cwd=dirs['abs_locales_dir'],
-                                  env=repack_env,
-                                  error_list=MakefileErrorList,
-                                  halt_on_failure=False):
-                self.add_failure(locale, message="%s failed in make installers-%s!" % (locale, locale))
-                continue
-            signed_path = os.path.join(base_package_dir,
-                                       base_package_name % {'locale': locale})
-            # We need to wrap what this function does with mock, since
-            # MobileSigningMixin doesn't know about mock
+        if result:
+            return "%s failed in compare-locales!" % locale
+        if self.run_command_m([make, "installers-%s" % locale] +
+                              self.query_locale_make_args(locale),
+                              cwd=dirs['abs_locales_dir'],
+                              env=repack_env,
+                              error_list=MakefileErrorList,
+                              halt_on_failure=False):
+            return "%s failed in make installers-%s!" % (locale, locale)
+        signed_path = os.path.join(base_package_dir,
+                                   base_package_name % {'locale': locale})
+        # We need to wrap what this function does with mock, since
+        # MobileSigningMixin doesn't know about mock
+        with self.mock_lock:
             self.enable_mock()
             status = self.verify_android_signature(
                 signed_path,
@@ -414,11 +435,45 @@ class MobileSingleLocale(MockMixin, LocalesMixin, ReleaseMixin,
                 key_alias=c['key_alias'],
             )
             self.disable_mock()
-            if status:
-                self.add_failure(locale, message="Errors verifying %s binary!" % locale)
-                # No need to rm because upload is per-locale
-                continue
-            success_count += 1
+        if status:
+            # No need to rm because upload is per-locale
+            return "Errors verifying %s binary!" % locale
+        self.add_repack_to_cache(
+            cache_inputs,
+            c.get('repack_cache_files', self.repack_cache_files),
+            start_time)
+        return None
+
+    def repack(self):
+        """ Repack up to self.config['repack_workers'] locales at once;
+            each one's log is also in repack-<locale>.log.
+
+            If self.config['repack_cache_dir'] is set, locales whose inputs
+            haven't changed since an earlier repack reuse its results.
+            """
+        dirs = self.query_abs_dirs()
+        locales = self.query_locales()
+        # Look these up once, before the locales do.
+        self.query_repack_env()
+        base_package_name = self.query_base_package_name()
+        cache_inputs = {}
+        if self.query_repack_cache():
+            en_us_package = os.path.join(dirs['abs_objdir'], 'dist',
+                                         base_package_name % {'locale': 'en-US'})
+            for locale in locales:
+                cache_inputs[locale] = self.query_repack_cache_inputs(
+                    locale, en_us_package, repack_env=self.query_repack_env())
+        success_count = total_count = 0
+        for locale, message in self.run_per_locale(
+                lambda locale: self._repack_locale(locale, cache_inputs.get(locale)),
+                locales,
+                num_workers=self.query_repack_workers(),
+                log_name='repack'):
+            total_count += 1
+            if message:
+                self.add_failure(locale, message=message)
+            else:
+                success_count += 1
         self.summarize_success_count(success_count, total_count,
                                      message="Repacked %d of %d binaries successfully.")
 
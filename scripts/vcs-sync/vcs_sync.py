@@ -10,8 +10,10 @@ hg<->git conversions.  Needs to support both the monolithic beagle/gecko.git
 type conversions, as well as many-to-many (l10n, build repos, etc.)
 """
 
+from collections import OrderedDict
 from copy import deepcopy
-import mmap
+import hashlib
+from multiprocessing.pool import ThreadPool
 import os
 import pprint
 import re
@@ -37,11 +39,13 @@ from mozharness.base.log import INFO, ERROR, FATAL
 from mozharness.base.python import VirtualenvMixin, virtualenv_config_options
 from mozharness.base.transfer import TransferMixin
 from mozharness.base.vcs.vcssync import VCSSyncScript
+from mozharness.mozilla.mapper import MapperMixin, combine_mapfiles
 from mozharness.mozilla.tooltool import TooltoolMixin
 
 
 # HgGitScript {{{1
-class HgGitScript(VirtualenvMixin, TooltoolMixin, TransferMixin, VCSSyncScript):
+class HgGitScript(VirtualenvMixin, TooltoolMixin, TransferMixin, MapperMixin,
+                  VCSSyncScript):
     """ Beagle-oriented hg->git script (lots of mozilla-central hardcodes;
         assumption that we're going to be importing lots of branches).
 
@@ -52,7 +56,6 @@ class HgGitScript(VirtualenvMixin, TooltoolMixin, TransferMixin, VCSSyncScript):
         script with some changes.
         """
 
-    mapfile_binary_search = None
     all_repos = None
     successful_repos = []
     config_options = [
@@ -61,7 +64,13 @@ class HgGitScript(VirtualenvMixin, TooltoolMixin, TransferMixin, VCSSyncScript):
             "dest": "check_incoming",
             "default": True,
             "help": "Don't check for incoming changesets"
-        }]
+        }],
+        [["--max-parallel-repos"], {
+            "action": "store",
+            "type": "int",
+            "dest": "max_parallel_repos",
+            "help": "Convert and push this many repos at once"
+        }],
     ]
 
     def __init__(self, require_config_file=True):
@@ -93,6 +102,7 @@ class HgGitScript(VirtualenvMixin, TooltoolMixin, TransferMixin, VCSSyncScript):
             ],
             require_config_file=require_config_file
         )
+        self.unchanged_repos = []
 
     # Helper methods {{{1
     def query_abs_dirs(self):
@@ -431,135 +441,339 @@ intree=1
 
             This was meant to be a cross-vcs method, but currently only
             covers git pushes.
+
+            Test pushes go first, one at a time; if one fails, we don't
+            push anywhere else.  Then the remote targets are pushed to, in
+            up to self.config['max_parallel_pushes'] threads.
             """
         dirs = self.query_abs_dirs()
         conversion_dir = self.query_abs_conversion_dir(repo_config)
         if not conversion_dir:
             self.fatal("No conversion_dir for %s!" % repo_config['repo_name'])
         source_dir = os.path.join(dirs['abs_source_dir'], repo_config['repo_name'])
+        test_targets = [t for t in repo_config['targets'] if t.get("test_push")]
+        remote_targets = [t for t in repo_config['targets'] if not t.get("test_push")]
+        for target_config in test_targets:
+            error_msg = self._push_target(repo_config, target_config,
+                                          conversion_dir, source_dir)
+            if error_msg:
+                return error_msg
+
+        def push_target(target_config):
+            return self._push_target(repo_config, target_config,
+                                     conversion_dir, source_dir)
+        num_threads = min(self.config.get('max_parallel_pushes', 1), len(remote_targets))
+        if num_threads > 1:
+            pool = ThreadPool(num_threads)
+            try:
+                statuses = pool.map(push_target, remote_targets)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            statuses = [push_target(t) for t in remote_targets]
+        return ''.join(statuses)
+
+    def _push_target(self, repo_config, target_config, conversion_dir, source_dir):
+        """ Helper method for _push_repo(): push to one target.
+
+            Returns an error message, or '' on success.
+            """
+        dirs = self.query_abs_dirs()
         git = self.query_exe('git', return_type='list')
         hg = self._query_hg_exe()
-        return_status = ''
-        for target_config in repo_config['targets']:
-            test_push = False
-            remote_config = {}
-            if target_config.get("test_push"):
-                test_push = True
-                force_push = target_config.get("force_push")
-                target_name = os.path.join(
-                    dirs['abs_target_dir'], target_config['target_dest'])
-                target_vcs = target_config.get("vcs")
+        test_push = False
+        remote_config = {}
+        if target_config.get("test_push"):
+            test_push = True
+            force_push = target_config.get("force_push")
+            target_name = os.path.join(
+                dirs['abs_target_dir'], target_config['target_dest'])
+            target_vcs = target_config.get("vcs")
+        else:
+            target_name = target_config['target_dest']
+            remote_config = self.config.get('remote_targets', {}).get(target_name, target_config)
+            force_push = remote_config.get("force_push", target_config.get("force_push"))
+            target_vcs = remote_config.get("vcs", target_config.get("vcs"))
+        if target_vcs == "git":
+            base_command = git + ['push']
+            env = {}
+            if force_push:
+                base_command.append("-f")
+            if test_push:
+                base_command.append(target_name)
             else:
-                target_name = target_config['target_dest']
-                remote_config = self.config.get('remote_targets', {}).get(target_name, target_config)
-                force_push = remote_config.get("force_push", target_config.get("force_push"))
-                target_vcs = remote_config.get("vcs", target_config.get("vcs"))
-            if target_vcs == "git":
-                base_command = git + ['push']
-                env = {}
-                if force_push:
-                    base_command.append("-f")
-                if test_push:
-                    base_command.append(target_name)
-                else:
-                    base_command.append(remote_config['repo'])
-                    # Allow for using a custom git ssh key.
-                    env['GIT_SSH_KEY'] = remote_config['ssh_key']
-                    env['GIT_SSH'] = os.path.join(external_tools_path, 'git-ssh-wrapper.sh')
-                # Allow for pushing a subset of repo branches to the target.
-                # If we specify that subset, we can also specify different
-                # names for those branches (e.g. b2g18 -> master for a
-                # standalone b2g18 repo)
-                # We query hg for these because the conversion dir will have
-                # branches from multiple hg repos, and the regexes may match
-                # too many things.
-                refs_list = []
-                branch_map = self.query_branches(
-                    target_config.get('branch_config', repo_config.get('branch_config', {})),
-                    source_dir,
+                base_command.append(remote_config['repo'])
+                # Allow for using a custom git ssh key.
+                env['GIT_SSH_KEY'] = remote_config['ssh_key']
+                env['GIT_SSH'] = os.path.join(external_tools_path, 'git-ssh-wrapper.sh')
+            # Allow for pushing a subset of repo branches to the target.
+            # If we specify that subset, we can also specify different
+            # names for those branches (e.g. b2g18 -> master for a
+            # standalone b2g18 repo)
+            # We query hg for these because the conversion dir will have
+            # branches from multiple hg repos, and the regexes may match
+            # too many things.
+            refs_list = []
+            branch_map = self.query_branches(
+                target_config.get('branch_config', repo_config.get('branch_config', {})),
+                source_dir,
+            )
+            # If the target_config has a branch_config, the key is the
+            # local git branch and the value is the target git branch.
+            if target_config.get("branch_config"):
+                for (branch, target_branch) in branch_map.items():
+                    refs_list += ['+refs/heads/%s:refs/heads/%s' % (branch, target_branch)]
+            # Otherwise the key is the hg branch and the value is the git
+            # branch; use the git branch for both local and target git
+            # branch names.
+            else:
+                for (hg_branch, git_branch) in branch_map.items():
+                    refs_list += ['+refs/heads/%s:refs/heads/%s' % (git_branch, git_branch)]
+            # Allow for pushing a subset of tags to the target, via name or
+            # regex.  Again, query hg for this list because the conversion
+            # dir will contain tags from multiple hg repos, and the regexes
+            # may match too many things.
+            tag_config = target_config.get('tag_config', repo_config.get('tag_config', {}))
+            if tag_config.get('tags'):
+                for (tag, target_tag) in tag_config['tags'].items():
+                    refs_list += ['+refs/tags/%s:refs/tags/%s' % (tag, target_tag)]
+            if tag_config.get('tag_regexes'):
+                regex_list = []
+                for regex in tag_config['tag_regexes']:
+                    regex_list.append(re.compile(regex))
+                tag_list = self.get_output_from_command(
+                    hg + ['tags'],
+                    cwd=source_dir,
                 )
-                # If the target_config has a branch_config, the key is the
-                # local git branch and the value is the target git branch.
-                if target_config.get("branch_config"):
-                    for (branch, target_branch) in branch_map.items():
-                        refs_list += ['+refs/heads/%s:refs/heads/%s' % (branch, target_branch)]
-                # Otherwise the key is the hg branch and the value is the git
-                # branch; use the git branch for both local and target git
-                # branch names.
-                else:
-                    for (hg_branch, git_branch) in branch_map.items():
-                        refs_list += ['+refs/heads/%s:refs/heads/%s' % (git_branch, git_branch)]
-                # Allow for pushing a subset of tags to the target, via name or
-                # regex.  Again, query hg for this list because the conversion
-                # dir will contain tags from multiple hg repos, and the regexes
-                # may match too many things.
-                tag_config = target_config.get('tag_config', repo_config.get('tag_config', {}))
-                if tag_config.get('tags'):
-                    for (tag, target_tag) in tag_config['tags'].items():
-                        refs_list += ['+refs/tags/%s:refs/tags/%s' % (tag, target_tag)]
-                if tag_config.get('tag_regexes'):
-                    regex_list = []
-                    for regex in tag_config['tag_regexes']:
-                        regex_list.append(re.compile(regex))
-                    tag_list = self.get_output_from_command(
-                        hg + ['tags'],
-                        cwd=source_dir,
-                    )
-                    for tag_line in tag_list.splitlines():
-                        if not tag_line:
+                for tag_line in tag_list.splitlines():
+                    if not tag_line:
+                        continue
+                    tag_parts = tag_line.split()
+                    if not tag_parts:
+                        self.warning("Bogus tag_line? %s" % str(tag_line))
+                        continue
+                    tag_name = tag_parts[0]
+                    for regex in regex_list:
+                        if tag_name != 'tip' and regex.search(tag_name) is not None:
+                            refs_list += ['+refs/tags/%s:refs/tags/%s' % (tag_name, tag_name)]
                             continue
-                        tag_parts = tag_line.split()
-                        if not tag_parts:
-                            self.warning("Bogus tag_line? %s" % str(tag_line))
-                            continue
-                        tag_name = tag_parts[0]
-                        for regex in regex_list:
-                            if tag_name != 'tip' and regex.search(tag_name) is not None:
-                                refs_list += ['+refs/tags/%s:refs/tags/%s' % (tag_name, tag_name)]
-                                continue
-                error_msg = "%s: Can't push %s to %s!\n" % (repo_config['repo_name'], conversion_dir, target_name)
-                if self._do_push_repo(
-                    base_command,
-                    refs_list=refs_list,
-                    kwargs={
-                        'output_timeout': target_config.get("output_timeout", 30 * 60),
-                        'cwd': os.path.join(conversion_dir, '.git'),
-                        'error_list': GitErrorList,
-                        'partial_env': env,
-                    }
-                ):
-                    if target_config.get("test_push"):
-                        error_msg += "This was a test push that failed; not proceeding any further with %s!\n" % repo_config['repo_name']
-                    self.error(error_msg)
-                    return_status += error_msg
-                    if target_config.get("test_push"):
-                        break
-            else:
-                # TODO write hg
-                error_msg = "%s: Don't know how to deal with vcs %s!\n" % (
-                    target_config['target_dest'], target_vcs)
+            error_msg = "%s: Can't push %s to %s!\n" % (repo_config['repo_name'], conversion_dir, target_name)
+            if self._do_push_repo(
+                base_command,
+                refs_list=refs_list,
+                kwargs={
+                    'output_timeout': target_config.get("output_timeout", 30 * 60),
+                    'cwd': os.path.join(conversion_dir, '.git'),
+                    'error_list': GitErrorList,
+                    'partial_env': env,
+                }
+            ):
+                if target_config.get("test_push"):
+                    error_msg += "This was a test push that failed; not proceeding any further with %s!\n" % repo_config['repo_name']
                 self.error(error_msg)
-                return_status += error_msg
-        return return_status
+                return error_msg
+        else:
+            # TODO write hg
+            error_msg = "%s: Don't know how to deal with vcs %s!\n" % (
+                target_config['target_dest'], target_vcs)
+            self.error(error_msg)
+            return error_msg
+        return ''
+
+    def _update_work_mirror_repo(self, repo_config, previous_branches=None):
+        """ Helper method for update_work_mirror(): pull the latest changes
+            for one repo into its work mirror, and convert them.
+
+            previous_branches is the repo's branches from the repo_map.  If
+            every branch is still at the hg_revision we converted last time,
+            there's nothing to do, and we add the repo to
+            self.unchanged_repos instead.
+
+            Returns the repo's branches for the repo_map, None if we skipped
+            the repo, or False if we couldn't pull from the stage mirror.
+            This may run in a worker thread, so it leaves the failure
+            bookkeeping to the caller.
+            """
+        hg = self._query_hg_exe()
+        git = self.query_exe("git", return_type="list")
+        dirs = self.query_abs_dirs()
+        repo_name = repo_config['repo_name']
+        source = os.path.join(dirs['abs_source_dir'], repo_name)
+        dest = self.query_abs_conversion_dir(repo_config)
+        if not dest:
+            self.fatal("No conversion_dir for %s!" % repo_name)
+        if not os.path.exists(dest):
+#            self.run_command(hg + ["init", dest], halt_on_failure=True)
+#            self.run_command(hg + ['pull', source],
+#                             cwd=os.path.dirname(dest))
+            self.mkdir_p(os.path.dirname(dest))
+            self.run_command(hg + ['clone', '--noupdate', source, dest],
+                             error_list=HgErrorList,
+                             halt_on_failure=True)
+            self.write_hggit_hgrc(dest)
+            self.init_git_repo('%s/.git' % dest, additional_args=['--bare'])
+            self.run_command(
+                git + ['--git-dir', '%s/.git' % dest, 'config', 'gc.auto', '0'],
+            )
+            previous_branches = None
+        elif self.query_failure(repo_name):
+            self.info("Skipping %s." % repo_config['repo_name'])
+            return None
+        # Build branch map.
+        branch_map = self.query_branches(
+            repo_config.get('branch_config', {}),
+            source,
+        )
+        revs = {}
+        for branch in branch_map:
+            output = self.get_output_from_command(
+                hg + ['id', '-r', branch],
+                cwd=source
+            )
+            if output:
+                revs[branch] = output.split(' ')[0]
+            else:
+                self.fatal("Branch %s doesn't exist in %s!" % (branch, repo_name))
+        if previous_branches and branch_map and \
+                self.config.get('skip_unchanged_repos', True) and \
+                self._query_branches_unchanged(branch_map, revs, previous_branches):
+            self.info("%s hasn't changed since the last conversion; skipping." % repo_name)
+            upload_mapfile = os.path.join(
+                self.query_abs_dirs()['abs_upload_dir'],
+                repo_config.get('mapfile_name', self.config.get('mapfile_name', "gecko-mapfile")))
+            if not os.path.exists(upload_mapfile):
+                self.copy_to_upload_dir(os.path.join(dest, '.hg', 'git-mapfile'),
+                                        dest=os.path.basename(upload_mapfile),
+                                        log_level=INFO)
+            self.unchanged_repos.append(repo_name)
+            return dict((branch, previous_branches[branch]) for branch in branch_map)
+        branches = {}
+        for (branch, target_branch) in branch_map.items():
+            rev = revs[branch]
+            timestamp = int(time.time())
+            datetime = time.strftime('%Y-%m-%d %H:%M %Z')
+            if self.run_command(hg + ['pull', '-r', rev, source], cwd=dest,
+                                error_list=HgErrorList):
+                # We shouldn't have an issue pulling!  update_work_mirror()
+                # records the failure and clobbers the stage mirror.
+                return False
+            self.run_command(
+                hg + ['bookmark', '-f', '-r', rev, target_branch],
+                cwd=dest, error_list=HgErrorList,
+            )
+            # This might get a little large.
+            branches[branch] = {
+                'hg_branch': branch,
+                'hg_revision': rev,
+                'git_branch': target_branch,
+                'pull_timestamp': timestamp,
+                'pull_datetime': datetime,
+            }
+        self.retry(
+            self.run_command,
+            args=(hg + ['-v', 'gexport'], ),
+            kwargs={
+                'output_timeout': 15 * 60,
+                'cwd': dest,
+                'error_list': HgErrorList,
+            },
+            error_level=FATAL,
+        )
+        generated_mapfile = os.path.join(dest, '.hg', 'git-mapfile')
+        self.copy_to_upload_dir(
+            generated_mapfile,
+            dest=repo_config.get('mapfile_name', self.config.get('mapfile_name', "gecko-mapfile")),
+            log_level=INFO
+        )
+        git_revisions = self.query_mapfile_index(generated_mapfile).resolve(
+            [branches[branch]['hg_revision'] for branch in branches], vcs='git')
+        for branch in branches:
+            branches[branch]['git_revision'] = git_revisions[branches[branch]['hg_revision']]
+        return branches
+
+    def _query_branches_unchanged(self, branch_map, revs, previous_branches):
+        """ Helper method for _update_work_mirror_repo(): is every branch
+            in branch_map at revision revs[branch], mapped to the same git
+            branch and already converted, according to previous_branches?
+            """
+        for (branch, target_branch) in branch_map.items():
+            previous = previous_branches.get(branch, {})
+            if previous.get('hg_revision') != revs[branch] or \
+                    previous.get('git_branch') != target_branch or \
+                    not previous.get('git_revision'):
+                return False
+        return True
+
+    def _query_push_config_hash(self, repo_config):
+        """ Helper method for push(): a hash of everything in the config
+            that decides what we push for repo_config, and where.
+
+            We record it in the repo_map after each successful push, so an
+            unchanged repo is still pushed if its targets have changed.
+            """
+        remote_targets = self.config.get('remote_targets', {})
+        push_config = {
+            'branch_config': repo_config.get('branch_config', {}),
+            'tag_config': repo_config.get('tag_config', {}),
+            'targets': repo_config['targets'],
+            'remote_targets': dict(
+                (t['target_dest'], remote_targets[t['target_dest']])
+                for t in repo_config['targets']
+                if t['target_dest'] in remote_targets
+            ),
+        }
+        return hashlib.sha1(json.dumps(push_config, sort_keys=True)).hexdigest()
+
+    def _run_per_repo(self, func, repo_configs):
+        """ Call func(repo_config) for each of repo_configs, and yield
+            (repo_config, result) as they finish.
+
+            With self.config['max_parallel_repos'] > 1, repos with different
+            conversion dirs are done concurrently in that many threads;
+            repos sharing a conversion dir are still done in order.  If func
+            exits (e.g. through fatal()) for one repo, the ones already
+            underway finish, and then we exit the same way.
+            """
+        max_parallel_repos = self.config.get('max_parallel_repos', 1)
+        if max_parallel_repos <= 1:
+            for repo_config in repo_configs:
+                yield repo_config, func(repo_config)
+            return
+        groups = OrderedDict()
+        for repo_config in repo_configs:
+            dest = self.query_abs_conversion_dir(repo_config)
+            groups.setdefault(dest, []).append(repo_config)
+
+        def run_group(group):
+            results = []
+            for repo_config in group:
+                try:
+                    results.append((repo_config, func(repo_config), None))
+                except BaseException:
+                    results.append((repo_config, None, sys.exc_info()))
+                    break
+            return results
+
+        pool = ThreadPool(max(1, min(max_parallel_repos, len(groups))))
+        exc_info = None
+        try:
+            for results in pool.imap_unordered(run_group, groups.values()):
+                for repo_config, result, e in results:
+                    if e is not None:
+                        exc_info = exc_info or e
+                    else:
+                        yield repo_config, result
+        finally:
+            pool.close()
+            pool.join()
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
 
     def _query_mapped_revision(self, revision=None, mapfile=None):
-        """ Use the virtualenv mapper module to search a mapfile for a
-            revision.
+        """ Search a mapfile for the git revision of an hg revision.
             """
-        if not callable(self.mapfile_binary_search):
-            site_packages_path = self.query_python_site_packages_path()
-            sys.path.append(os.path.join(site_packages_path, 'mapper'))
-            try:
-                from bsearch import mapfile_binary_search
-                global log
-                log = self.log_obj
-                self.mapfile_binary_search = mapfile_binary_search
-            except ImportError, e:
-                self.fatal("Can't import mapfile_binary_search! %s\nDid you create-virtualenv?" % str(e))
-        # I wish mapper did this for me, but ...
-        fd = open(mapfile, 'rb')
-        m = mmap.mmap(fd.fileno(), 0, mmap.MAP_PRIVATE, mmap.PROT_READ)
-        return self.mapfile_binary_search(m, revision)
+        return self.query_mapfile_index(mapfile).query_git_revision(revision)
 
     def _post_fatal(self, message=None, exit_code=None):
         """ After we call fatal(), run this method before exiting.
@@ -662,7 +876,8 @@ intree=1
         """ Adapted from repo-sync-tools/combine_mapfiles
 
             Consolidate multiple conversion processes' mapfiles into a
-            single mapfile.
+            single mapfile.  Only what's been appended to each mapfile since
+            the last run is merged in; see mapper.combine_mapfiles().
             """
         self.info("Determining whether we need to combine mapfiles...")
         if cwd is None:
@@ -671,29 +886,19 @@ intree=1
         for f in mapfiles:
             f_path = os.path.join(cwd, f)
             if os.path.exists(f_path):
-                existing_mapfiles.append(f)
+                existing_mapfiles.append(f_path)
             else:
                 self.warning("%s doesn't exist!" % f_path)
         combined_mapfile_path = os.path.join(cwd, combined_mapfile)
-        if os.path.exists(combined_mapfile_path):
-            combined_timestamp = os.path.getmtime(combined_mapfile_path)
-            for f in existing_mapfiles:
-                f_path = os.path.join(cwd, f)
-                if os.path.getmtime(f_path) > combined_timestamp:
-                    # Yes, we want to combine mapfiles
-                    break
-            else:
-                self.info("No new mapfiles to combine.")
-                return
-            self.move(combined_mapfile_path, "%s.old" % combined_mapfile_path)
-        output = self.get_output_from_command(
-            ['sort', '--unique', '-t', ' ',
-             '--key=2'] + existing_mapfiles,
-            silent=True, halt_on_failure=True,
-            cwd=cwd,
-        )
-        self.write_to_file(combined_mapfile_path, output, verbose=False,
-                           error_level=FATAL)
+        try:
+            new_lines = combine_mapfiles(existing_mapfiles, combined_mapfile_path,
+                                         run_lines=self.config.get('mapfile_run_lines', 100000))
+        except (IOError, OSError), e:
+            self.fatal("Can't combine mapfiles into %s: %s" % (combined_mapfile_path, str(e)))
+        if new_lines is None:
+            self.info("No new mapfiles to combine.")
+            return
+        self.info("Merged %d new lines into %s." % (new_lines, combined_mapfile_path))
         self.run_command(['ln', '-sf', combined_mapfile,
                           '%s-latest' % combined_mapfile],
                          cwd=cwd)
@@ -740,100 +945,42 @@ intree=1
         """ Pull the latest changes into the work mirror, update the repo_map
             json, and run |hg gexport| to convert those latest changes into
             the git conversion repo.
+
+            Repos are converted concurrently if max_parallel_repos is set;
+            see _run_per_repo().
             """
-        hg = self._query_hg_exe()
-        git = self.query_exe("git", return_type="list")
-        dirs = self.query_abs_dirs()
         repo_map = self._read_repo_update_json()
         timestamp = int(time.time())
         datetime = time.strftime('%Y-%m-%d %H:%M %Z')
         repo_map['last_pull_timestamp'] = timestamp
         repo_map['last_pull_datetime'] = datetime
-        for repo_config in self.query_all_repos():
+        previous_repos = deepcopy(repo_map.get('repos', {}))
+
+        def update_work_mirror_repo(repo_config):
+            return self._update_work_mirror_repo(
+                repo_config,
+                previous_repos.get(repo_config['repo_name'], {}).get('branches'))
+        converted = 0
+        dirs = self.query_abs_dirs()
+        for repo_config, branches in self._run_per_repo(update_work_mirror_repo,
+                                                        self.query_all_repos()):
             repo_name = repo_config['repo_name']
-            source = os.path.join(dirs['abs_source_dir'], repo_name)
-            dest = self.query_abs_conversion_dir(repo_config)
-            if not dest:
-                self.fatal("No conversion_dir for %s!" % repo_name)
-            if not os.path.exists(dest):
-#                self.run_command(hg + ["init", dest], halt_on_failure=True)
-#                self.run_command(hg + ['pull', source],
-#                                 cwd=os.path.dirname(dest))
-                self.mkdir_p(os.path.dirname(dest))
-                self.run_command(hg + ['clone', '--noupdate', source, dest],
-                                 error_list=HgErrorList,
-                                 halt_on_failure=True)
-                self.write_hggit_hgrc(dest)
-                self.init_git_repo('%s/.git' % dest, additional_args=['--bare'])
-                self.run_command(
-                    git + ['--git-dir', '%s/.git' % dest, 'config', 'gc.auto', '0'],
-                )
-            elif self.query_failure(repo_name):
-                self.info("Skipping %s." % repo_config['repo_name'])
-                continue
-            # Build branch map.
-            branch_map = self.query_branches(
-                repo_config.get('branch_config', {}),
-                source,
-            )
-            for (branch, target_branch) in branch_map.items():
-                output = self.get_output_from_command(
-                    hg + ['id', '-r', branch],
-                    cwd=source
-                )
-                if output:
-                    rev = output.split(' ')[0]
-                else:
-                    self.fatal("Branch %s doesn't exist in %s!" % (branch, repo_name))
-                timestamp = int(time.time())
-                datetime = time.strftime('%Y-%m-%d %H:%M %Z')
-                if self.run_command(hg + ['pull', '-r', rev, source], cwd=dest,
-                                    error_list=HgErrorList):
-                    # We shouldn't have an issue pulling!
-                    self.add_failure(
-                        repo_name,
-                        message="Unable to pull %s from stage_source; clobbering and skipping!" % repo_name,
-                        level=ERROR,
-                    )
-                    self._update_repo_previous_status(repo_name, successful_flag=False, write_update=True)
-                    self.rmtree(source)
-                    break
-                self.run_command(
-                    hg + ['bookmark', '-f', '-r', rev, target_branch],
-                    cwd=dest, error_list=HgErrorList,
+            if branches is False:
+                self.add_failure(
+                    repo_name,
+                    message="Unable to pull %s from stage_source; clobbering and skipping!" % repo_name,
+                    level=ERROR,
                 )
-                # This might get a little large.
-                repo_map.setdefault('repos', {}).setdefault(repo_name, {}).setdefault('branches', {})[branch] = {
-                    'hg_branch': branch,
-                    'hg_revision': rev,
-                    'git_branch': target_branch,
-                    'pull_timestamp': timestamp,
-                    'pull_datetime': datetime,
-                }
-            if self.query_failure(repo_name):
-                # We hit an error in the for loop above
-                continue
-            self.retry(
-                self.run_command,
-                args=(hg + ['-v', 'gexport'], ),
-                kwargs={
-                    'output_timeout': 15 * 60,
-                    'cwd': dest,
-                    'error_list': HgErrorList,
-                },
-                error_level=FATAL,
-            )
-            generated_mapfile = os.path.join(dest, '.hg', 'git-mapfile')
-            self.copy_to_upload_dir(
-                generated_mapfile,
-                dest=repo_config.get('mapfile_name', self.config.get('mapfile_name', "gecko-mapfile")),
-                log_level=INFO
-            )
-            for (branch, target_branch) in branch_map.items():
-                git_revision = self._query_mapped_revision(
-                    revision=rev, mapfile=generated_mapfile)
-                repo_map['repos'][repo_name]['branches'][branch]['git_revision'] = git_revision
+                self.rmtree(os.path.join(dirs['abs_source_dir'], repo_name))
+                self._update_repo_previous_status(repo_name, successful_flag=False,
+                                                  repo_map=repo_map, write_update=True)
+            elif branches is not None:
+                repo_map.setdefault('repos', {}).setdefault(repo_name, {}).setdefault('branches', {}).update(branches)
+                if repo_name not in self.unchanged_repos:
+                    converted += 1
         self._write_repo_update_json(repo_map)
+        self.info("Converted %d repos; skipped %d unchanged repos." %
+                  (converted, len(self.unchanged_repos)))
 
     def combine_mapfiles(self):
         """ This method is for any job (l10n, project-branches) that needs to combine
@@ -866,6 +1013,9 @@ intree=1
     def push(self):
         """ Push to all targets.  test_targets are local directory test repos;
             the rest are remote.  Updates the repo_map json.
+
+            Repos are pushed concurrently if max_parallel_repos is set; see
+            _run_per_repo().
             """
         self.create_test_targets()
         repo_map = self._read_repo_update_json()
@@ -874,19 +1024,35 @@ intree=1
         datetime = time.strftime('%Y-%m-%d %H:%M %Z')
         repo_map['last_push_timestamp'] = timestamp
         repo_map['last_push_datetime'] = datetime
+        repo_configs = []
+        skipped = 0
         for repo_config in self.query_all_repos():
             if self.query_failure(repo_config['repo_name']):
                 self.info("Skipping %s." % repo_config['repo_name'])
                 continue
+            # Unchanged repos only need pushing if the last push failed,
+            # or if their targets have changed since.
+            if repo_config['repo_name'] in self.unchanged_repos and \
+                    self._query_repo_previous_status(repo_config['repo_name'], repo_map=repo_map) and \
+                    repo_map['repos'][repo_config['repo_name']].get('push_config_hash') == \
+                    self._query_push_config_hash(repo_config):
+                self.info("Skipping unchanged %s." % repo_config['repo_name'])
+                skipped += 1
+                continue
+            repo_configs.append(repo_config)
+
+        def push_repo(repo_config):
             timestamp = int(time.time())
             datetime = time.strftime('%Y-%m-%d %H:%M %Z')
-            status = self._push_repo(repo_config)
+            return timestamp, datetime, self._push_repo(repo_config)
+        for repo_config, (timestamp, datetime, status) in self._run_per_repo(push_repo, repo_configs):
             repo_name = repo_config['repo_name']
             if not status:  # good
                 if repo_name not in self.successful_repos:
                     self.successful_repos.append(repo_name)
                 repo_map.setdefault('repos', {}).setdefault(repo_name, {})['push_timestamp'] = timestamp
                 repo_map['repos'][repo_name]['push_datetime'] = datetime
+                repo_map['repos'][repo_name]['push_config_hash'] = self._query_push_config_hash(repo_config)
                 previous_status = self._query_repo_previous_status(repo_name, repo_map=repo_map)
                 if previous_status is None:
                     self.add_summary("Possibly the first successful push of %s." % repo_name)
@@ -901,6 +1067,7 @@ intree=1
                 )
                 failure_msg += status + "\n"
                 self._update_repo_previous_status(repo_name, successful_flag=False, repo_map=repo_map, write_update=True)
+        self.info("Pushed %d repos; skipped %d unchanged repos." % (len(repo_configs), skipped))
         if not failure_msg:
             repo_map['last_successful_push_timestamp'] = repo_map['last_push_timestamp']
             repo_map['last_successful_push_datetime'] = repo_map['last_push_datetime']
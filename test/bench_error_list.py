@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""Micro-benchmark for mozharness.base.log.ErrorListMatcher.
+
+Times the old one-entry-at-a-time error_list walk against the compiled
+matcher over a log file, and makes sure both pick the same entry for
+every line.
+
+    python test/bench_error_list.py [mochitest.log ...]
+
+Without arguments, a synthetic mochitest-style log is used.  Not run as
+part of the unit tests.
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mozharness.base.errors import BaseErrorList, HgErrorList, \
+    MakefileErrorList, SSHErrorList, VirtualenvErrorList
+from mozharness.mozilla.testing.errors import LogcatErrorList
+from mozharness.base.log import ErrorListMatcher
+
+ERROR_LISTS = (
+    ('BaseErrorList', BaseErrorList),
+    ('HgErrorList', HgErrorList),
+    ('MakefileErrorList', MakefileErrorList),
+    ('SSHErrorList', SSHErrorList),
+    ('VirtualenvErrorList', VirtualenvErrorList),
+    ('LogcatErrorList', LogcatErrorList),
+)
+
+
+def synthetic_log(num_lines=200000):
+    random.seed(0)
+    lines = []
+    for i in range(num_lines):
+        test = "/tests/dom/tests/mochitest/general/test_%d.html" % (i % 700)
+        if i % 5000 == 0:
+            lines.append(u"%d ERROR TEST-UNEXPECTED-FAIL | %s | Error: bad" % (i, test))
+        elif i % 3 == 0:
+            lines.append(u"%d INFO TEST-START | %s" % (i, test))
+        else:
+            lines.append(u"%d INFO TEST-PASS | %s | %s" % (i, test, "x" * random.randint(10, 80)))
+    return lines
+
+
+def read_log(path):
+    fh = open(path)
+    try:
+        return [l.decode('utf-8', 'replace').rstrip() for l in fh if l.strip()]
+    finally:
+        fh.close()
+
+
+def walk_error_list(error_list, line):
+    """The pre-ErrorListMatcher OutputParser.parse_single_line() loop."""
+    for error_check in error_list:
+        if 'substr' in error_check:
+            if error_check['substr'] in line:
+                return error_check
+        elif error_check['regex'].search(line):
+            return error_check
+
+
+def main(paths):
+    if paths:
+        lines = []
+        for path in paths:
+            lines.extend(read_log(path))
+    else:
+        lines = synthetic_log()
+    print "%d lines" % len(lines)
+    for name, error_list in ERROR_LISTS:
+        start = time.time()
+        expected = [walk_error_list(error_list, l) for l in lines]
+        walk_time = time.time() - start
+
+        start = time.time()
+        matcher = ErrorListMatcher(error_list)
+        got = [matcher.match(l) for l in lines]
+        matcher_time = time.time() - start
+
+        assert [id(e) for e in expected] == [id(e) for e in got], \
+            "%s: ErrorListMatcher disagrees with the error_list walk!" % name
+        print "%-22s %3d entries: walk %.3fs, matcher %.3fs (%.1fx)" % (
+            name, len(error_list), walk_time, matcher_time,
+            walk_time / max(matcher_time, 1e-6))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
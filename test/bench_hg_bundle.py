@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""Benchmark for bootstrapping MercurialVCS.clone() from a bundle.
+
+Builds a local test repo, serves it with `hg serve`, and times a plain
+clone over http against unbundling a pre-generated bundle of all but the
+last few changesets and pulling the rest.
+
+    python test/bench_hg_bundle.py [changesets [files]]
+
+Defaults to 2000 changesets touching 200 files.  Needs hg on the PATH.
+Not run as part of the unit tests.
+"""
+
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mozharness.base.vcs.mercurial import MercurialVCS
+
+# Changesets left out of the bundle, i.e. pulled after unbundling.
+NEW_CHANGESETS = 10
+
+
+def make_repo(path, changesets, files):
+    subprocess.check_call(['hg', 'init', path])
+    for i in range(changesets):
+        fh = open(os.path.join(path, 'file%d.txt' % (i % files)), 'a')
+        fh.write("Line %d: %s\n" % (i, os.urandom(32).encode('hex')))
+        fh.close()
+        subprocess.check_call(['hg', 'commit', '-q', '-A', '-u', 'bench',
+                               '-m', 'Change %d' % i], cwd=path)
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def timed_clone(repo, dest, bundle=None):
+    m = MercurialVCS(config={'log_to_console': False},
+                     vcs_config={'repo': repo, 'dest': dest, 'bundle': bundle})
+    start = time.time()
+    m.clone(repo, dest)
+    return time.time() - start
+
+
+def main(changesets=2000, files=200):
+    tmpdir = tempfile.mkdtemp()
+    repo = os.path.join(tmpdir, 'repo')
+    bundle = os.path.join(tmpdir, 'repo.hg')
+    pid_file = os.path.join(tmpdir, 'hg.pid')
+    try:
+        print "Creating a repo with %d changesets..." % changesets
+        make_repo(repo, changesets, files)
+        subprocess.check_call(['hg', 'bundle', '-q', '--all', '-r',
+                               str(changesets - NEW_CHANGESETS - 1), bundle],
+                              cwd=repo)
+        port = free_port()
+        subprocess.check_call(['hg', 'serve', '-d', '-a', '127.0.0.1',
+                               '-p', str(port), '--pid-file', pid_file],
+                              cwd=repo)
+        url = 'http://127.0.0.1:%d/' % port
+        try:
+            plain = timed_clone(url, os.path.join(tmpdir, 'plain'))
+            bundled = timed_clone(url, os.path.join(tmpdir, 'bundled'), bundle)
+        finally:
+            os.kill(int(open(pid_file).read().strip()), 15)
+        print "plain clone %.2fs, bundle + pull of %d changesets %.2fs (%.1fx)" % (
+            plain, NEW_CHANGESETS, bundled, plain / max(bundled, 1e-6))
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
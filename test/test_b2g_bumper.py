@@ -0,0 +1,130 @@
+import imp
+import json
+import os
+import shutil
+import unittest
+
+MH_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+b2g_bumper = imp.load_source(
+    'b2g_bumper', os.path.join(MH_DIR, 'scripts', 'b2g_bumper.py'))
+
+REMOTE = 'https://git.mozilla.org/b2g/gaia.git'
+REFS = [
+    ('HEAD', 'aaa'),
+    ('refs/heads/master', 'aaa'),
+    ('refs/heads/v1.4', 'bbb'),
+    ('refs/tags/v1.4', 'ccc'),
+]
+
+
+class B2GBumperTest(b2g_bumper.B2GBumper):
+    def __init__(self, **kwargs):
+        config = {'log_to_console': False, 'gecko_local_dir': 'gecko'}
+        config.update(kwargs)
+        super(b2g_bumper.B2GBumper, self).__init__(
+            config=config, initial_config_file='test/test.json')
+        self.device_manifests = {}
+        self._remote_refs = {}
+        self._cached_remotes = set()
+        self.ls_remote_calls = []
+        self.refs = list(REFS)
+
+    def ls_remote(self, remote_url):
+        self.ls_remote_calls.append(remote_url)
+        return list(self.refs)
+
+
+class TestRemoteRefs(unittest.TestCase):
+    def tearDown(self):
+        for d in ('logs', 'build'):
+            shutil.rmtree(d, ignore_errors=True)
+
+    def _age_cache(self, b, seconds):
+        path = b._query_remote_refs_cache_path(REMOTE)
+        fh = open(path)
+        cached = json.load(fh)
+        fh.close()
+        cached['time'] -= seconds
+        fh = open(path, 'w')
+        json.dump(cached, fh)
+        fh.close()
+
+    def test_once_per_run(self):
+        b = B2GBumperTest()
+        self.assertEquals(b.query_remote_refs(REMOTE), REFS)
+        self.assertEquals(b.query_remote_refs(REMOTE), REFS)
+        self.assertEquals(b.ls_remote_calls, [REMOTE])
+
+    def test_cache_hit(self):
+        B2GBumperTest().query_remote_refs(REMOTE)
+        b = B2GBumperTest()
+        b.refs = []
+        self.assertEquals(b.query_remote_refs(REMOTE), REFS)
+        self.assertEquals(b.ls_remote_calls, [])
+
+    def test_cache_expired(self):
+        B2GBumperTest(git_ref_cache_ttl=60).query_remote_refs(REMOTE)
+        b = B2GBumperTest(git_ref_cache_ttl=60)
+        self._age_cache(b, 61)
+        b.refs = REFS[:2]
+        self.assertEquals(b.query_remote_refs(REMOTE), REFS[:2])
+        self.assertEquals(b.ls_remote_calls, [REMOTE])
+
+    def test_cache_from_the_future(self):
+        B2GBumperTest().query_remote_refs(REMOTE)
+        b = B2GBumperTest()
+        self._age_cache(b, -3600)
+        b.query_remote_refs(REMOTE)
+        self.assertEquals(b.ls_remote_calls, [REMOTE])
+
+    def test_cache_disabled(self):
+        B2GBumperTest(git_ref_cache_ttl=0).query_remote_refs(REMOTE)
+        b = B2GBumperTest(git_ref_cache_ttl=0)
+        b.query_remote_refs(REMOTE)
+        self.assertEquals(b.ls_remote_calls, [REMOTE])
+
+    def test_missing_ref_refetched(self):
+        b = B2GBumperTest()
+        b.refs = REFS[:2]
+        b.query_remote_refs(REMOTE)
+        b = B2GBumperTest()
+        self.assertEquals(b.resolve_git_ref(REMOTE, 'v2.0'), None)
+        self.assertEquals(b.ls_remote_calls, [REMOTE])
+        # The new refs replace the cached ones.
+        self.assertEquals(b.resolve_git_ref(REMOTE, 'v1.4'), 'bbb')
+        self.assertEquals(b.ls_remote_calls, [REMOTE])
+        self.assertEquals(B2GBumperTest().query_remote_refs(REMOTE), REFS)
+
+    def test_missing_ref_not_cached(self):
+        b = B2GBumperTest()
+        self.assertEquals(b.resolve_git_ref(REMOTE, 'v2.0'), None)
+        self.assertEquals(b.ls_remote_calls, [REMOTE])
+
+    def test_ls_remote_fails(self):
+        b = B2GBumperTest()
+        b.ls_remote = lambda remote_url: None
+        self.assertEquals(b.resolve_git_ref(REMOTE, 'master'), None)
+        self.assertFalse(os.path.exists(b._query_remote_refs_cache_path(REMOTE)))
+
+
+class TestResolveGitRef(unittest.TestCase):
+    def setUp(self):
+        self.b = B2GBumperTest(git_ref_cache_ttl=0)
+
+    def tearDown(self):
+        for d in ('logs', 'build'):
+            shutil.rmtree(d, ignore_errors=True)
+
+    def test_branch(self):
+        self.assertEquals(self.b.resolve_git_ref(REMOTE, 'master'), 'aaa')
+
+    def test_full_ref(self):
+        self.assertEquals(self.b.resolve_git_ref(REMOTE, 'refs/tags/v1.4'), 'ccc')
+
+    def test_first_match_wins(self):
+        self.assertEquals(self.b.resolve_git_ref(REMOTE, 'v1.4'), 'bbb')
+
+    def test_partial_component(self):
+        self.assertEquals(self.b.resolve_git_ref(REMOTE, 'ster'), None)
+        self.assertEquals(self.b.resolve_git_ref(REMOTE, '1.4'), None)
@@ -1,9 +1,12 @@
 import os
+import re
 import shutil
 import subprocess
 import unittest
 
+import mozharness.base.errors as errors
 import mozharness.base.log as log
+from mozharness.base.log import INFO, ERROR, WARNING, CRITICAL, FATAL
 
 tmp_dir = "test_log_dir"
 log_name = "test"
@@ -38,5 +41,150 @@ class TestLog(unittest.TestCase):
         self.assertTrue(os.path.exists(get_log_file_path()))
         del(l)
 
+
+class ListLogger(object):
+    def __init__(self):
+        self.messages = []
+
+    def log_message(self, message, level=INFO, exit_code=-1, post_fatal_callback=None):
+        self.messages.append((message, level))
+
+
+class TestPrefixLogger(unittest.TestCase):
+    def test_prefix(self):
+        logger = ListLogger()
+        l = log.PrefixLogger(logger, 'mochitest-1: ')
+        l.log_message('one\ntwo', level=WARNING)
+        self.assertEqual(logger.messages,
+                         [('mochitest-1: one\nmochitest-1: two', WARNING)])
+        self.assertTrue(l.messages is logger.messages)
+
+
+class TestErrorListMatcher(unittest.TestCase):
+    def _walk(self, error_list, line):
+        for error_check in error_list:
+            if 'substr' in error_check:
+                if error_check['substr'] in line:
+                    return error_check
+            elif error_check['regex'].search(line):
+                return error_check
+
+    def test_regex_gate(self):
+        self.assertEqual(log.query_regex_gate(re.compile(r'^abort:')), 'abort:')
+        self.assertEqual(log.query_regex_gate(re.compile(r'make\[\d+\]: \*\*\* \[')), ']: *** [')
+        self.assertEqual(log.query_regex_gate(re.compile(r'(foo|bar)')), '')
+        self.assertEqual(log.query_regex_gate(re.compile(r'abort', re.I)), '')
+
+    def test_first_match_wins(self):
+        error_list = [
+            {'substr': 'later in the line', 'level': WARNING},
+            {'regex': re.compile(r'^ERROR'), 'level': ERROR},
+        ]
+        matcher = log.ErrorListMatcher(error_list)
+        self.assertTrue(matcher.match('ERROR: later in the line') is error_list[0])
+        self.assertTrue(matcher.match('ERROR: something') is error_list[1])
+        self.assertEqual(matcher.match('all good'), None)
+
+    def test_shadowed_entries_dropped(self):
+        matcher = log.ErrorListMatcher(errors.MakefileErrorList)
+        self.assertTrue(len(matcher.checks) < len(errors.MakefileErrorList))
+
+    def test_matches_error_list_walk(self):
+        lines = [
+            'abort: push creates new remote head',
+            'foo.cpp:12: error: expected ;',
+            'make[1]: *** [libs] Error 2',
+            'Traceback (most recent call last):',
+            'raise SomeException: oops',
+            'bash: hg: command not found',
+            'Warning: Error: ',
+            'nothing to see here',
+        ]
+        for error_list in (errors.HgErrorList, errors.MakefileErrorList,
+                           errors.VirtualenvErrorList, errors.SSHErrorList):
+            matcher = log.ErrorListMatcher(error_list)
+            for line in lines:
+                self.assertTrue(matcher.match(line) is self._walk(error_list, line),
+                                msg=line)
+
+    def test_compile_error_list_cache(self):
+        error_list = list(errors.HgErrorList)
+        matcher = log.compile_error_list(error_list)
+        self.assertTrue(log.compile_error_list(error_list) is matcher)
+        error_list.append({'substr': 'new entry', 'level': ERROR})
+        self.assertFalse(log.compile_error_list(error_list) is matcher)
+
+    def test_compile_error_list_cache_bounded(self):
+        matcher = log.compile_error_list(errors.HgErrorList)
+        for i in range(log.MAX_ERROR_LIST_MATCHERS * 2):
+            log.compile_error_list(errors.HgErrorList + [{'substr': str(i), 'level': ERROR}])
+            # Lists in use stay cached.
+            self.assertTrue(log.compile_error_list(errors.HgErrorList) is matcher)
+        self.assertEqual(len(log._error_list_matchers), log.MAX_ERROR_LIST_MATCHERS)
+
+    def test_invalid_entry(self):
+        parser = log.OutputParser(config={'log_level': 'fatal'},
+                                  error_list=[{'level': ERROR}, {'substr': 'bad', 'level': ERROR}])
+        parser.parse_single_line('bad things')
+        self.assertEqual(parser.num_errors, 1)
+
+
+class RecordingLogger(object):
+    def __init__(self):
+        self.messages = []
+
+    def log_message(self, message, level=INFO, **kwargs):
+        self.messages.append((message.strip(), level))
+
+
+class TestContextLines(unittest.TestCase):
+    def _parse(self, error_list, lines):
+        log_obj = RecordingLogger()
+        parser = log.OutputParser(config={}, log_obj=log_obj,
+                                  error_list=error_list)
+        parser.add_lines(lines)
+        return parser, log_obj.messages
+
+    def test_parse_context_lines(self):
+        self.assertEqual(log.parse_context_lines('5:5'), (5, 5))
+        self.assertEqual(log.parse_context_lines('20:'), (20, 0))
+        self.assertEqual(log.parse_context_lines(':3'), (0, 3))
+        self.assertEqual(log.parse_context_lines((1, 2)), (1, 2))
+        self.assertEqual(log.parse_context_lines(None), (0, 0))
+        self.assertRaises(ValueError, log.parse_context_lines, '5')
+
+    def test_buffer_is_bounded(self):
+        error_list = [{'substr': 'boom', 'level': ERROR, 'context_lines': '3:0'}]
+        parser, _ = self._parse(error_list, ['line %d' % i for i in range(100)])
+        self.assertEqual(parser.context_buffer.maxlen, 3)
+        self.assertEqual(len(parser.context_buffer), 3)
+
+    def test_context(self):
+        error_list = [{'substr': 'boom', 'level': ERROR, 'context_lines': '2:1'}]
+        parser, messages = self._parse(
+            error_list, ['one', 'two', 'three', 'boom', 'four', 'five'])
+        self.assertEqual(messages, [
+            ('one', INFO), ('two', INFO), ('three', INFO),
+            ('two', ERROR), ('three', ERROR), ('boom', ERROR),
+            ('four', ERROR), ('five', INFO),
+        ])
+        # Context lines don't count as errors.
+        self.assertEqual(parser.num_errors, 1)
+
+    def test_context_not_repeated(self):
+        error_list = [{'substr': 'boom', 'level': ERROR, 'context_lines': '2:0'}]
+        _, messages = self._parse(error_list, ['one', 'boom', 'boom'])
+        self.assertEqual(messages, [
+            ('one', INFO), ('one', ERROR), ('boom', ERROR), ('boom', ERROR),
+        ])
+
+    def test_fatal_context(self):
+        error_list = [{'substr': 'boom', 'level': FATAL, 'context_lines': '1:0'}]
+        log_obj = RecordingLogger()
+        parser = log.OutputParser(config={}, log_obj=log_obj,
+                                  error_list=error_list)
+        parser.add_lines(['one', 'boom'])
+        self.assertEqual(log_obj.messages[1], ('one', CRITICAL))
+
 if __name__ == '__main__':
     unittest.main()
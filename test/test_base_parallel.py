@@ -1,6 +1,9 @@
+import shutil
+import threading
 import unittest
 
-from mozharness.base.parallel import ChunkingMixin
+from mozharness.base.parallel import ChunkingMixin, ParallelMixin
+from mozharness.base.script import BaseScript
 
 
 class TestChunkingMixin(unittest.TestCase):
@@ -24,3 +27,37 @@ class TestChunkingMixin(unittest.TestCase):
         self.assertEquals(self.c.query_chunked_list(thing, 1, 3), [1, 3, 6])
         self.assertEquals(self.c.query_chunked_list(thing, 2, 3), [4, 3])
         self.assertEquals(self.c.query_chunked_list(thing, 3, 3), [2, 6])
+
+
+class ParallelScript(ParallelMixin, BaseScript):
+    pass
+
+
+class TestParallelMixin(unittest.TestCase):
+    def setUp(self):
+        self.s = ParallelScript(config={'log_to_console': False},
+                                initial_config_file='test/test.json')
+
+    def tearDown(self):
+        for d in ('logs', 'build'):
+            shutil.rmtree(d, ignore_errors=True)
+
+    def test_run_in_parallel(self):
+        started = []
+        all_started = threading.Event()
+
+        def boot(n):
+            started.append(n)
+            if len(started) == 3:
+                all_started.set()
+            # Only succeeds if all the items are running at once.
+            self.assertTrue(all_started.wait(5))
+            return n * 2
+        results = dict(self.s.run_in_parallel(boot, [1, 2, 3], num_workers=3))
+        self.assertEquals(results, {1: 2, 2: 4, 3: 6})
+
+    def test_serial(self):
+        order = []
+        results = list(self.s.run_in_parallel(order.append, [3, 1, 2]))
+        self.assertEquals(order, [3, 1, 2])
+        self.assertEquals(results, [(3, None), (1, None), (2, None)])
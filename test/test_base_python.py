@@ -1,7 +1,12 @@
+import mock
 import os
+import shutil
+import threading
+import types
 import unittest
 
 import mozharness.base.python as python
+from mozharness.base.script import BaseScript
 
 here = os.path.dirname(os.path.abspath(__file__))
 
@@ -33,5 +38,84 @@ class TestVirtualenvMixin(unittest.TestCase):
         self.assertEqual(packages, expected)
 
 
+class ResourceScript(python.VirtualenvMixin, python.ResourceMonitoringMixin, BaseScript):
+    pass
+
+
+class FakeResourceMonitor(object):
+    start_time = None
+    started = threading.Event()
+
+    def __init__(self, poll_interval):
+        self.phases = []
+        self.running = set()
+
+    def start(self):
+        FakeResourceMonitor.started.set()
+
+    def stop(self):
+        pass
+
+    def begin_phase(self, name):
+        self.running.add(name)
+
+    def finish_phase(self, name):
+        # SystemResourceMonitor asserts the phase was begun.
+        assert name in self.running
+        self.running.remove(name)
+        self.phases.append(name)
+
+
+class ParallelResourceScript(ResourceScript):
+    """fetch starts before create-virtualenv and finishes after it."""
+    def __init__(self, **kwargs):
+        super(ParallelResourceScript, self).__init__(
+            config={'log_to_console': False},
+            all_actions=['fetch', 'create-virtualenv', 'build'],
+            action_dependencies={'fetch': [], 'create-virtualenv': []},
+            initial_config_file='test/test.json', **kwargs)
+        self.fetch_started = threading.Event()
+
+    def fetch(self):
+        self.fetch_started.set()
+        assert FakeResourceMonitor.started.wait(5)
+
+    def create_virtualenv(self):
+        assert self.fetch_started.wait(5)
+
+    def activate_virtualenv(self):
+        pass
+
+    def build(self):
+        pass
+
+
+class TestResourceMonitoringMixin(unittest.TestCase):
+    def tearDown(self):
+        for d in ('logs', 'build'):
+            shutil.rmtree(d, ignore_errors=True)
+
+    def test_resource_timings(self):
+        s = ResourceScript(config={'log_to_console': False},
+                           initial_config_file='test/test.json')
+        s.record_resource_timing('emulator-1 startup', 42.4)
+        with mock.patch.object(s, 'info') as info:
+            s._resource_record_post_run()
+        info.assert_called_once_with('emulator-1 startup - Wall time: 42s')
+
+    def test_action_spans_create_virtualenv(self):
+        resourcemonitor = types.ModuleType('mozsystemmonitor.resourcemonitor')
+        resourcemonitor.SystemResourceMonitor = FakeResourceMonitor
+        FakeResourceMonitor.started.clear()
+        s = ParallelResourceScript()
+        with mock.patch.dict('sys.modules', {
+                'mozsystemmonitor': types.ModuleType('mozsystemmonitor'),
+                'mozsystemmonitor.resourcemonitor': resourcemonitor}):
+            self.assertEqual(s.run(), 0)
+        # fetch was already running when the monitor started.
+        self.assertEqual(s._resource_monitor.phases, ['build'])
+        self.assertEqual(s._resource_phases, set())
+
+
 if __name__ == '__main__':
     unittest.main()
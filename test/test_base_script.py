@@ -1,9 +1,17 @@
+import BaseHTTPServer
 import gc
+import hashlib
 import mock
 import os
 import re
+import SocketServer
+import subprocess
+import tarfile
+import threading
+import time
 import types
 import unittest
+import zipfile
 PYWIN32 = False
 if os.name == 'nt':
     try:
@@ -251,6 +259,42 @@ class TestScript(unittest.TestCase):
         self.assertTrue(error_logsize > 0,
                         msg="error list not working properly")
 
+    def test_run_command_parses_all_output(self):
+        self.s = get_debug_script_obj()
+        num_errors = self.s.run_command(
+            ["bash", "-c", "for i in $(seq 1 500); do echo error $i; done; printf 'error last'"],
+            error_list=[{'substr': 'error', 'level': ERROR}],
+            return_type='num_errors')
+        self.assertEqual(num_errors, 501)
+
+    @unittest.skipIf(os.name == "nt", "Not for Windows")
+    def test_run_command_output_timeout(self):
+        self.s = get_debug_script_obj()
+        start = time.time()
+        status = self.s.run_command(["bash", "-c", "echo start; sleep 30; echo done"],
+                                    output_timeout=1)
+        self.assertNotEqual(status, 0)
+        self.assertTrue(time.time() - start < 20,
+                        msg="output_timeout didn't kill the command")
+
+    @unittest.skipIf(os.name == "nt", "Not for Windows")
+    def test_run_command_output_timeout_shell(self):
+        self.s = get_debug_script_obj()
+        start = time.time()
+        status = self.s.run_command("echo start; sleep 30 | cat; echo done",
+                                    output_timeout=1)
+        self.assertNotEqual(status, 0)
+        self.assertTrue(time.time() - start < 20,
+                        msg="output_timeout didn't kill the command")
+
+    @unittest.skipIf(os.name == "nt", "Not for Windows")
+    def test_setsid_command(self):
+        output = subprocess.check_output(script.query_setsid_command(
+            "echo $$ $(ps -o pgid= $$)", shell=True))
+        pid, pgid = output.split()
+        # The command leads its own process group.
+        self.assertEqual(pid, pgid)
+        self.assertNotEqual(int(pgid), os.getpgrp())
 
 # TestHelperFunctions {{{1
 class TestHelperFunctions(unittest.TestCase):
@@ -285,6 +329,48 @@ class TestHelperFunctions(unittest.TestCase):
         self.assertEqual(test_string, contents,
                          msg="get_output_from_command('cat file') differs from fh.write")
 
+    def test_get_output_from_command_keep_lines(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        command = ["bash", "-c", "seq 1 1000"]
+        self.assertEqual(self.s.get_output_from_command(command, keep_first_lines=2),
+                         "1\n2")
+        self.assertEqual(self.s.get_output_from_command(command, keep_last_lines=2),
+                         "999\n1000")
+        self.assertEqual(self.s.get_output_from_command(command, keep_first_lines=1,
+                                                        keep_last_lines=1),
+                         "1\n1000")
+        self.assertEqual(self.s.get_output_from_command(command, keep_first_lines=600,
+                                                        keep_last_lines=600),
+                         self.s.get_output_from_command(command))
+
+    def test_get_output_from_command_silent(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        output = self.s.get_output_from_command(["bash", "-c", "echo foo; echo"],
+                                                silent=True)
+        self.assertEqual(output, "foo\n\n")
+
+    def test_get_output_from_command_generator(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        lines = self.s.get_output_from_command(
+            ["bash", "-c", "seq 1 3; echo oops >&2"], return_type='generator')
+        self.assertEqual(list(lines), ['1', '2', '3'])
+
+    def test_get_output_from_command_generator_throw(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        lines = self.s.get_output_from_command(["bash", "-c", "echo 1; exit 3"],
+                                               return_type='generator',
+                                               throw_exception=True)
+        self.assertEqual(lines.next(), '1')
+        self.assertRaises(subprocess.CalledProcessError, lines.next)
+
+    def test_get_output_from_command_tmpfiles(self):
+        self._create_temp_file()
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        stdout_file, stderr_file = self.s.get_output_from_command(
+            ["bash", "-c", "cat %s" % self.temp_file], return_type='files',
+            save_tmpfiles=True)
+        self.assertEqual(open(stdout_file).read(), test_string)
+
     def test_run_command(self):
         self._create_temp_file()
         self.s = script.BaseScript(initial_config_file='test/test.json')
@@ -319,6 +405,167 @@ class TestHelperFunctions(unittest.TestCase):
                          msg="%s and %s are different sizes after copyfile()" %
                              (self.temp_file, temp_file2))
 
+    def _download_cache_script(self, **kwargs):
+        config = {'download_cache_dir': 'test_dir/cache'}
+        config.update(kwargs)
+        return script.BaseScript(config=config,
+                                 initial_config_file='test/test.json')
+
+    def test_download_file_cache_hit(self):
+        self._create_temp_file()
+        self.s = self._download_cache_script()
+        url = 'file://%s' % os.path.abspath(self.temp_file)
+        self.assertEqual(self.s.download_file(url, 'one', parent_dir='test_dir'),
+                         os.path.join('test_dir', 'one'))
+        with mock.patch.object(self.s, '_retry_download_file') as download:
+            self.s.download_file(url, 'two', parent_dir='test_dir')
+            self.assertFalse(download.called)
+        self.assertEqual(open('test_dir/two').read(), test_string)
+        # Changing a copy doesn't touch the cache.
+        os.chmod('test_dir/one', 0644)
+        open('test_dir/one', 'w').write('changed')
+        with mock.patch.object(self.s, '_retry_download_file') as download:
+            self.s.download_file(url, 'three', parent_dir='test_dir')
+            self.assertFalse(download.called)
+        self.assertEqual(open('test_dir/three').read(), test_string)
+
+    def test_download_file_cache_corrupt(self):
+        self._create_temp_file()
+        self.s = self._download_cache_script()
+        url = 'file://%s' % os.path.abspath(self.temp_file)
+        self.s.download_file(url, 'one', parent_dir='test_dir')
+        cache = self.s.query_download_cache()
+        object_path = cache.query_object_path(hashlib.sha512(test_string).hexdigest())
+        os.chmod(object_path, 0644)
+        open(object_path, 'w').write('corrupt')
+        self.assertEqual(self.s.download_file(url, 'two', parent_dir='test_dir'),
+                         os.path.join('test_dir', 'two'))
+        self.assertEqual(open('test_dir/two').read(), test_string)
+        self.assertEqual(open(object_path).read(), test_string)
+
+    def test_download_file_cache_evicted(self):
+        self._create_temp_file()
+        self.s = self._download_cache_script()
+        url = 'file://%s' % os.path.abspath(self.temp_file)
+        self.s.download_file(url, 'one', parent_dir='test_dir')
+        cache = self.s.query_download_cache()
+        copy = cache.copy
+
+        def evict_then_copy(sha512, dest):
+            # Another process evicts the object as we go to copy it.
+            if os.path.exists(cache.query_object_path(sha512) or ''):
+                os.remove(cache.query_object_path(sha512))
+            return copy(sha512, dest)
+        with mock.patch.object(cache, 'copy', side_effect=evict_then_copy):
+            # The cached copy and then the one we download into the cache
+            # are both evicted, so we end up downloading it directly.
+            self.assertEqual(self.s.download_file(url, 'two', parent_dir='test_dir'),
+                             os.path.join('test_dir', 'two'))
+        self.assertEqual(open('test_dir/two').read(), test_string)
+        self.assertEqual(self.s.download_file(url, 'three', parent_dir='test_dir'),
+                         os.path.join('test_dir', 'three'))
+        self.assertEqual(open('test_dir/three').read(), test_string)
+
+    def test_download_file_cache_changed(self):
+        self._create_temp_file()
+        self.s = self._download_cache_script()
+        url = 'file://%s' % os.path.abspath(self.temp_file)
+        self.s.download_file(url, 'one', parent_dir='test_dir')
+        fh = open(self.temp_file, 'w')
+        fh.write('changed')
+        fh.close()
+        later = time.time() + 10
+        os.utime(self.temp_file, (later, later))
+        self.s.download_file(url, 'two', parent_dir='test_dir')
+        self.assertEqual(open('test_dir/one').read(), test_string)
+        self.assertEqual(open('test_dir/two').read(), 'changed')
+
+    def test_download_file_cache_sha512(self):
+        self._create_temp_file()
+        self.s = self._download_cache_script()
+        url = 'file://%s' % os.path.abspath(self.temp_file)
+        sha512 = hashlib.sha512(test_string).hexdigest()
+        self.assertEqual(self.s.download_file(url, 'one', parent_dir='test_dir',
+                                              sha512='0' * 128), None)
+        self.assertEqual(self.s.download_file(url, 'one', parent_dir='test_dir',
+                                              sha512=sha512),
+                         os.path.join('test_dir', 'one'))
+        with mock.patch.object(self.s, '_query_url_headers') as head:
+            self.s.download_file('file:///nonexistent', 'two',
+                                 parent_dir='test_dir', sha512=sha512)
+            self.assertFalse(head.called)
+        self.assertEqual(open('test_dir/two').read(), test_string)
+
+    def test_download_file_cache_evict(self):
+        self.s = self._download_cache_script(download_cache_max_size=len(test_string) + 10)
+        os.mkdir('test_dir')
+        for name in ('a', 'b'):
+            fh = open(os.path.join('test_dir', name), 'w')
+            fh.write(name + test_string)
+            fh.close()
+            self.s.download_file('file://%s' % os.path.abspath(os.path.join('test_dir', name)),
+                                 name + '.out', parent_dir='test_dir')
+        cache = self.s.query_download_cache()
+        self.assertEqual(os.listdir(cache.objects_dir),
+                         [hashlib.sha512('b' + test_string).hexdigest()])
+
+    def _create_zip(self):
+        os.mkdir('test_dir')
+        bundle = zipfile.ZipFile('test_dir/test.zip', 'w', zipfile.ZIP_DEFLATED)
+        bundle.writestr('bin/xpcshell', test_string)
+        bundle.getinfo('bin/xpcshell').external_attr = 0755 << 16
+        bundle.writestr('bin/components/foo.js', 'foo')
+        bundle.writestr('mochitest/bar.html', 'bar' * 10000)
+        bundle.writestr('../evil', 'evil')
+        bundle.close()
+
+    def test_extract_zip(self):
+        self._create_zip()
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        self.assertEqual(self.s.extract_zip('test_dir/test.zip', 'test_dir/out'), 0)
+        self.assertEqual(open('test_dir/out/bin/xpcshell').read(), test_string)
+        self.assertEqual(os.stat('test_dir/out/bin/xpcshell').st_mode & 0777, 0755)
+        self.assertEqual(open('test_dir/out/mochitest/bar.html').read(), 'bar' * 10000)
+        self.assertFalse(os.path.exists('test_dir/evil'))
+
+    def test_extract_zip_members(self):
+        self._create_zip()
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        self.assertEqual(self.s.extract_zip('test_dir/test.zip', 'test_dir/out',
+                                            members=['bin/*']), 0)
+        self.assertTrue(os.path.exists('test_dir/out/bin/components/foo.js'))
+        self.assertFalse(os.path.exists('test_dir/out/mochitest'))
+        self.assertEqual(self.s.extract_zip('test_dir/test.zip', 'test_dir/out',
+                                            members=['nothing/*']), 11)
+
+    def test_extract_zip_skips_current_files(self):
+        self._create_zip()
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        self.s.extract_zip('test_dir/test.zip', 'test_dir/out')
+        fh = open('test_dir/out/bin/xpcshell', 'w')
+        fh.write(test_string.upper())
+        fh.close()
+        with mock.patch.object(self.s, '_extract_zip_member') as extract:
+            self.s.extract_zip('test_dir/test.zip', 'test_dir/out')
+            self.assertEqual([c[0][1].filename for c in extract.call_args_list],
+                             ['bin/xpcshell'])
+
+    def test_unpack_tar(self):
+        os.mkdir('test_dir')
+        fh = open('test_dir/foo', 'w')
+        fh.write(test_string)
+        fh.close()
+        tar = tarfile.open('test_dir/test.tar.bz2', 'w:bz2')
+        tar.add('test_dir/foo', 'a/foo')
+        tar.add('test_dir/foo', 'b/foo')
+        tar.close()
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        self.assertEqual(self.s.unpack('test_dir/test.tar.bz2', 'test_dir/out',
+                                       members=['a/*']), 0)
+        self.assertEqual(open('test_dir/out/a/foo').read(), test_string)
+        self.assertFalse(os.path.exists('test_dir/out/b'))
+        self.assertRaises(SystemExit, self.s.unpack, 'test_dir/foo', 'test_dir/out')
+
     def test_existing_rmtree(self):
         self._create_temp_file()
         self.s = script.BaseScript(initial_config_file='test/test.json')
@@ -422,6 +669,37 @@ class TestHelperFunctions(unittest.TestCase):
         self.assertEqual(contents, None)
 
 
+class TestOutputPump(unittest.TestCase):
+    def test_remove_stream(self):
+        read_fd, write_fd = os.pipe()
+        lines = []
+        pump = script.OutputPump()
+        pump.add_stream(read_fd, lines.extend)
+        os.write(write_fd, "one\ntwo\nthr")
+        self.assertTrue(pump.pump(1))
+        self.assertEqual(lines, ['one', 'two'])
+        os.write(write_fd, "ee")
+        # write_fd is still open, so there's no EOF to wait for.
+        pump.remove_stream(read_fd)
+        self.assertEqual(lines, ['one', 'two', 'three'])
+        self.assertEqual(pump.streams, {})
+        os.close(read_fd)
+        os.close(write_fd)
+
+    def test_pump_after_eof(self):
+        read_fd, write_fd = os.pipe()
+        pump = script.OutputPump()
+        pump.add_stream(read_fd, lambda lines: None)
+        os.close(write_fd)
+        pump.pump(1)
+        self.assertEqual(pump.streams, {})
+        os.close(read_fd)
+        # Nothing left to wait for, but it still waits for timeout.
+        with mock.patch.object(script.time, 'sleep') as sleep:
+            self.assertFalse(pump.pump(1))
+            sleep.assert_called_once_with(1)
+
+
 # TestScriptLogging {{{1
 class TestScriptLogging(unittest.TestCase):
     # I need a log watcher helper function, here and in test_log.
@@ -615,6 +893,174 @@ class TestRetry(unittest.TestCase):
         self.assertEqual(ret[1], kwargs)
 
 
+class RangeRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serve self.server.content, honouring Range headers if
+    self.server.ranges is set.  The first response for a range starting
+    at self.server.truncate_at is cut short.
+    """
+    def do_GET(self):
+        server = self.server
+        content = server.content
+        start, end = 0, len(content) - 1
+        m = re.match(r'bytes=(\d*)-(\d+)$', self.headers.get('Range', ''))
+        if m and not m.group(1):
+            # The last n bytes.
+            m = (max(0, len(content) - int(m.group(2))), len(content) - 1)
+        elif m:
+            m = (int(m.group(1)), int(m.group(2)))
+        server.requests.append(m)
+        if m and server.ranges:
+            start, end = m
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes %d-%d/%d' % (start, end, len(content)))
+        else:
+            self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('ETag', '"abc"')
+        self.end_headers()
+        body = content[start:end + 1]
+        if m and start == server.truncate_at:
+            server.truncate_at = None
+            body = body[:len(body) // 2]
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.server.requests.append('HEAD')
+        self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(len(self.server.content)))
+        self.send_header('ETag', '"abc"')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class RangeHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients hang up on the whole-file response once they've read the
+        # first segment.
+        pass
+
+
+class RangeServerTestCase(unittest.TestCase):
+    def setUp(self):
+        cleanup()
+        os.mkdir('test_dir')
+        self.server = RangeHTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+        self.server.content = ''.join(chr(i % 251) for i in range(100 * 1024))
+        self.server.ranges = True
+        self.server.truncate_at = None
+        self.server.requests = []
+        self.url = 'http://127.0.0.1:%d/file' % self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.s = script.BaseScript(config={'download_segments': 4,
+                                           'download_min_segment_size': 10 * 1024},
+                                   initial_config_file='test/test.json')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        del self.s
+        cleanup()
+
+
+class TestDownloadFile(RangeServerTestCase):
+    def test_segmented(self):
+        self.assertEqual(self.s.download_file(self.url, parent_dir='test_dir'),
+                         'test_dir/file')
+        self.assertEqual(open('test_dir/file', 'rb').read(), self.server.content)
+        # The first segment comes from the initial request for the whole file.
+        self.assertEqual(sorted(self.server.requests[1:]),
+                         [(25600, 51199), (51200, 76799), (76800, 102399)])
+
+    def test_resume(self):
+        self.server.truncate_at = 51200
+        with mock.patch('time.sleep'):
+            self.assertEqual(self.s.download_file(self.url, parent_dir='test_dir'),
+                             'test_dir/file')
+        self.assertEqual(open('test_dir/file', 'rb').read(), self.server.content)
+        # Only the rest of the broken segment is fetched again.
+        self.assertEqual(self.server.requests[-1], (51200 + 12800, 76799))
+
+    def test_segment_short(self):
+        # A segment that stops early without an error still fails the
+        # download, even though the file is already its full length.
+        with mock.patch.object(self.s, '_download_segment'):
+            with mock.patch('time.sleep'):
+                self.assertEqual(self.s.download_file(self.url, parent_dir='test_dir'),
+                                 None)
+
+    def test_range_ignored(self):
+        self.server.ranges = False
+        with mock.patch('time.sleep'):
+            self.assertEqual(self.s.download_file(self.url, parent_dir='test_dir'),
+                             'test_dir/file')
+        self.assertEqual(open('test_dir/file', 'rb').read(), self.server.content)
+
+
+class TestDownloadAndUnpack(RangeServerTestCase):
+    def _serve_zip(self):
+        bundle = zipfile.ZipFile('test_dir/test.zip', 'w', zipfile.ZIP_DEFLATED)
+        for i in range(20):
+            bundle.writestr('dir%d/file%d' % (i % 3, i), os.urandom(10000))
+        bundle.writestr('bin/xpcshell', test_string)
+        bundle.close()
+        self.server.content = open('test_dir/test.zip', 'rb').read()
+
+    def test_zip(self):
+        self._serve_zip()
+        self.assertEqual(self.s.download_and_unpack(self.url + '.zip', 'test_dir/dl/test.zip',
+                                                    'test_dir/out', members=['bin/*']), 0)
+        self.assertEqual(open('test_dir/dl/test.zip', 'rb').read(), self.server.content)
+        self.assertEqual(open('test_dir/out/bin/xpcshell').read(), test_string)
+        self.assertFalse(os.path.exists('test_dir/out/dir0'))
+        # The central directory came first.
+        self.assertEqual(self.server.requests[0][1], len(self.server.content) - 1)
+
+    def test_zip_without_ranges(self):
+        self._serve_zip()
+        self.server.ranges = False
+        with mock.patch('time.sleep'):
+            self.assertEqual(self.s.download_and_unpack(self.url + '.zip', 'test_dir/test2.zip',
+                                                        'test_dir/out'), 0)
+        self.assertEqual(open('test_dir/out/bin/xpcshell').read(), test_string)
+
+    def test_zip_cached(self):
+        self._serve_zip()
+        self.s = script.BaseScript(config={'download_cache_dir': 'test_dir/cache'},
+                                   initial_config_file='test/test.json')
+        self.assertEqual(self.s.download_and_unpack(self.url + '.zip', 'test_dir/dl/test.zip',
+                                                    'test_dir/out'), 0)
+        self.server.requests = []
+        with mock.patch.object(self.s, '_download_and_extract_zip') as pipeline:
+            self.assertEqual(self.s.download_and_unpack(self.url + '.zip', 'test_dir/dl/test2.zip',
+                                                        'test_dir/out2'), 0)
+            self.assertFalse(pipeline.called)
+        self.assertEqual(self.server.requests, ['HEAD'])
+        self.assertEqual(open('test_dir/out2/bin/xpcshell').read(), test_string)
+
+    def test_tar(self):
+        fh = open('test_dir/foo', 'w')
+        fh.write(test_string)
+        fh.close()
+        tar = tarfile.open('test_dir/test.tar.gz', 'w:gz')
+        tar.add('test_dir/foo', 'a/foo')
+        tar.close()
+        self.server.content = open('test_dir/test.tar.gz', 'rb').read()
+        self.assertEqual(self.s.download_and_unpack(self.url + '.tar.gz', 'test_dir/dl.tar.gz',
+                                                    'test_dir/out'), 0)
+        self.assertEqual(open('test_dir/dl.tar.gz', 'rb').read(), self.server.content)
+        self.assertEqual(open('test_dir/out/a/foo').read(), test_string)
+        self.assertEqual(len(self.server.requests), 1)
+
+
 class BaseScriptWithDecorators(script.BaseScript):
     def __init__(self, *args, **kwargs):
         super(BaseScriptWithDecorators, self).__init__(*args, **kwargs)
@@ -809,6 +1255,89 @@ class TestScriptDecorators(unittest.TestCase):
         self.assertEqual(len(self.s.post_run_2_args), 1)
 
 
+class BaseScriptWithDependencies(script.BaseScript):
+    """fetch-a and fetch-b don't depend on each other; build needs both."""
+    def __init__(self, **kwargs):
+        kwargs.setdefault('all_actions', ['fetch-a', 'fetch-b', 'build'])
+        kwargs.setdefault('action_dependencies', {
+            'fetch-a': [],
+            'fetch-b': [],
+        })
+        super(BaseScriptWithDependencies, self).__init__(
+            initial_config_file='test/test.json', **kwargs)
+        self.started = set()
+        self.overlapped = []
+        self.order = []
+        self.post_action_args = []
+
+    def _fetch(self, name, other):
+        self.started.add(name)
+        # Wait for the other fetch to start; sequential runs never see it.
+        for _ in range(20):
+            if other in self.started:
+                self.overlapped.append(name)
+                break
+            time.sleep(.1)
+        self.order.append(name)
+
+    def fetch_a(self):
+        self._fetch('fetch-a', 'fetch-b')
+
+    def fetch_b(self):
+        self._fetch('fetch-b', 'fetch-a')
+
+    def build(self):
+        self.order.append('build')
+
+    @script.PostScriptAction
+    def post_action(self, *args, **kwargs):
+        self.post_action_args.append((args, kwargs))
+
+
+class TestActionDependencies(unittest.TestCase):
+    def setUp(self):
+        cleanup()
+
+    def tearDown(self):
+        cleanup()
+
+    def test_independent_actions_overlap(self):
+        s = BaseScriptWithDependencies()
+        s.run()
+        self.assertEqual(sorted(s.order[:2]), ['fetch-a', 'fetch-b'])
+        self.assertEqual(s.order[2], 'build')
+        self.assertEqual(sorted(s.overlapped), ['fetch-a', 'fetch-b'])
+        self.assertEqual(len(s.post_action_args), 3)
+        self.assertEqual(s.post_action_args[-1],
+                         (('build', ), dict(success=True)))
+
+    def test_max_parallel_actions_1_is_sequential(self):
+        s = BaseScriptWithDependencies(config={'max_parallel_actions': 1})
+        s.run()
+        self.assertEqual(s.order, ['fetch-a', 'fetch-b', 'build'])
+        self.assertEqual(s.overlapped, ['fetch-b'])
+
+    def test_failure_stops_scheduling(self):
+        s = BaseScriptWithDependencies()
+
+        def fetch_a():
+            s.started.add('fetch-a')
+            raise Exception("fetch-a failed")
+        s.fetch_a = fetch_a
+        self.assertRaises(SystemExit, s.run)
+        self.assertNotIn('build', s.order)
+        self.assertIn((('fetch-a', ), dict(success=False)),
+                      s.post_action_args)
+
+    def test_dependency_must_come_first(self):
+        self.assertRaises(SystemExit, BaseScriptWithDependencies,
+                          action_dependencies={'fetch-a': ['build']})
+
+    def test_unknown_dependency(self):
+        self.assertRaises(SystemExit, BaseScriptWithDependencies,
+                          action_dependencies={'build': ['bogus']})
+
+
 # main {{{1
 if __name__ == '__main__':
     unittest.main()
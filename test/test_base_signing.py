@@ -0,0 +1,92 @@
+import hashlib
+import json
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+import mozharness.base.signing as signing
+from mozharness.base.script import BaseScript
+
+
+class SigningScript(signing.BaseSigningMixin, BaseScript):
+    pass
+
+
+class TestHashing(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.files = []
+        for i, size in enumerate((0, 1, 5 * 1024 ** 2 + 3)):
+            path = os.path.join(self.tmpdir, 'file%d' % i)
+            fh = open(path, 'wb')
+            fh.write(os.urandom(size))
+            fh.close()
+            self.files.append(path)
+        self.cache_file = os.path.join(self.tmpdir, 'hash_cache.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        for d in ('logs', 'build'):
+            if os.path.isdir(d):
+                shutil.rmtree(d)
+
+    def _script(self):
+        return SigningScript(config={'log_to_console': False,
+                                     'hash_cache_file': self.cache_file},
+                             initial_config_file='test/test.json')
+
+    def expected(self, path, algorithm):
+        return hashlib.new(algorithm, open(path, 'rb').read()).hexdigest()
+
+    def test_hash_file(self):
+        for path in self.files:
+            digests = signing.hash_file(path, ('sha1', 'sha512', 'md5'))
+            for algorithm in ('sha1', 'sha512', 'md5'):
+                self.assertEqual(digests[algorithm], self.expected(path, algorithm))
+
+    def test_query_files_digests(self):
+        s = self._script()
+        digests = s.query_files_digests(self.files, ('sha1', 'sha512'))
+        for path in self.files:
+            self.assertEqual(digests[path]['sha1'], self.expected(path, 'sha1'))
+        self.assertEqual(s.query_sha512sum(self.files[2]),
+                         self.expected(self.files[2], 'sha512'))
+
+    def test_cache(self):
+        self._script().query_sha512sum(self.files[2])
+        s = self._script()
+        with mock.patch.object(signing, 'hash_file') as hash_file:
+            self.assertEqual(s.query_sha512sum(self.files[2]),
+                             self.expected(self.files[2], 'sha512'))
+            self.assertFalse(hash_file.called)
+        fh = open(self.files[2], 'ab')
+        fh.write('more')
+        fh.close()
+        self.assertEqual(s.query_sha512sum(self.files[2]),
+                         self.expected(self.files[2], 'sha512'))
+
+    def test_cache_saved_once(self):
+        s = self._script()
+        with mock.patch.object(s, '_save_hash_cache') as save:
+            s.query_files_digests(self.files)
+            self.assertEqual(save.call_count, 1)
+            s.query_files_digests(self.files)
+            self.assertEqual(save.call_count, 1)
+
+    def test_cache_pruned(self):
+        s = self._script()
+        s.query_files_digests(self.files)
+        os.remove(self.files[0])
+        # Hashing a new file saves the cache.
+        new_file = os.path.join(self.tmpdir, 'new')
+        open(new_file, 'w').write('new')
+        s.query_sha512sum(new_file)
+        cached = json.load(open(self.cache_file))
+        self.assertFalse(self.files[0] in cached)
+        self.assertTrue(self.files[2] in cached)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,4 @@
+import mock
 import os
 import platform
 import shutil
@@ -6,6 +7,7 @@ import unittest
 
 import mozharness.base.errors as errors
 import mozharness.base.vcs.mercurial as mercurial
+import mozharness.base.vcs.vcsbase as vcsbase
 
 test_string = '''foo
 bar
@@ -73,6 +75,39 @@ class TestMakeAbsolute(unittest.TestCase):
             self.assertEquals(m._make_absolute("file://foo/bar"), "file://%s/foo/bar" % os.getcwd())
 
 
+class TestVCSCheckoutRepos(unittest.TestCase):
+    def tearDown(self):
+        for d in ('logs', 'build'):
+            shutil.rmtree(d, ignore_errors=True)
+
+    def test_query_repo_host(self):
+        self.assertEqual(vcsbase.query_repo_host('https://hg.mozilla.org/build/tools'),
+                         'hg.mozilla.org')
+        self.assertEqual(vcsbase.query_repo_host('git@github.com:mozilla/gecko-dev.git'),
+                         'github.com')
+        self.assertEqual(vcsbase.query_repo_host('/builds/hg/tools'), None)
+        self.assertEqual(vcsbase.query_repo_host('tools'), None)
+
+    def test_repo_paths(self):
+        s = vcsbase.MercurialScript(config={'log_to_console': False},
+                                    initial_config_file='test/test.json')
+        repos = []
+
+        def vcs_checkout(**kwargs):
+            repos.append(kwargs['repo'])
+        s.vcs_checkout = vcs_checkout
+        s.vcs_checkout_repos([
+            {'repo': 'https://hg.mozilla.org/build/tools'},
+            {'repo': 'git@github.com:mozilla/gecko-dev.git'},
+            {'repo': 'tools', 'dest': 'local'},
+        ], parent_dir='build/parent')
+        self.assertEqual(sorted(repos), [
+            os.path.abspath(os.path.join('build', 'parent', 'tools')),
+            'git@github.com:mozilla/gecko-dev.git',
+            'https://hg.mozilla.org/build/tools',
+        ])
+
+
 class TestHg(unittest.TestCase):
     def _init_hg_repo(self, hg_obj, repodir):
         hg_obj.run_command(["bash",
@@ -460,6 +495,113 @@ class TestHg(unittest.TestCase):
         # make sure shared history is identical
         self.assertEquals(self.revisions, get_revisions(repo3))
 
+    def _vcs_script(self, **config):
+        config.update({'log_to_console': False,
+                       'base_work_dir': self.tmpdir,
+                       'work_dir': 'parent'})
+        return vcsbase.MercurialScript(config=config,
+                                       initial_config_file='test/test.json')
+
+    def test_vcs_checkout_repos(self):
+        repo2 = os.path.join(self.tmpdir, 'repo2')
+        self._init_hg_repo(get_mercurial_vcs_obj(), repo2)
+        s = self._vcs_script()
+        pwd = os.getcwd()
+        revision_dict = s.vcs_checkout_repos([
+            {'repo': self.repodir, 'dest': 'one'},
+            {'repo': repo2},
+            {'repo': self.repodir, 'dest': 'two', 'revision': self.revisions[-1]},
+        ])
+        self.assertEqual(os.getcwd(), pwd)
+        parent_dir = os.path.join(self.tmpdir, 'parent')
+        self.assertEqual(revision_dict['one'],
+                         {'repo': self.repodir, 'revision': self.revisions[0]})
+        self.assertEqual(revision_dict['repo2']['revision'],
+                         get_revisions(repo2)[0])
+        self.assertEqual(revision_dict['two']['revision'], self.revisions[-1])
+        for dest in ('one', 'two', 'repo2'):
+            self.assertTrue(os.path.isdir(os.path.join(parent_dir, dest, '.hg')))
+
+    def test_vcs_checkout_repos_nested(self):
+        s = self._vcs_script()
+        with mock.patch.object(s, '_vcs_checkout_in_parallel') as parallel:
+            s.vcs_checkout_repos([
+                {'repo': self.repodir, 'dest': 'outer'},
+                {'repo': self.repodir, 'dest': 'outer/inner'},
+            ])
+            self.assertFalse(parallel.called)
+        self.assertTrue(os.path.isdir(os.path.join(self.tmpdir, 'parent', 'outer', 'inner', '.hg')))
+
+    def test_vcs_checkout_repos_failure(self):
+        s = self._vcs_script(global_retries=1)
+        self.assertRaises(SystemExit, s.vcs_checkout_repos, [
+            {'repo': self.repodir, 'dest': 'one'},
+            {'repo': os.path.join(self.tmpdir, 'nonexistent'), 'dest': 'two'},
+        ])
+
+    def test_can_share_cached_in_share_base(self):
+        share_base = os.path.join(self.tmpdir, 'share')
+        mercurial._can_share_cache.clear()
+        m = get_mercurial_vcs_obj()
+        self.assertTrue(m.query_can_share(share_base))
+        self.assertTrue(os.path.exists(os.path.join(share_base, mercurial.SHARE_STATE_FILE)))
+        mercurial._can_share_cache.clear()
+        m = get_mercurial_vcs_obj()
+        with mock.patch.object(m, 'get_output_from_command') as get_output:
+            self.assertTrue(m.query_can_share(share_base))
+            self.assertFalse(get_output.called)
+
+    def test_share_skips_pull_for_known_revision(self):
+        share_base = os.path.join(self.tmpdir, 'share')
+        m = get_mercurial_vcs_obj()
+        m.vcs_config = {'repo': self.repodir, 'dest': self.wc,
+                        'vcs_share_base': share_base}
+        m.ensure_repo_and_revision()
+        m = get_mercurial_vcs_obj()
+        m.vcs_config = {'repo': self.repodir, 'dest': self.wc,
+                        'vcs_share_base': share_base,
+                        'revision': self.revisions[-1]}
+        with mock.patch.object(m, 'pull') as pull:
+            rev = m.ensure_repo_and_revision()
+            self.assertFalse(pull.called)
+        self.assertEquals(rev, self.revisions[-1])
+        # Unknown revisions still get pulled.
+        m.vcs_config['revision'] = 'abcdef123456'
+        self.assertFalse(m._query_share_is_current(
+            share_base, self.repodir,
+            os.path.join(share_base, self.repodir.lstrip('/')), 'abcdef123456'))
+
+    def test_clone_from_bundle(self):
+        m = get_mercurial_vcs_obj()
+        bundle = os.path.join(self.tmpdir, 'repo.hg')
+        # The bundle only has the first revision; the rest gets pulled.
+        m.run_command(HG + ['bundle', '-r', self.revisions[-1], '--all', bundle],
+                      cwd=self.repodir)
+        m.vcs_config = {'repo': self.repodir, 'dest': self.wc, 'bundle': bundle}
+        rev = m.clone(self.repodir, self.wc)
+        self.assertEquals(rev, self.revisions[0])
+        self.assertEquals(get_revisions(self.wc), self.revisions)
+        self.assertEquals(m.get_output_from_command(HG + ['paths', 'default'], cwd=self.wc),
+                          self.repodir)
+
+    def test_clone_from_bad_bundle(self):
+        m = get_mercurial_vcs_obj()
+        bundle = os.path.join(self.tmpdir, 'repo.hg')
+        open(bundle, 'w').write('not a bundle')
+        m.vcs_config = {'repo': self.repodir, 'dest': self.wc, 'bundle': bundle}
+        m.clone(self.repodir, self.wc, update_dest=False)
+        self.assertEquals(get_revisions(self.wc), self.revisions)
+
+    def test_mercurial_pulls_only_pinned_revision(self):
+        m = get_mercurial_vcs_obj()
+        m.clone(self.repodir, self.wc, revision=self.revisions[-1])
+        m.vcs_config = {'repo': self.repodir, 'dest': self.wc,
+                        'revision': self.revisions[0]}
+        rev = m.ensure_repo_and_revision()
+        self.assertEquals(rev, self.revisions[0])
+        # branch2 isn't an ancestor, so it didn't get pulled.
+        self.assertEquals(get_revisions(self.wc), self.revisions[:1] + self.revisions[2:])
+
     def test_mercurial_share_outgoing(self):
         m = get_mercurial_vcs_obj()
         # ensure that outgoing changesets in a shared clone affect the shared history
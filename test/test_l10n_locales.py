@@ -2,6 +2,9 @@ import os
 import shutil
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 import unittest
 
 import mozharness.base.log as log
@@ -128,5 +131,195 @@ class TestLocalesMixin(unittest.TestCase):
         expected_dirs.sort()
         self.assertEqual(dirs, expected_dirs)
 
+class ListLogger(object):
+    def __init__(self):
+        self.messages = []
+
+    def log_message(self, message, level=log.INFO, exit_code=-1, post_fatal_callback=None):
+        self.messages.append(message)
+
+
+class TestRunPerLocale(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.l = LocalesTest()
+        self.l.config['base_work_dir'] = self.tmpdir
+        self.l.config['work_dir'] = 'work_dir'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        cleanup()
+
+    def test_parallel(self):
+        running = []
+        most_running = []
+        lock = threading.Lock()
+
+        def repack(locale):
+            with lock:
+                running.append(locale)
+                most_running.append(len(running))
+            time.sleep(0.1)
+            with lock:
+                running.remove(locale)
+            return locale.upper()
+        results = dict(self.l.run_per_locale(repack, ALL_LOCALES, num_workers=4))
+        self.assertEqual(results, dict((l, l.upper()) for l in ALL_LOCALES))
+        self.assertTrue(max(most_running) > 1)
+
+    def test_logs(self):
+        log_obj = ListLogger()
+        self.l.log_obj = log_obj
+
+        def repack(locale):
+            self.l.info("start %s" % locale)
+            time.sleep(0.05)
+            self.l.info("end %s" % locale)
+        list(self.l.run_per_locale(repack, ALL_LOCALES, num_workers=4,
+                                   log_name='repack'))
+        self.assertTrue(self.l.log_obj is log_obj)
+        log_dir = self.l.query_abs_dirs()['abs_log_dir']
+        for locale in ALL_LOCALES:
+            # Each locale's log is in one piece.
+            i = log_obj.messages.index("start %s" % locale)
+            self.assertEqual(log_obj.messages[i + 1], "end %s" % locale)
+            lines = open(os.path.join(log_dir, 'repack-%s.log' % locale)).readlines()
+            self.assertEqual([line.split(' - ')[1] for line in lines],
+                             ["start %s\n" % locale, "end %s\n" % locale])
+
+    def test_repack_workers(self):
+        self.l.config['repack_workers'] = 4
+        self.l.config['locale_make_args'] = ['LOCALE_WORK_DIR=%(abs_locale_work_dir)s']
+        self.assertEqual(self.l.query_repack_workers(), 4)
+
+    def test_repack_workers_shared_dirs(self):
+        self.l.config['repack_workers'] = 4
+        self.assertEqual(self.l.query_repack_workers(), 1)
+
+    def test_exception(self):
+        done = []
+        started = threading.Event()
+
+        def repack(locale):
+            if locale == ALL_LOCALES[0]:
+                started.wait(5)
+                raise SystemExit(2)
+            started.set()
+            time.sleep(0.1)
+            done.append(locale)
+        results = self.l.run_per_locale(repack, ALL_LOCALES, num_workers=2)
+        self.assertRaises(SystemExit, list, results)
+        # The locale already running finished, and no more were started.
+        self.assertEqual(done, ALL_LOCALES[1:2])
+
+class TestRepackCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.objdir = os.path.join(self.tmpdir, 'objdir')
+        self.inputs = {'locale': 'de', 'en_us_package': 'abc',
+                       'l10n_revision': '123456789abc'}
+        self.files = ['dist/firefox.de.tar.bz2', 'dist/update/firefox.de.complete.mar']
+        for f in self.files:
+            self.write(f, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        cleanup()
+
+    def write(self, f, contents):
+        path = os.path.join(self.objdir, f)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        fh = open(path, 'w')
+        fh.write(contents)
+        fh.close()
+
+    def test_add_restore(self):
+        cache = locales.RepackCache(os.path.join(self.tmpdir, 'cache'))
+        self.assertEqual(cache.restore(self.inputs, self.objdir), None)
+        cache.add(self.inputs, self.objdir, self.files)
+        shutil.rmtree(self.objdir)
+        self.assertEqual(cache.restore(self.inputs, self.objdir), self.files)
+        for f in self.files:
+            self.assertEqual(open(os.path.join(self.objdir, f)).read(), f)
+        inputs = dict(self.inputs, l10n_revision='cba987654321')
+        self.assertEqual(cache.query_files(inputs), None)
+
+    def test_evict(self):
+        cache = locales.RepackCache(os.path.join(self.tmpdir, 'cache'), max_size=100)
+        old_inputs = dict(self.inputs, locale='fr')
+        cache.add(old_inputs, self.objdir, self.files)
+        entry = os.path.join(cache.entries_dir, cache.query_key(old_inputs), 'inputs.json')
+        os.utime(entry, (time.time() - 60, time.time() - 60))
+        self.write('big', 'x' * 80)
+        cache.add(self.inputs, self.objdir, ['big'])
+        cache.evict(keep=self.inputs)
+        self.assertEqual(cache.query_files(old_inputs), None)
+        self.assertEqual(cache.query_files(self.inputs), ['big'])
+
+    def test_add_repack_to_cache(self):
+        l = LocalesTest()
+        l.config['base_work_dir'] = self.tmpdir
+        l.config['work_dir'] = '.'
+        l.config['objdir'] = self.objdir
+        l.config['mozilla_dir'] = 'mozilla'
+        l.config['l10n_dir'] = 'l10n'
+        l.config['locales_dir'] = 'browser/locales'
+        l.config['repack_cache_dir'] = os.path.join(self.tmpdir, 'cache')
+        stale = os.path.join(self.objdir, 'dist', 'firefox.de.old.zip')
+        self.write('dist/firefox.de.old.zip', 'stale')
+        os.utime(stale, (time.time() - 60, time.time() - 60))
+        l.add_repack_to_cache(self.inputs, ['dist/*.%(locale)s.*', 'dist/update/*'],
+                              int(time.time()) - 10)
+        self.assertEqual(sorted(l.query_repack_cache().query_files(self.inputs)),
+                         sorted(self.files))
+        shutil.rmtree(self.objdir)
+        self.assertTrue(l.restore_repack_from_cache(self.inputs))
+        self.assertFalse(os.path.exists(stale))
+        self.assertFalse(l.restore_repack_from_cache(dict(self.inputs, locale='fr')))
+
+    def test_restore_fails(self):
+        l = LocalesTest()
+        l.config['base_work_dir'] = self.tmpdir
+        l.config['work_dir'] = '.'
+        l.config['objdir'] = self.objdir
+        l.config['mozilla_dir'] = 'mozilla'
+        l.config['l10n_dir'] = 'l10n'
+        l.config['locales_dir'] = 'browser/locales'
+        l.config['repack_cache_dir'] = os.path.join(self.tmpdir, 'cache')
+        l.query_repack_cache().add(self.inputs, self.objdir, self.files)
+        shutil.rmtree(self.objdir)
+        # Something in the way of the second file.
+        os.makedirs(os.path.join(self.objdir, self.files[1]))
+        self.assertRaises(IOError, l.query_repack_cache().restore,
+                          self.inputs, self.objdir)
+        self.assertFalse(os.path.exists(os.path.join(self.objdir, self.files[0])))
+        self.assertFalse(l.restore_repack_from_cache(self.inputs))
+        self.assertFalse(os.path.exists(os.path.join(self.objdir, self.files[0])))
+
+    def test_repack_cache_inputs(self):
+        l = LocalesTest()
+        l.config['base_work_dir'] = self.tmpdir
+        l.config['work_dir'] = '.'
+        l.config['objdir'] = self.objdir
+        l.config['mozilla_dir'] = 'mozilla'
+        l.config['l10n_dir'] = 'l10n'
+        l.config['locales_dir'] = 'browser/locales'
+        l._query_hg_revision = lambda path: '123456789abc'
+        en_us_package = os.path.join(self.objdir, 'dist', 'firefox.en-US.tar.bz2')
+        self.write('dist/firefox.en-US.tar.bz2', 'en-US')
+        inputs = l.query_repack_cache_inputs('de', en_us_package,
+                                             repack_env={'MOZ_UPDATE_CHANNEL': 'nightly'})
+        self.assertEqual(inputs['update_channel'], 'nightly')
+        self.assertFalse(inputs['signed'])
+        signed_inputs = l.query_repack_cache_inputs(
+            'de', en_us_package,
+            repack_env={'MOZ_UPDATE_CHANNEL': 'nightly', 'MOZ_SIGN_CMD': 'signtool'})
+        self.assertTrue(signed_inputs['signed'])
+        beta_inputs = l.query_repack_cache_inputs('de', en_us_package,
+                                                  repack_env={'MOZ_UPDATE_CHANNEL': 'beta'})
+        cache = locales.RepackCache(os.path.join(self.tmpdir, 'cache'))
+        self.assertEqual(len(set(cache.query_key(i) for i in (inputs, signed_inputs, beta_inputs))), 3)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,172 @@
+import hashlib
+import mock
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+
+import mozharness.mozilla.mapper as mapper
+from mozharness.base.script import BaseScript
+
+
+class MapperScript(mapper.MapperMixin, BaseScript):
+    pass
+
+
+def sha(s):
+    return hashlib.sha1(s).hexdigest()
+
+
+class TestMapfileIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.mapfile = os.path.join(self.tmpdir, 'git-mapfile')
+        self.pairs = [(sha('git%d' % i), sha('hg%d' % i)) for i in range(200)]
+        fh = open(self.mapfile, 'w')
+        for git_rev, hg_rev in self.pairs:
+            fh.write("%s %s\n" % (git_rev, hg_rev))
+        fh.write("not a mapfile line\n")
+        fh.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        for d in ('logs', 'build'):
+            if os.path.isdir(d):
+                shutil.rmtree(d)
+
+    def _script(self, **config):
+        config['log_to_console'] = False
+        return MapperScript(config=config, initial_config_file='test/test.json')
+
+    def test_lookups(self):
+        index = mapper.MapfileIndex(self.mapfile)
+        self.assertEqual(len(index), 200)
+        for git_rev, hg_rev in self.pairs:
+            self.assertEqual(index.query_git_revision(hg_rev), git_rev)
+            self.assertEqual(index.query_hg_revision(git_rev), hg_rev)
+        git_rev, hg_rev = self.pairs[7]
+        self.assertEqual(index.query_git_revision(hg_rev[:12].upper()), git_rev)
+        self.assertEqual(index.query_git_revision(git_rev), None)
+        self.assertEqual(index.query_hg_revision('f' * 40), None)
+        index.close()
+
+    def test_resolve(self):
+        index = mapper.MapfileIndex(self.mapfile)
+        hg_revs = [hg_rev[:12] for _, hg_rev in self.pairs[::3]] + ['0' * 12]
+        expected = dict((hg_rev[:12], git_rev) for git_rev, hg_rev in self.pairs[::3])
+        expected['0' * 12] = None
+        self.assertEqual(index.resolve(hg_revs, vcs='git'), expected)
+        git_revs = [git_rev for git_rev, _ in self.pairs]
+        self.assertEqual(index.resolve(git_revs, vcs='hg'),
+                         dict(self.pairs))
+
+    def test_empty_mapfile(self):
+        open(self.mapfile, 'w').close()
+        index = mapper.MapfileIndex(self.mapfile)
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.query_git_revision(self.pairs[0][1]), None)
+
+    def test_query_mapfile_index(self):
+        s = self._script()
+        index = s.query_mapfile_index(self.mapfile)
+        self.assertTrue(s.query_mapfile_index(self.mapfile) is index)
+        fh = open(self.mapfile, 'a')
+        fh.write("%s %s\n" % (sha('newgit'), sha('newhg')))
+        fh.close()
+        os.utime(self.mapfile, (time.time() + 10, time.time() + 10))
+        new_index = s.query_mapfile_index(self.mapfile)
+        self.assertFalse(new_index is index)
+        self.assertEqual(new_index.query_git_revision(sha('newhg')), sha('newgit'))
+
+    def test_query_mapper_uses_mapfile(self):
+        s = self._script()
+        git_rev, hg_rev = self.pairs[42]
+        with mock.patch.object(mapper.urllib2, 'urlopen') as urlopen:
+            self.assertEqual(s.query_mapper_git_revision(
+                'http://mapper/{project}/{vcs}/{rev}', 'gecko', hg_rev,
+                mapfile=self.mapfile), git_rev)
+            s = self._script(mapper_mapfiles={'gecko': self.mapfile})
+            self.assertEqual(s.query_mapper_hg_revision(
+                'http://mapper/{project}/{vcs}/{rev}', 'gecko', git_rev), hg_rev)
+            self.assertFalse(urlopen.called)
+
+
+class TestCombineMapfiles(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.combined = os.path.join(self.tmpdir, 'combined-mapfile')
+        self.mapfiles = [os.path.join(self.tmpdir, 'mapfile%d' % i) for i in range(3)]
+        self.lines = []
+        for i in range(300):
+            self.append(i % 3, "%s %s\n" % (sha('git%d' % i), sha('hg%d' % i)))
+        # Mapfiles overlap.
+        self.append(1, open(self.mapfiles[0]).readline())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def append(self, n, line):
+        fh = open(self.mapfiles[n], 'a')
+        fh.write(line)
+        fh.close()
+        self.lines.append(line)
+
+    def expected(self):
+        """The first line appended for each hg revision, sorted by it."""
+        lines = {}
+        for line in self.lines:
+            lines.setdefault(line.split(' ')[1], line)
+        return ''.join(lines[k] for k in sorted(lines))
+
+    def test_combine(self):
+        self.assertEqual(mapper.combine_mapfiles(self.mapfiles, self.combined,
+                                                 run_lines=50), 301)
+        self.assertEqual(open(self.combined).read(), self.expected())
+        self.assertEqual(mapper.combine_mapfiles(self.mapfiles, self.combined), None)
+
+    def test_incremental(self):
+        mapper.combine_mapfiles(self.mapfiles, self.combined)
+        self.append(2, "%s %s\n" % (sha('newgit'), sha('newhg')))
+        # Half-written lines are left for next time.
+        fh = open(self.mapfiles[0], 'a')
+        fh.write(sha('partial'))
+        fh.close()
+        with mock.patch.object(mapper, '_keyed_mapfile_lines',
+                               wraps=mapper._keyed_mapfile_lines) as keyed_lines:
+            self.assertEqual(mapper.combine_mapfiles(self.mapfiles, self.combined), 1)
+            # Just the existing combined mapfile; the new line wasn't spilled.
+            self.assertEqual(keyed_lines.call_count, 1)
+        self.assertEqual(open(self.combined).read(), self.expected())
+        self.assertTrue(os.path.exists(self.combined + '.old'))
+
+    def test_duplicate_revision(self):
+        # The same hg revision mapped to two git revisions; the later
+        # mapfile's git revision sorts first.
+        hg = sha('hg0')
+        self.append(2, "%s %s\n" % ('0' * 40, hg))
+        self.assertEqual(mapper.combine_mapfiles(self.mapfiles, self.combined,
+                                                 run_lines=50), 302)
+        env = dict(os.environ, LC_ALL='C')
+        expected = subprocess.Popen(
+            ['sort', '--unique', '-t', ' ', '--key=2'] + self.mapfiles,
+            stdout=subprocess.PIPE, env=env).communicate()[0]
+        self.assertEqual(open(self.combined).read(), expected)
+        self.assertEqual(open(self.combined).read(), self.expected())
+        # A new line for a revision we already have doesn't replace it.
+        self.append(0, "%s %s\n" % ('0' * 40, sha('hg1')))
+        self.assertEqual(mapper.combine_mapfiles(self.mapfiles, self.combined), 1)
+        self.assertEqual(open(self.combined).read(), self.expected())
+
+    def test_rewritten_mapfile(self):
+        mapper.combine_mapfiles(self.mapfiles, self.combined)
+        lines = open(self.mapfiles[1]).readlines()
+        open(self.mapfiles[1], 'w').writelines(lines[1:])
+        self.lines.remove(lines[0])
+        mapper.combine_mapfiles(self.mapfiles, self.combined)
+        self.assertEqual(open(self.combined).read(), self.expected())
+
+
+if __name__ == '__main__':
+    unittest.main()
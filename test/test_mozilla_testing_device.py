@@ -0,0 +1,225 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mozharness.mozilla.testing.device as device
+from mozharness.base.log import ERROR, FATAL, INFO
+from mozharness.base.script import BaseScript
+
+here = os.path.dirname(os.path.abspath(__file__))
+FAKE_ADB = os.path.join(here, 'helper_files', 'fake_adb')
+DEVICE_ID = 'emulator-5554'
+
+
+class TestADBDeviceHandler(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.old_environ = os.environ.copy()
+        os.environ['FAKE_ADB_DIR'] = self.tmpdir
+        fh = open(os.path.join(self.tmpdir, 'devices'), 'w')
+        fh.write('%s\n' % DEVICE_ID)
+        fh.close()
+        self.device_dir = os.path.join(self.tmpdir, 'device')
+        for d in ('mnt/sdcard/tests/profile', 'data/data/org.mozilla.fennec'):
+            os.makedirs(os.path.join(self.device_dir, d))
+        self.dh = self._handler()
+
+    def tearDown(self):
+        self.dh.close_shell_session()
+        os.environ.clear()
+        os.environ.update(self.old_environ)
+        shutil.rmtree(self.tmpdir)
+
+    def _handler(self, **config):
+        config.setdefault('exes', {'adb': FAKE_ADB})
+        config.setdefault('device_id', DEVICE_ID)
+        dh = device.ADBDeviceHandler(config=config)
+        dh.device_id = DEVICE_ID
+        return dh
+
+    def query_calls(self):
+        return open(os.path.join(self.tmpdir, 'calls')).read().splitlines()
+
+    def test_shell_session(self):
+        session = device.ADBShellSession(FAKE_ADB, DEVICE_ID)
+        try:
+            self.assertEqual(session.run(['ls -d /mnt/sdcard', 'ls -d /nope; echo hi', 'df']), [
+                (0, '/mnt/sdcard'),
+                (0, '/nope: No such file or directory\nhi'),
+                (0, 'Filesystem             Size   Used   Free   Blksize\n'
+                    '/mnt/sdcard          503M     0K   503M   512'),
+            ])
+            self.assertEqual(session.run(['ls -d /nope']),
+                             [(1, '/nope: No such file or directory')])
+            # Output with no newline at the end.
+            self.assertEqual(session.run(['echo -n foo', 'echo -n']),
+                             [(0, 'foo'), (0, '')])
+        finally:
+            session.close()
+        self.assertEqual(self.query_calls(), ['-s %s shell' % DEVICE_ID])
+
+    def test_shell_session_goes_away(self):
+        session = device.ADBShellSession(FAKE_ADB, DEVICE_ID, timeout=10)
+        try:
+            self.assertRaises(device.DeviceException, session.run, ['exit'])
+            # The next command gets a new shell.
+            self.assertEqual(session.run(['uptime'])[0][0], 0)
+        finally:
+            session.close()
+        self.assertEqual(len(self.query_calls()), 2)
+
+    def test_device_calls(self):
+        self.assertTrue(self.dh.ping_device())
+        self.assertEqual(self.dh.query_device_root(), '/mnt/sdcard/tests')
+        self.assertTrue(self.dh.query_device_file_exists('/mnt/sdcard/tests'))
+        self.assertFalse(self.dh.query_device_file_exists('/mnt/sdcard/nope'))
+        self.assertEqual(self.query_calls(), ['-s %s shell' % DEVICE_ID])
+
+    def test_without_shell_session(self):
+        dh = self._handler(adb_shell_session=False)
+        self.assertTrue(dh.ping_device())
+        self.assertTrue(dh.query_device_file_exists('/mnt/sdcard/tests'))
+        self.assertEqual(self.query_calls(), [
+            '-s %s shell uptime' % DEVICE_ID,
+            '-s %s shell ls -d /mnt/sdcard/tests' % DEVICE_ID,
+        ])
+
+    def test_cleanup_device(self):
+        dh = self._handler(device_package_name='org.mozilla.fennec',
+                           enable_automation=True)
+        dh.cleanup_device()
+        self.assertFalse(os.path.exists(os.path.join(self.device_dir, 'mnt/sdcard/tests')))
+        self.assertFalse(os.path.exists(os.path.join(self.device_dir, 'data/data/org.mozilla.fennec')))
+        self.assertEqual(self.query_calls(), [
+            '-s %s shell' % DEVICE_ID,
+            '-s %s uninstall org.mozilla.fennec' % DEVICE_ID,
+        ])
+        dh.close_shell_session()
+
+    def test_cleanup_device_unreachable(self):
+        dh = self._handler(adb_shell_timeout=10)
+        self.assertEqual(dh.query_device_root(), '/mnt/sdcard/tests')
+        dh.close_shell_session()
+        open(os.path.join(self.tmpdir, 'devices'), 'w').close()
+        self.assertRaises(SystemExit, dh.cleanup_device)
+        self.assertEqual(dh.device_flags, [device.DEVICE_UNREACHABLE])
+        self.assertTrue(os.path.exists(os.path.join(self.device_dir, 'mnt/sdcard/tests')))
+
+    def test_remove_device_root_unreachable(self):
+        self.dh.device_root = '/mnt/sdcard/tests'
+        self.dh.run_shell_commands = lambda commands, silent=False: [None] * len(commands)
+        self.assertFalse(self.dh.remove_device_root())
+        self.assertEqual(self.dh.device_flags, [device.DEVICE_UNREACHABLE])
+
+    def test_remove_device_root_error(self):
+        self.dh.device_root = '/mnt/sdcard/tests'
+        self.dh.run_shell_commands = lambda commands, silent=False: [
+            '/system/bin/sh: rm: command not found',
+            '/mnt/sdcard/tests: No such file or directory']
+        self.assertFalse(self.dh.remove_device_root())
+        self.assertEqual(self.dh.device_flags, [device.DEVICE_CANT_REMOVE_DEVROOT])
+
+    def test_remove_device_root(self):
+        self.assertTrue(self.dh.remove_device_root())
+        self.assertFalse(os.path.exists(os.path.join(self.device_dir, 'mnt/sdcard/tests')))
+        self.assertEqual(self.dh.device_flags, [])
+
+    def test_query_device_uptime(self):
+        self.assertEqual(self.dh.query_device_uptime(), 600)
+        self.dh.query_shell_output = lambda command, silent=False: \
+            'up time: 2 days, 04:10:33, idle time: 5 days, 00:00:00, sleep time: 00:00:00'
+        self.assertEqual(self.dh.query_device_uptime(), 2 * 86400 + 4 * 3600 + 10 * 60 + 33)
+        self.dh.query_shell_output = lambda command, silent=False: None
+        self.assertEqual(self.dh.query_device_uptime(), None)
+
+    def test_wait_for_reboot(self):
+        dh = self._handler(device_poll_initial_interval=0.01)
+        # The fake device has been up for 10 minutes.
+        self.assertTrue(dh.wait_for_device(interval=0.01, max_attempts=3,
+                                           rebooted_at=time.time() - 700))
+        dh.close_shell_session()
+
+    def test_wait_for_reboot_not_rebooted(self):
+        dh = self._handler(device_poll_initial_interval=0.01)
+        self.assertRaises(device.DeviceException, dh.wait_for_device,
+                          interval=0.01, max_attempts=3, rebooted_at=time.time() - 20)
+        dh.close_shell_session()
+
+    def test_attached_devices_cache(self):
+        dh = self._handler()
+        dh.device_id = None
+        self.assertEqual(dh._query_attached_devices(), [DEVICE_ID])
+        self.assertEqual(dh._query_attached_devices(), [DEVICE_ID])
+        self.assertEqual(self.query_calls(), ['devices'])
+        # Reconnecting forgets the cached devices.
+        dh.connect_device()
+        self.assertEqual(dh._query_attached_devices(), [DEVICE_ID])
+        self.assertEqual(self.query_calls().count('devices'), 2)
+
+
+class DeviceScript(device.DeviceMixin, BaseScript):
+    pass
+
+
+class TestDeviceMixin(unittest.TestCase):
+    devices = ['emulator-5554', 'emulator-5556', 'emulator-5558']
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.old_environ = os.environ.copy()
+        os.environ['FAKE_ADB_DIR'] = self.tmpdir
+        fh = open(os.path.join(self.tmpdir, 'devices'), 'w')
+        fh.write('%s\n' % self.devices[0])
+        fh.close()
+        fh = open(os.path.join(self.tmpdir, 'unreachable'), 'w')
+        fh.write('%s\n' % self.devices[2])
+        fh.close()
+        os.makedirs(os.path.join(self.tmpdir, 'device', 'mnt', 'sdcard'))
+        self.s = DeviceScript(config={
+            'log_to_console': False,
+            'device_protocol': 'adb',
+            'exes': {'adb': FAKE_ADB},
+            'devices': [{'device_id': d} for d in self.devices],
+        }, initial_config_file='test/test.json')
+
+    def tearDown(self):
+        for name, dh in self.s.query_device_handlers():
+            dh.close_shell_session()
+        os.environ.clear()
+        os.environ.update(self.old_environ)
+        shutil.rmtree(self.tmpdir)
+        for d in ('logs', 'build'):
+            shutil.rmtree(d, ignore_errors=True)
+
+    def test_check_devices(self):
+        levels = []
+        log_message = self.s.log_obj.log_message
+
+        def record_level(message, level=INFO, **kwargs):
+            levels.append(level)
+            return log_message(message, level=level, **kwargs)
+        self.s.log_obj.log_message = record_level
+        report = self.s.check_devices()
+        self.assertEqual([(d['device'], d['status'], d['flags']) for d in report], [
+            ('emulator-5554', 'ok', []),
+            ('emulator-5556', 'ok', []),
+            ('emulator-5558', 'failed', ['not connected']),
+        ])
+        self.assertEqual(report[2]['error'], "Can't find device!")
+        # Only the caller decides whether a failed device is fatal.
+        self.assertTrue(ERROR in levels)
+        self.assertFalse(FATAL in levels)
+        name, dh = self.s.query_device_handlers()[2]
+        self.assertRaises(SystemExit, dh.fatal, "Can't find device!")
+        self.assertEqual(self.s.query_device_flags(), [device.DEVICE_NOT_CONNECTED])
+
+    def test_poll_intervals(self):
+        name, dh = self.s.query_device_handlers()[0]
+        self.assertEqual(list(dh.query_poll_intervals(60, 2)),
+                         [5, 10, 20, 40, 60, 45])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,242 @@
+import imp
+import os
+import shutil
+import threading
+import unittest
+
+MH_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+vcs_sync = imp.load_source(
+    'vcs_sync', os.path.join(MH_DIR, 'scripts', 'vcs-sync', 'vcs_sync.py'))
+
+
+class VCSSyncTest(vcs_sync.HgGitScript):
+    def __init__(self, **kwargs):
+        config = {'log_to_console': False}
+        config.update(kwargs)
+        super(vcs_sync.HgGitScript, self).__init__(
+            config=config, initial_config_file='test/test.json')
+        self.unchanged_repos = []
+
+
+def repo(name, conversion_dir=None, targets=()):
+    repo_config = {'repo_name': name, 'targets': list(targets)}
+    if conversion_dir:
+        repo_config['conversion_dir'] = conversion_dir
+    return repo_config
+
+
+class TestRunPerRepo(unittest.TestCase):
+    def tearDown(self):
+        for d in ('logs', 'build'):
+            shutil.rmtree(d, ignore_errors=True)
+
+    def test_serial(self):
+        s = VCSSyncTest()
+        order = []
+
+        def func(repo_config):
+            order.append(repo_config['repo_name'])
+            return repo_config['repo_name'].upper()
+        repos = [repo('a'), repo('b'), repo('c')]
+        results = [(r['repo_name'], result) for r, result in s._run_per_repo(func, repos)]
+        self.assertEquals(order, ['a', 'b', 'c'])
+        self.assertEquals(results, [('a', 'A'), ('b', 'B'), ('c', 'C')])
+
+    def test_grouped_by_conversion_dir(self):
+        s = VCSSyncTest(max_parallel_repos=2)
+        lock = threading.Lock()
+        running = {}
+        order = {}
+        both_started = threading.Event()
+
+        def func(repo_config):
+            conversion_dir = repo_config['conversion_dir']
+            with lock:
+                # Repos sharing a conversion dir never overlap.
+                self.assertFalse(running.get(conversion_dir))
+                running[conversion_dir] = True
+                order.setdefault(conversion_dir, []).append(repo_config['repo_name'])
+                if len(running) == 2:
+                    both_started.set()
+            # Only succeeds if the two conversion dirs run at once.
+            self.assertTrue(both_started.wait(5))
+            with lock:
+                running[conversion_dir] = False
+            return repo_config['repo_name']
+        repos = [repo('a1', 'a'), repo('b1', 'b'), repo('a2', 'a'), repo('b2', 'b')]
+        results = dict((r['repo_name'], result) for r, result in s._run_per_repo(func, repos))
+        self.assertEquals(results, {'a1': 'a1', 'a2': 'a2', 'b1': 'b1', 'b2': 'b2'})
+        self.assertEquals(order, {'a': ['a1', 'a2'], 'b': ['b1', 'b2']})
+
+    def test_exit_after_running_repos(self):
+        s = VCSSyncTest(max_parallel_repos=2)
+        done = []
+
+        def func(repo_config):
+            if repo_config['repo_name'] == 'a1':
+                raise SystemExit(2)
+            done.append(repo_config['repo_name'])
+        repos = [repo('a1', 'a'), repo('a2', 'a'), repo('b1', 'b'), repo('b2', 'b')]
+        self.assertRaises(SystemExit, list, s._run_per_repo(func, repos))
+        # The rest of a1's conversion dir is abandoned; b finishes.
+        self.assertEquals(sorted(done), ['b1', 'b2'])
+
+
+class TestPushRepo(unittest.TestCase):
+    def tearDown(self):
+        for d in ('logs', 'build'):
+            shutil.rmtree(d, ignore_errors=True)
+
+    def _push_repo(self, s, repo_config, push_target):
+        pushed = []
+
+        def _push_target(repo_config, target_config, conversion_dir, source_dir):
+            pushed.append(target_config['target_dest'])
+            return push_target(target_config)
+        s._push_target = _push_target
+        return s._push_repo(repo_config), pushed
+
+    def test_test_push_first(self):
+        s = VCSSyncTest(conversion_dir='a')
+        targets = [{'target_dest': 'remote1'},
+                   {'target_dest': 'test1', 'test_push': True},
+                   {'target_dest': 'remote2'}]
+        status, pushed = self._push_repo(s, repo('a', targets=targets),
+                                         lambda t: '')
+        self.assertEquals(status, '')
+        self.assertEquals(pushed, ['test1', 'remote1', 'remote2'])
+
+    def test_test_push_fails(self):
+        s = VCSSyncTest(conversion_dir='a')
+        targets = [{'target_dest': 'remote1'},
+                   {'target_dest': 'test1', 'test_push': True}]
+        status, pushed = self._push_repo(s, repo('a', targets=targets),
+                                         lambda t: "Can't push!\n")
+        self.assertEquals(status, "Can't push!\n")
+        self.assertEquals(pushed, ['test1'])
+
+    def test_max_parallel_pushes(self):
+        s = VCSSyncTest(conversion_dir='a', max_parallel_pushes=3)
+        started = []
+        all_started = threading.Event()
+
+        def push_target(target_config):
+            started.append(target_config['target_dest'])
+            if len(started) == 3:
+                all_started.set()
+            # Only succeeds if all the remote targets are pushed at once.
+            self.assertTrue(all_started.wait(5))
+            if target_config['target_dest'] == 'remote2':
+                return "Can't push remote2!\n"
+            return ''
+        targets = [{'target_dest': 'remote%d' % i} for i in range(3)]
+        status, pushed = self._push_repo(s, repo('a', targets=targets), push_target)
+        self.assertEquals(status, "Can't push remote2!\n")
+        self.assertEquals(sorted(pushed), ['remote0', 'remote1', 'remote2'])
+
+
+class TestUpdateWorkMirror(unittest.TestCase):
+    def tearDown(self):
+        for d in ('logs', 'build'):
+            shutil.rmtree(d, ignore_errors=True)
+
+    def test_failed_pull(self):
+        s = VCSSyncTest(conversion_dir='a', max_parallel_repos=2,
+                        conversion_repos=[repo('good', 'a'), repo('bad', 'b')])
+        dirs = s.query_abs_dirs()
+        source = os.path.join(dirs['abs_source_dir'], 'bad')
+        os.makedirs(source)
+        workers = []
+
+        def _update_work_mirror_repo(repo_config, previous_branches=None):
+            workers.append(threading.current_thread())
+            if repo_config['repo_name'] == 'bad':
+                return False
+            return {'default': {'hg_revision': 'abc'}}
+        s._update_work_mirror_repo = _update_work_mirror_repo
+        s.update_work_mirror()
+        self.assertEquals(s.failures, ['bad'])
+        self.assertFalse(os.path.exists(source))
+        self.assertTrue(threading.current_thread() not in workers)
+        repo_map = s._read_repo_update_json()
+        self.assertEquals(repo_map['repos']['bad'], {'previous_push_successful': False})
+        self.assertEquals(repo_map['repos']['good']['branches'],
+                          {'default': {'hg_revision': 'abc'}})
+
+
+class TestUnchangedRepos(unittest.TestCase):
+    previous_branches = {
+        'default': {'hg_branch': 'default', 'hg_revision': 'abc',
+                    'git_branch': 'master', 'git_revision': '123'},
+        'beta': {'hg_branch': 'beta', 'hg_revision': 'def',
+                 'git_branch': 'beta', 'git_revision': '456'},
+    }
+    branch_map = {'default': 'master', 'beta': 'beta'}
+
+    def setUp(self):
+        self.s = VCSSyncTest()
+
+    def tearDown(self):
+        for d in ('logs', 'build'):
+            shutil.rmtree(d, ignore_errors=True)
+
+    def test_unchanged(self):
+        self.assertTrue(self.s._query_branches_unchanged(
+            self.branch_map, {'default': 'abc', 'beta': 'def'}, self.previous_branches))
+
+    def test_new_revision(self):
+        self.assertFalse(self.s._query_branches_unchanged(
+            self.branch_map, {'default': 'abc', 'beta': 'fed'}, self.previous_branches))
+
+    def test_new_git_branch(self):
+        self.assertFalse(self.s._query_branches_unchanged(
+            {'default': 'main', 'beta': 'beta'}, {'default': 'abc', 'beta': 'def'},
+            self.previous_branches))
+
+    def test_new_branch(self):
+        self.assertFalse(self.s._query_branches_unchanged(
+            {'default': 'master', 'release': 'release'},
+            {'default': 'abc', 'release': 'abc'}, self.previous_branches))
+
+    def test_not_converted(self):
+        previous_branches = dict(self.previous_branches)
+        previous_branches['beta'] = dict(previous_branches['beta'], git_revision=None)
+        self.assertFalse(self.s._query_branches_unchanged(
+            self.branch_map, {'default': 'abc', 'beta': 'def'}, previous_branches))
+
+    def _push(self, s):
+        pushed = []
+
+        def _push_repo(repo_config):
+            pushed.append(repo_config['repo_name'])
+            return ''
+        s._push_repo = _push_repo
+        s.push()
+        return pushed
+
+    def test_push_skips_unchanged(self):
+        targets = [{'target_dest': 'github'}]
+        s = VCSSyncTest(conversion_repos=[repo('a', 'a', targets), repo('b', 'b', targets)],
+                        remote_targets={'github': {'repo': 'git@github.com:a', 'vcs': 'git'}})
+        self.assertEquals(self._push(s), ['a', 'b'])
+        s.unchanged_repos = ['a']
+        self.assertEquals(self._push(s), ['b'])
+
+    def test_push_changed_targets(self):
+        targets = [{'target_dest': 'github'}]
+        s = VCSSyncTest(conversion_repos=[repo('a', 'a', targets)],
+                        remote_targets={'github': {'repo': 'git@github.com:a', 'vcs': 'git'}})
+        self.assertEquals(self._push(s), ['a'])
+        s = VCSSyncTest(conversion_repos=[repo('a', 'a', targets)],
+                        remote_targets={'github': {'repo': 'git@github.com:b', 'vcs': 'git'}})
+        s.unchanged_repos = ['a']
+        self.assertEquals(self._push(s), ['a'])
+        self.assertEquals(self._push(s), [])
+
+    def test_push_failed_last_time(self):
+        s = VCSSyncTest(conversion_repos=[repo('a', 'a', [{'target_dest': 'github'}])])
+        s._update_repo_previous_status('a', successful_flag=False, write_update=True)
+        s.unchanged_repos = ['a']
+        self.assertEquals(self._push(s), ['a'])
+        self.assertEquals(self._push(s), [])